@@ -1,6 +1,16 @@
 # Page Zipper v1.1
 # Nathan Craddock 2018
 
+import time
+START = time.perf_counter()
+
+import multiprocessing
+import sys
+
 import ui
 
-ui.create_window()
+# Thumbnails are created in worker processes, which import this module again
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    # --measure-startup prints the time until the window is shown, then quits
+    ui.create_window(START, "--measure-startup" in sys.argv)
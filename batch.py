@@ -0,0 +1,180 @@
+import collections
+import csv
+import json
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import reporting
+import utils
+import zipper
+
+
+# Columns of a batch manifest, prefix may be left out
+FIELDS = ('left', 'right', 'output', 'prefix')
+
+
+class Job:
+    '''One book of a batch. line is where it is in the manifest, for error messages'''
+    def __init__(self, left, right, output, prefix="img_", line=0):
+        self.left = left
+        self.right = right
+        self.output = output
+        self.prefix = prefix
+        self.line = line
+
+
+# Reads a manifest: a CSV file with a header row naming the columns, or a JSON list of objects
+# with the same keys. Relative folders are relative to the manifest. Raises ValueError if a job is incomplete
+def read_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith(".json"):
+            rows = [(i + 1, row) for i, row in enumerate(json.load(f))]
+        else:
+            rows = [(reader.line_num, row) for reader in [csv.DictReader(f)] for row in reader]
+
+    jobs = []
+    for line, row in rows:
+        row = {k.strip().lower(): (v or "").strip() for k, v in row.items() if k}
+        missing = [field for field in FIELDS[:3] if not row.get(field)]
+        if missing:
+            raise ValueError("{0}, job {1}: no {2}".format(path, line, " or ".join(missing)))
+        folders = [os.path.join(base, os.path.expanduser(row[field])) for field in FIELDS[:3]]
+        jobs.append(Job(*folders, prefix=row.get('prefix') or "img_", line=line))
+    return jobs
+
+
+# The device of the volume a folder is on, or will be on once it is created
+def _volume(path):
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+class Result:
+    '''What happened to a job: the pages and bytes saved and the seconds taken, or the error'''
+    def __init__(self, job, pages=0, size=0, seconds=0.0, error=None):
+        self.job = job
+        self.pages = pages
+        self.size = size
+        self.seconds = seconds
+        self.error = error
+
+    def describe(self):
+        if self.error is not None:
+            return "FAILED job {0} ({1}): {2}".format(self.job.line, self.job.output, self.error)
+        seconds = max(self.seconds, 1e-6)
+        return "Saved {0} pages ({1:.1f} MB) to {2} in {3:.1f} s, {4:.1f} pages/s, {5:.1f} MB/s".format(
+            self.pages, self.size / 1e6, self.job.output, self.seconds, self.pages / seconds, self.size / 1e6 / seconds)
+
+    def to_dict(self):
+        return {'left': self.job.left, 'right': self.job.right, 'output': self.job.output, 'pages': self.pages,
+                'bytes': self.size, 'seconds': self.seconds, 'error': self.error}
+
+
+# Runs in worker processes. Zips one book as the command line does, returns (pages, bytes, seconds)
+def zip_book(left, right, output, prefix, mode, threads, clear):
+    start = time.perf_counter()
+    for folder in (left, right):
+        if not os.path.isdir(folder):
+            raise OSError("{0} is not a folder".format(folder))
+
+    right_pages = utils.list_pages(right, images_only=True)
+    left_pages = utils.list_pages(left, images_only=True)
+    if not left_pages or not right_pages:
+        raise ValueError("No images found")
+
+    # The right page (cover) goes first, as in the GUI
+    merged = zipper.ungroup(zipper.merge_lists(right_pages, left_pages))
+    size = sum(p.file_size if p.file_size is not None else os.path.getsize(p.path) for p in merged)
+
+    os.makedirs(output, exist_ok=True)
+    if clear:
+        zipper.clear_dir(output)
+    zipper.copy_files(merged, output, prefix, reporting.NullProgress, mode, threads)
+    return len(merged), size, time.perf_counter() - start
+
+
+# Ctrl+C reaches the whole process group, the main process decides when to stop
+def _ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _pool(processes):
+    return ProcessPoolExecutor(max_workers=processes, initializer=_ignore_interrupt)
+
+
+# Zips each job on a pool of worker processes, with at most per_volume jobs writing to the same
+# volume at once. Failed jobs are reported and the rest carry on. When progress is cancelled, the
+# jobs that are running are finished and no more are started.
+# Returns a Result for each job in manifest order, None for the jobs that were never started
+def run_batch(jobs, progress=reporting.ConsoleProgress, processes=2, per_volume=1, mode='copy', threads=4, clear=False):
+    progress = progress("Zipping Books", len(jobs))
+    volumes = [_volume(job.output) for job in jobs]
+    running = collections.Counter()
+    waiting = list(range(len(jobs)))
+    results = [None] * len(jobs)
+    retried = set()
+    executor = _pool(processes)
+
+    try:
+        pending = {}
+        stopping = False
+        broken = False
+        while pending or (waiting and not stopping):
+            stopping = stopping or reporting.cancelled(progress)
+
+            # The first waiting jobs whose volume has room are started, in manifest order
+            if not stopping and not broken:
+                for i in list(waiting):
+                    # A job that is tried again runs alone, so a crash only takes down the job that caused it
+                    if len(pending) >= processes or (pending and i in retried) or retried.intersection(pending.values()):
+                        break
+                    if running[volumes[i]] < per_volume:
+                        job = jobs[i]
+                        pending[executor.submit(zip_book, job.left, job.right, job.output, job.prefix, mode, threads, clear)] = i
+                        running[volumes[i]] += 1
+                        waiting.remove(i)
+
+            done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                running[volumes[i]] -= 1
+                try:
+                    results[i] = Result(jobs[i], *future.result())
+                except BrokenProcessPool:
+                    # Every job in the pool fails with the one that crashed it, so each is tried again
+                    broken = True
+                    if i not in retried:
+                        retried.add(i)
+                        waiting.insert(0, i)
+                        continue
+                    results[i] = Result(jobs[i], error="the worker process stopped unexpectedly")
+                except Exception as err:
+                    results[i] = Result(jobs[i], error="{0}: {1}".format(type(err).__name__, err))
+                progress.next()
+                progress.log_message(results[i].describe())
+
+            # A worker that dies takes the pool with it, the jobs still waiting get a new one
+            if broken and not pending:
+                executor.shutdown(wait=False)
+                executor = _pool(processes)
+                broken = False
+
+        finished = [r for r in results if r is not None]
+        failed = sum(1 for r in finished if r.error is not None)
+        progress.log_message("Zipped {0} of {1} books, {2} failed".format(len(finished) - failed, len(jobs), failed))
+    finally:
+        executor.shutdown()
+        progress.destroy()
+
+    return results
@@ -0,0 +1,67 @@
+'''Generates synthetic left/right capture folders for benchmarking
+
+Usage: python benchmarks/corpus.py <folder> [--count 100] [--width 4000] [--height 3000] [--format jpg]
+
+Creates <folder>/left and <folder>/right. Pages look like scanned text: a paper coloured
+background, lines of dark "words" and some sensor noise, so they compress like real captures.
+'''
+import argparse
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+FORMATS = {'jpg': ('JPEG', {'quality': 90}), 'png': ('PNG', {}), 'tif': ('TIFF', {'compression': 'tiff_lzw'})}
+
+
+def make_page(width, height, seed):
+    rng = random.Random(seed)
+    shade = rng.randint(215, 240)
+    image = Image.new('RGB', (width, height), (shade, shade - 8, shade - 30))
+    draw = ImageDraw.Draw(image)
+
+    margin = width // 12
+    line = max(height // 60, 4)
+    for y in range(margin, height - margin, line * 2):
+        x = margin
+        while x < width - margin:
+            word = rng.randint(line, line * 6)
+            draw.rectangle([x, y, min(x + word, width - margin), y + line], fill=(40, 35, 30))
+            x += word + line
+
+    noise = Image.effect_noise((width, height), 20).convert('RGB')
+    return Image.blend(image, noise, 0.12)
+
+
+# Returns the (left, right) folders
+def generate(folder, count=100, width=4000, height=3000, fmt='jpg', seed=0):
+    name, options = FORMATS[fmt]
+    left = os.path.join(folder, "left")
+    right = os.path.join(folder, "right")
+
+    for side, path in enumerate((left, right)):
+        os.makedirs(path, exist_ok=True)
+        for i in range(count):
+            target = os.path.join(path, "IMG_{0:05d}.{1}".format(i + 1, fmt))
+            if not os.path.exists(target):
+                make_page(width, height, seed + side * count + i).save(target, name, **options)
+
+    return left, right
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic capture folders")
+    parser.add_argument("folder")
+    parser.add_argument("--count", type=int, default=100, help="pages per side")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--format", default='jpg', choices=list(FORMATS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    left, right = generate(args.folder, args.count, args.width, args.height, args.format, args.seed)
+    print("Wrote {0} pages to {1} and {2}".format(args.count, left, right))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+'''Times the main Page Zipper operations on a synthetic corpus and checks them for regressions
+
+Usage: python benchmarks/run.py [--count 100] [--width 4000] [--height 3000] [--format jpg]
+                                [--output results.json] [--baseline old.json] [--thresholds thresholds.json]
+
+Results are written as JSON, one entry per benchmark with the total seconds, the number of
+items and the milliseconds per item. With --baseline, a benchmark whose ms per item grew by more
+than its threshold ratio (from thresholds.json, "default" otherwise) is reported and the exit
+code is 1. Benchmarks that took less than "min_seconds" in total are not compared.
+
+The viewer benchmarks need a display. On a headless machine run under a virtual one:
+
+    xvfb-run -a python benchmarks/run.py
+
+Without a display they are recorded as skipped.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep benchmark thumbnails and folder indexes out of the user's cache, each run starts cold
+# and removes its own. The folder indexes go under the per-user cache directory
+CACHE = tempfile.mkdtemp(prefix="page-zipper-bench-cache-")
+os.environ["PAGE_ZIPPER_CACHE"] = CACHE
+os.environ["XDG_CACHE_HOME"] = CACHE
+os.environ["LOCALAPPDATA"] = CACHE
+
+import corpus
+import pagesequence
+import reporting
+import screening
+import stats
+import utils
+import zipper
+
+
+class Timer:
+    '''Adds up the time spent in each named stage'''
+    def __init__(self):
+        self.results = {}
+
+    def record(self, name, seconds, items=1):
+        total, count = self.results.get(name, (0.0, 0))
+        self.results[name] = (total + seconds, count + items)
+
+    def time(self, name, function, items=1, repeat=1):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            value = function()
+        self.record(name, time.perf_counter() - start, items * repeat)
+        return value
+
+    def skip(self, name, reason):
+        self.results[name] = reason
+
+    def report(self):
+        out = {}
+        for name, result in self.results.items():
+            if isinstance(result, str):
+                out[name] = {'skipped': result}
+            else:
+                seconds, items = result
+                out[name] = {'seconds': seconds, 'items': items, 'ms_per_item': 1000 * seconds / max(items, 1)}
+        return out
+
+
+# Times utils.make_thumbnail_data, and each of its stages from the timings it records
+def bench_thumbnails(timer, paths, size):
+    recorder = stats.Recorder()
+    for path in paths:
+        timer.time('thumbnail.total', lambda: utils.make_thumbnail_data(path, size, recorder=recorder))
+
+    for name, count, total, mean, longest in recorder.summary():
+        timer.record(name, total, count)
+
+
+def bench_pages(timer, left, right):
+    from folderindex import FolderIndex
+
+    for folder in (left, right):
+        index = FolderIndex.index_path(folder)
+        if os.path.exists(index):
+            os.remove(index)
+
+    count = len(os.listdir(left)) + len(os.listdir(right))
+    timer.time('list_pages.cold', lambda: (utils.list_pages(left), utils.list_pages(right)), count)
+    left_pages, right_pages = timer.time('list_pages.warm', lambda: (utils.list_pages(left), utils.list_pages(right)), count)
+
+    # Group every fourth pair, as a user joining fold out pages would
+    grouped = [utils.PageGroup(right_pages[i:i + 2]) if i % 4 == 0 else p for i, p in enumerate(right_pages)]
+    merged = timer.time('merge_lists', lambda: zipper.merge_lists(grouped, left_pages), count, repeat=100)
+    timer.time('ungroup', lambda: zipper.ungroup(merged), count, repeat=100)
+
+    return zipper.ungroup(zipper.merge_lists(right_pages, left_pages))
+
+
+# Groups and ungroups pages across a long book, where a list would shift every later page
+def bench_sequence(timer, pages, length=10000, groups=1000):
+    entries = (pages * (length // max(len(pages), 1) + 1))[:length]
+    sequence = timer.time('PageSequence.build', lambda: pagesequence.PageSequence(entries), length)
+
+    def group():
+        grouped = sequence
+        for i in range(groups):
+            grouped = grouped.group(i, i + 2)
+        return grouped
+    grouped = timer.time('PageSequence.group', group, groups)
+
+    def ungroup():
+        ungrouped = grouped
+        for i in reversed(range(groups)):
+            ungrouped = ungrouped.ungroup(i)
+        return ungrouped
+    timer.time('PageSequence.ungroup', ungroup, groups)
+    timer.time('PageSequence.move', lambda: [sequence.move(i, i + 10, length - 20 - i) for i in range(groups)], groups)
+
+    # Each group click near the front of the book updates the output and looks up the pages in view
+    model = zipper.OutputModel()
+
+    def update():
+        for i in range(groups):
+            model.update(grouped if i % 2 else sequence, sequence, i)
+            [model.pages[j] for j in range(i, i + 10)]
+    timer.time('OutputModel.update', update, groups)
+
+
+# Screens the book for blank pages and double captures, then an index of length hashes for the comparison alone
+def bench_screening(timer, pages, length=10000):
+    import random
+
+    screening._known.clear()
+    timer.time('screen_pages.cold', lambda: screening.screen_pages(pages, reporting.NullProgress), len(pages))
+    timer.time('screen_pages.warm', lambda: screening.screen_pages(pages, reporting.NullProgress), len(pages))
+
+    bits = screening.HASH_SIZE * screening.HASH_SIZE
+    hashes = [random.Random(i).getrandbits(bits) for i in range(length)]
+
+    def compare():
+        index = screening.HashIndex()
+        for i, value in enumerate(hashes):
+            index.search(value)
+            index.add(value, i)
+    timer.time('HashIndex.search', compare, length)
+
+
+def bench_files(timer, pages, work):
+    out = os.path.join(work, "output")
+    os.mkdir(out)
+    timer.time('copy_files', lambda: zipper.copy_files(pages, out, progress=reporting.NullProgress), len(pages))
+
+    for in_place in (False, True):
+        name = 'rename_files.in_place' if in_place else 'rename_files.copy'
+        target = os.path.join(work, name)
+        shutil.copytree(out, target)
+        timer.time(name, lambda: utils.rename_files(target, 1, "page_", reporting.NullProgress, in_place), len(pages))
+
+
+# Times listing a folder in the viewer, waiting for the thumbnails in view, and redrawing them
+def bench_viewer(timer, left):
+    import tkinter as tk
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as err:
+        for name in ('PagesFrame.list_pages', 'ThumbnailViewer.thumbnails_shown', 'ThumbnailViewer.draw'):
+            timer.skip(name, "no display: {0}".format(err))
+        return
+    root.withdraw()
+
+    import widgets
+
+    frame = widgets.PagesFrame(root, "Benchmark")
+    frame.grid()
+    count = len(os.listdir(left))
+    frame.pages = timer.time('PagesFrame.list_pages', lambda: frame.load_pages(left), count)
+
+    # Thumbnails are made in the background, so this runs the event loop until every page in view has one
+    def thumbnails_shown():
+        frame.viewer.reload_pages(frame.pages)
+        deadline = time.perf_counter() + 300
+        while time.perf_counter() < deadline:
+            root.update()
+            first, last = frame.viewer.visible_range()
+            if all(frame.viewer.pages[i].loaded is not None for i in range(first, last)):
+                return last - first
+            time.sleep(0.005)
+        raise RuntimeError("Thumbnails were not made within 5 minutes")
+
+    start = time.perf_counter()
+    shown = thumbnails_shown()
+    timer.record('ThumbnailViewer.thumbnails_shown', time.perf_counter() - start, shown)
+
+    def draw():
+        frame.viewer.draw()
+        root.update_idletasks()
+
+    timer.time('ThumbnailViewer.draw', draw, repeat=20)
+    root.destroy()
+
+
+# Returns the benchmarks whose ms per item grew past their threshold ratio
+def regressions(results, baseline, thresholds):
+    found = []
+    for name, result in results.items():
+        old = baseline.get(name, {})
+        if 'ms_per_item' not in result or not old.get('ms_per_item'):
+            continue
+        # Timings this short are mostly noise
+        if max(result['seconds'], old['seconds']) < thresholds.get('min_seconds', 0.05):
+            continue
+
+        ratio = result['ms_per_item'] / old['ms_per_item']
+        limit = thresholds.get(name, thresholds.get('default', 1.25))
+        if ratio > limit:
+            found.append((name, ratio, limit))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Page Zipper on a synthetic corpus")
+    parser.add_argument("--corpus", help="folder for the generated corpus, reused between runs")
+    parser.add_argument("--count", type=int, default=100, help="pages per side")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--format", default='jpg', choices=list(corpus.FORMATS))
+    parser.add_argument("--samples", type=int, default=20, help="pages timed for thumbnails")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--thresholds", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json"),
+                        help="JSON of allowed slowdown ratios per benchmark")
+    args = parser.parse_args()
+
+    folder = args.corpus or os.path.join(tempfile.gettempdir(), "page-zipper-corpus-{0}-{1}x{2}-{3}".format(
+        args.count, args.width, args.height, args.format))
+    print("Generating corpus in {0}".format(folder), file=sys.stderr)
+    left, right = corpus.generate(folder, args.count, args.width, args.height, args.format)
+
+    timer = Timer()
+    work = tempfile.mkdtemp(prefix="page-zipper-bench-")
+    try:
+        paths = sorted(os.path.join(left, f) for f in os.listdir(left))[:args.samples]
+        bench_thumbnails(timer, paths, utils.Page.size)
+        pages = bench_pages(timer, left, right)
+        bench_sequence(timer, pages)
+        bench_screening(timer, pages)
+        bench_files(timer, pages, work)
+        bench_viewer(timer, left)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        shutil.rmtree(CACHE, ignore_errors=True)
+
+    report = {
+        'config': {'count': args.count, 'width': args.width, 'height': args.height, 'format': args.format, 'samples': args.samples},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': timer.report(),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+
+        found = regressions(report['results'], baseline, thresholds)
+        for name, ratio, limit in found:
+            print("Regression: {0} is {1:.2f}x slower (allowed {2:.2f}x)".format(name, ratio, limit), file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+'''Compares the per-page thumbnail time of the original GIF path and the fast PPM path
+
+Usage: python benchmarks/thumbnails.py <folder> [--size 250] [--repeat 3] [--tk]
+
+--tk also times creating the tk.PhotoImage, which needs a display.
+The files are read once before timing, so neither path pays for a cold page cache, and the
+two paths take turns going first on each repeat.
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+def time_thumbnails(paths, size, fast, photo):
+    times = []
+    for path in paths:
+        start = time.perf_counter()
+        data = utils.make_thumbnail_data(path, size, fast)
+        if photo:
+            photo(data=data)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+# Reads every file once, and makes one thumbnail each way, so the first timed pass starts as warm as the rest
+def warm_up(paths, size):
+    for path in paths:
+        with open(path, 'rb') as f:
+            while f.read(1024 * 1024):
+                pass
+    for fast in (False, True):
+        utils.make_thumbnail_data(paths[0], size, fast)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark page thumbnail creation")
+    parser.add_argument("folder", help="folder of captures to benchmark")
+    parser.add_argument("--size", type=int, default=utils.Page.size, help="thumbnail size")
+    parser.add_argument("--repeat", type=int, default=3, help="timed passes of each path")
+    parser.add_argument("--tk", action="store_true", help="include tk.PhotoImage creation")
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(args.folder, f) for f in os.listdir(args.folder))
+    paths = [p for p in paths if os.path.isfile(p)]
+
+    photo = None
+    if args.tk:
+        import tkinter as tk
+        root = tk.Tk()
+        root.withdraw()
+        photo = tk.PhotoImage
+
+    print("{0} pages from {1}, {2} passes each".format(len(paths), args.folder, args.repeat))
+    if not paths:
+        return
+    warm_up(paths, args.size)
+
+    times = {False: [], True: []}
+    for i in range(args.repeat):
+        for fast in ((False, True) if i % 2 == 0 else (True, False)):
+            times[fast].extend(time_thumbnails(paths, args.size, fast, photo))
+
+    results = {}
+    for label, fast in (("before (full decode, GIF)", False), ("after (draft/EXIF, PPM)", True)):
+        results[fast] = statistics.mean(times[fast])
+        print("{0:28} mean {1:8.2f} ms/page   median {2:8.2f} ms/page".format(
+            label, results[fast] * 1000, statistics.median(times[fast]) * 1000))
+
+    print("speedup: {0:.1f}x".format(results[False] / results[True]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+
+
+def user_directory():
+    '''Returns the per-user directory where Page Zipper keeps cached data'''
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+
+    return os.path.join(base, "page-zipper")
+
+
+def default_directory():
+    '''Returns the per-user directory where thumbnails are cached'''
+    if os.environ.get("PAGE_ZIPPER_CACHE"):
+        return os.environ["PAGE_ZIPPER_CACHE"]
+
+    return os.path.join(user_directory(), "thumbnails")
+
+
+class ThumbnailCache:
+    '''A content-addressed on-disk cache of thumbnails with a size cap and LRU eviction'''
+
+    # Bump when the stored thumbnail format changes so old entries are never reused
+    version = 2
+
+    def __init__(self, directory=None, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    # stat is the (file size, mtime_ns) of path if it is already known
+    def key(self, path, size, stat=None):
+        if stat is None:
+            result = os.stat(path)
+            stat = result.st_size, result.st_mtime_ns
+        text = "{0}|{1}|{2}|{3}|{4}".format(os.path.abspath(path), stat[1], stat[0], size, ThumbnailCache.version)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # Returns the cached thumbnail data, or None on a miss
+    # Lookups with count=False are left out of the hit and miss counts
+    def get(self, path, size, count=True, stat=None):
+        try:
+            entry = self.entry_path(self.key(path, size, stat))
+            with open(entry, 'rb') as f:
+                data = f.read()
+            # Touching the entry marks it as recently used for eviction
+            os.utime(entry)
+        except OSError:
+            if count:
+                with self.lock:
+                    self.misses += 1
+            return None
+
+        if count:
+            with self.lock:
+                self.hits += 1
+        return data
+
+    def put(self, path, size, data, stat=None):
+        try:
+            entry = self.entry_path(self.key(path, size, stat))
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+            # Write to a temporary file first so readers never see a partial thumbnail
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(entry))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp, entry)
+        except OSError as err:
+            print("Error Caching Thumbnail: {0}".format(err))
+            return
+
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += len(data)
+
+        if self.size() > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        found = []
+        if not os.path.isdir(self.directory):
+            return found
+
+        for bucket in os.scandir(self.directory):
+            if bucket.is_dir():
+                for entry in os.scandir(bucket.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, stat.st_size, entry.path))
+        return found
+
+    def size(self):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.entries())
+            return self.total_bytes
+
+    # Remove the least recently used entries until the cache is back under its cap
+    def evict(self):
+        with self.lock:
+            entries = self.entries()
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+
+            for _, size, path in entries:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+            self.total_bytes = total
+
+    def stats(self):
+        with self.lock:
+            return self.hits, self.misses
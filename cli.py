@@ -0,0 +1,217 @@
+# Page Zipper command line
+# Zips a book without the GUI, e.g. on a server or from cron. tkinter is never imported.
+
+import argparse
+import json
+import os
+import signal
+import sys
+
+import batch
+import export
+import fixity
+import reporting
+import spreads
+import transcode
+import sync
+import transfer
+import utils
+import zipper
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Merge (zip) right and left captured pages of a book into one folder.")
+    parser.add_argument("left", help="folder of left page captures")
+    parser.add_argument("right", help="folder of right page captures")
+    parser.add_argument("output", help="folder to save the zipped pages in")
+    parser.add_argument("--prefix", default="img_", help="file name prefix (default: img_)")
+    parser.add_argument("--mode", default='copy', choices=list(transfer.MODES),
+                        help="how pages are put in the output folder, falls back to copying when not supported (default: copy)")
+    parser.add_argument("--format", default='files', choices=list(export.FORMATS),
+                        help="save numbered files, or a single document named after the output folder (default: files)")
+    parser.add_argument("--spreads", action="store_true", help="join facing pages side by side into one image per spread")
+    parser.add_argument("--pair-cover", action="store_true", help="with --spreads, join the cover with the next page instead of keeping it alone")
+    parser.add_argument("--gap", type=int, default=0, help="with --spreads, pixels between the two pages (default: 0)")
+    parser.add_argument("--align", default='center', choices=list(spreads.ALIGNMENTS), help="with --spreads, placement of a shorter page (default: center)")
+    parser.add_argument("--long-edge", type=int, default=0, help="save access copies resized to this many pixels on the longest side")
+    parser.add_argument("--to", choices=list(transcode.FORMATS), help="save access copies in this format")
+    parser.add_argument("--quality", type=int, default=85, help="JPEG or WebP quality of access copies (default: 85)")
+    parser.add_argument("--strip-metadata", action="store_true", help="leave EXIF and other metadata out of access copies")
+    parser.add_argument("--manifest", choices=list(fixity.ALGORITHMS),
+                        help="write a BagIt style checksum manifest of the saved files, e.g. manifest-sha256.txt")
+    parser.add_argument("--jobs", type=int, default=4, help="number of files copied at the same time (default: 4)")
+    parser.add_argument("--clear", action="store_true", help="delete the files in the output folder first, like the Save button")
+    parser.add_argument("--sync", action="store_true", help="only write, rename or delete the output files that differ")
+    parser.add_argument("--hash", action="store_true", help="with --sync, compare file contents instead of size and modification time")
+    parser.add_argument("--dry-run", action="store_true", help="with --sync, print the planned changes without making them")
+    parser.add_argument("--resume", action="store_true", help="finish a save that was interrupted, instead of starting over")
+    parser.add_argument("--verbose", action="store_true", help="print every copied file")
+    return parser.parse_args(argv)
+
+
+def parse_verify_args(argv):
+    parser = argparse.ArgumentParser(prog="cli.py verify", description="Check the files in a folder against its checksum manifest.")
+    parser.add_argument("folder", help="folder saved with a manifest")
+    parser.add_argument("--jobs", type=int, default=4, help="number of files checked at the same time (default: 4)")
+    parser.add_argument("--verbose", action="store_true", help="print every checked file")
+    return parser.parse_args(argv)
+
+
+def parse_batch_args(argv):
+    parser = argparse.ArgumentParser(prog="cli.py batch", description="Zip every book listed in a manifest.")
+    parser.add_argument("manifest", help="CSV file with the columns left, right, output and optionally prefix, or a JSON list of the same")
+    parser.add_argument("--processes", type=int, default=2, help="number of books zipped at the same time (default: 2)")
+    parser.add_argument("--per-volume", type=int, default=1, help="number of books written to the same drive at the same time (default: 1)")
+    parser.add_argument("--jobs", type=int, default=4, help="number of files copied at the same time within a book (default: 4)")
+    parser.add_argument("--mode", default='copy', choices=list(transfer.MODES), help="how pages are put in the output folders (default: copy)")
+    parser.add_argument("--clear", action="store_true", help="delete the files in each output folder first")
+    parser.add_argument("--report", help="write the result of each book to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="print each book as it finishes")
+    return parser.parse_args(argv)
+
+
+# python cli.py batch <manifest> zips many books, returns 1 if any book failed
+def run_batch(argv):
+    args = parse_batch_args(argv)
+    try:
+        jobs = batch.read_manifest(args.manifest)
+    except (OSError, ValueError) as err:
+        print("Error: {0}".format(err), file=sys.stderr)
+        return 1
+
+    progress = lambda title, steps: reporting.ConsoleProgress(title, steps, args.verbose)
+    results = batch.run_batch(jobs, progress, max(1, args.processes), max(1, args.per_volume), args.mode, max(1, args.jobs), args.clear)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump([r.to_dict() if r is not None else None for r in results], f, indent=2)
+
+    failed = [r for r in results if r is not None and r.error is not None]
+    for result in failed:
+        print(result.describe(), file=sys.stderr)
+    if None in results:
+        print("Stopped, {0} books were not started".format(results.count(None)), file=sys.stderr)
+        return 130
+    return 1 if failed else 0
+
+
+# python cli.py verify <folder> re-checks a saved folder, returns 1 if any file does not match
+def verify(argv):
+    args = parse_verify_args(argv)
+    if fixity.find_manifest(args.folder) is None:
+        print("Error: {0} has no checksum manifest".format(args.folder), file=sys.stderr)
+        return 1
+
+    progress = lambda title, steps: reporting.ConsoleProgress(title, steps, args.verbose)
+    problems = fixity.verify_folder(args.folder, progress, max(1, args.jobs))
+    for name, problem in problems:
+        print("{0}: {1}".format(name, problem), file=sys.stderr)
+    return 1 if problems else 0
+
+
+# The first Ctrl+C stops the save at the next checkpoint, a second one stops it at once
+def _interrupt(signum, frame):
+    if reporting.ConsoleProgress.cancelled:
+        raise KeyboardInterrupt()
+    reporting.ConsoleProgress.cancelled = True
+    print("\nStopping after the files being copied, press Ctrl+C again to stop now", file=sys.stderr)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    signal.signal(signal.SIGINT, _interrupt)
+
+    if argv[:1] == ["batch"]:
+        return run_batch(argv[1:])
+    if argv[:1] == ["verify"]:
+        try:
+            return verify(argv[1:])
+        except reporting.Cancelled:
+            print("Stopped", file=sys.stderr)
+            return 130
+
+    args = parse_args(argv)
+    try:
+        return _run(args)
+    except reporting.Cancelled:
+        print("Stopped", file=sys.stderr)
+        if zipper.pending_save(args.output):
+            print("Run again with --resume to finish the save", file=sys.stderr)
+        return 130
+
+
+def _run(args):
+    for folder in (args.left, args.right):
+        if not os.path.isdir(folder):
+            print("Error: {0} is not a folder".format(folder), file=sys.stderr)
+            return 1
+
+    left = utils.list_pages(args.left, images_only=True)
+    right = utils.list_pages(args.right, images_only=True)
+    if not left or not right:
+        print("Error: No images found", file=sys.stderr)
+        return 1
+
+    # The right page (cover) goes first, as in the GUI
+    merged = zipper.merge_lists(right, left)
+    merged = zipper.ungroup(merged)
+
+    progress = lambda title, steps: reporting.ConsoleProgress(title, steps, args.verbose)
+
+    if args.resume:
+        if not zipper.pending_save(args.output):
+            print("Error: No interrupted save in {0}".format(args.output), file=sys.stderr)
+            return 1
+        zipper.resume_save(args.output, progress, args.jobs)
+        print("Finished the save in {0}".format(args.output))
+        return 0
+
+    if args.format != 'files':
+        os.makedirs(args.output, exist_ok=True)
+        target = export.document_path(args.output, args.format)
+        export.export_files(merged, target, args.format, args.prefix, progress)
+        print("Saved {0} pages to {1}".format(len(merged), target))
+        return 0
+
+    # Spreads and access copies are always written in full, without a manifest
+    if args.spreads or args.long_edge or args.to:
+        unused = [name for name, used in (("--long-edge/--to", args.spreads and (args.long_edge or args.to)), ("--manifest", args.manifest),
+                                          ("--sync", args.sync), ("--mode", args.mode != 'copy')) if used]
+        if unused:
+            print("Warning: {0} not used with {1}".format(", ".join(unused), "--spreads" if args.spreads else "access copies"), file=sys.stderr)
+
+    if args.spreads:
+        os.makedirs(args.output, exist_ok=True)
+        if args.clear:
+            zipper.clear_dir(args.output)
+        spreads.stitch_files(merged, args.output, args.prefix, progress, args.jobs, not args.pair_cover, max(0, args.gap), args.align)
+        print("Saved {0} pages as spreads to {1}".format(len(merged), args.output))
+        return 0
+
+    if args.long_edge or args.to:
+        os.makedirs(args.output, exist_ok=True)
+        if args.clear:
+            zipper.clear_dir(args.output)
+        profile = transcode.Profile(max(0, args.long_edge), args.to or 'keep', args.quality, args.strip_metadata)
+        transcode.transcode_files(merged, args.output, profile, args.prefix, progress, args.jobs)
+        print("Saved {0} access copies to {1}".format(len(merged), args.output))
+        return 0
+
+    if args.sync:
+        plan = sync.plan_sync(merged, args.output, args.prefix, 'hash' if args.hash else 'stat')
+        print(plan.summary(limit=len(merged) if args.verbose else 5))
+        if args.dry_run:
+            return 0
+        sync.apply_sync(plan, progress, args.mode, args.jobs, args.manifest)
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        if args.clear:
+            zipper.clear_dir(args.output)
+        zipper.copy_files(merged, args.output, args.prefix, progress, args.mode, args.jobs, args.manifest)
+
+    print("Saved {0} pages to {1}".format(len(merged), args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+import collections
+import os
+import shutil
+import struct
+import zipfile
+import zlib
+
+import reporting
+import stats
+import utils
+import zipper
+
+
+# Output formats, with the name shown in the Output tab
+FORMATS = collections.OrderedDict([
+    ('files', "Numbered Files"),
+    ('pdf', "PDF"),
+    ('tiff', "Multi-page TIFF"),
+    ('cbz', "CBZ (comic book zip)"),
+])
+
+EXTENSIONS = {'pdf': ".pdf", 'tiff': ".tif", 'cbz': ".cbz"}
+
+# Bytes copied at a time when a page is passed through
+CHUNK = 1024 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+# Returns the document saved in an output folder, named after the folder
+def document_path(folder, fmt):
+    return os.path.join(folder, os.path.basename(os.path.abspath(folder)) + EXTENSIONS[fmt])
+
+
+def _dpi(image):
+    dpi = image.info.get('dpi')
+    try:
+        return float(dpi[0]) or 72.0
+    except (TypeError, IndexError, ValueError):
+        return 72.0
+
+
+class PdfWriter:
+    '''Writes a PDF one page at a time, with one image per page
+
+    JPEG files are stored unchanged with DCTDecode, and 8 bit grey or RGB PNG files have
+    their compressed data copied with FlateDecode. Other images are decoded and stored
+    losslessly, except 16 bit grey pages, which are scaled to 8 bits. Only one page is
+    held in memory at a time.
+    '''
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.offsets = {}
+        self.kids = []
+        # 1 and 2 are the page tree and catalog, written last
+        self.next_number = 3
+        self.f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def new_object(self):
+        number = self.next_number
+        self.next_number += 1
+        return number
+
+    def begin(self, number):
+        self.offsets[number] = self.f.tell()
+        self.f.write(b"%d 0 obj\n" % number)
+
+    def end(self):
+        self.f.write(b"\nendobj\n")
+
+    def write_object(self, number, body):
+        self.begin(number)
+        self.f.write(body)
+        self.end()
+
+    # Returns True if the image data was stored without decoding it
+    def add_page(self, path, name=None):
+        from PIL import Image
+
+        with Image.open(path) as image:
+            width, height = image.size
+            dpi = _dpi(image)
+            if image.format == 'JPEG' and image.mode in ('L', 'RGB', 'CMYK'):
+                passed = True
+                write = self.image_jpeg(path, image)
+            elif image.format == 'PNG' and self.png_direct(path):
+                passed = True
+                write = self.image_png(path, image)
+            else:
+                passed = False
+                write = self.image_pixels(image)
+
+            image_number, length_number = self.new_object(), self.new_object()
+            self.begin(image_number)
+            self.f.write(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /Length %d 0 R " % (width, height, length_number))
+            self.f.write(write[0] + b" >>\nstream\n")
+            start = self.f.tell()
+            write[1]()
+            length = self.f.tell() - start
+            self.f.write(b"\nendstream")
+            self.end()
+            self.write_object(length_number, b"%d" % length)
+
+        # Page size in points, from the image resolution
+        w = width * 72.0 / dpi
+        h = height * 72.0 / dpi
+        content = b"q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (w, h)
+        content_number = self.new_object()
+        self.write_object(content_number, b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+
+        page_number = self.new_object()
+        self.write_object(page_number, b"<< /Type /Page /Parent 1 0 R /MediaBox [0 0 %.2f %.2f] /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>" % (
+            w, h, image_number, content_number))
+        self.kids.append(page_number)
+        return passed
+
+    # Each image_ method returns (dictionary entries, function that writes the stream)
+    def image_jpeg(self, path, image):
+        space = {'L': b"/DeviceGray", 'RGB': b"/DeviceRGB", 'CMYK': b"/DeviceCMYK"}[image.mode]
+        entries = b"/ColorSpace " + space + b" /BitsPerComponent 8 /Filter /DCTDecode"
+        if image.mode == 'CMYK' and 'adobe' in image.info:
+            # Adobe CMYK JPEGs are stored inverted
+            entries += b" /Decode [1 0 1 0 1 0 1 0]"
+
+        def write():
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.f, CHUNK)
+        return entries, write
+
+    # PNG data can be used as is when it is 8 bit grey or RGB without interlacing
+    @staticmethod
+    def png_direct(path):
+        with open(path, 'rb') as f:
+            header = f.read(33)
+        if len(header) < 33 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+            return False
+        depth, colour, compression, filtering, interlace = header[24:29]
+        return depth == 8 and colour in (0, 2) and interlace == 0
+
+    def image_png(self, path, image):
+        colours = 1 if image.mode == 'L' else 3
+        entries = b"/ColorSpace %s /BitsPerComponent 8 /Filter /FlateDecode /DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent 8 /Columns %d >>" % (
+            b"/DeviceGray" if colours == 1 else b"/DeviceRGB", colours, image.width)
+
+        # The IDAT chunks together are one zlib stream of the filtered rows, which FlateDecode with a PNG predictor reads
+        def write():
+            with open(path, 'rb') as f:
+                f.seek(8)
+                while True:
+                    header = f.read(8)
+                    if len(header) < 8:
+                        break
+                    length, kind = struct.unpack('>I4s', header)
+                    if kind == b'IDAT':
+                        remaining = length
+                        while remaining:
+                            data = f.read(min(remaining, CHUNK))
+                            if not data:
+                                raise OSError("Truncated PNG file {0}".format(path))
+                            self.f.write(data)
+                            remaining -= len(data)
+                        f.seek(4, os.SEEK_CUR)
+                    elif kind == b'IEND':
+                        break
+                    else:
+                        f.seek(length + 4, os.SEEK_CUR)
+        return entries, write
+
+    def image_pixels(self, image):
+        image = utils.to_8_bits(image)
+        if image.mode not in ('L', 'RGB', 'CMYK'):
+            image = image.convert('RGB')
+        space = {'L': b"/DeviceGray", 'RGB': b"/DeviceRGB", 'CMYK': b"/DeviceCMYK"}[image.mode]
+        entries = b"/ColorSpace " + space + b" /BitsPerComponent 8 /Filter /FlateDecode"
+
+        # Compressed in strips of rows, so the raw pixels are never copied as a whole
+        def write():
+            compressor = zlib.compressobj(6)
+            rows = max(1, CHUNK // (image.width * len(image.getbands())))
+            for y in range(0, image.height, rows):
+                strip = image.crop((0, y, image.width, min(y + rows, image.height)))
+                self.f.write(compressor.compress(strip.tobytes()))
+            self.f.write(compressor.flush())
+        return entries, write
+
+    def close(self):
+        self.write_object(1, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in self.kids), len(self.kids)))
+        self.write_object(2, b"<< /Type /Catalog /Pages 1 0 R >>")
+
+        xref = self.f.tell()
+        self.f.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_number)
+        for number in range(1, self.next_number):
+            self.f.write(b"%010d 00000 n \n" % self.offsets[number])
+        self.f.write(b"trailer\n<< /Size %d /Root 2 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_number, xref))
+        self.f.close()
+
+    def abort(self):
+        self.f.close()
+
+
+class TiffWriter:
+    '''Writes a multi-page TIFF one page at a time
+
+    TIFF pages can't hold the original JPEG data, so every page is decoded and stored
+    with lossless deflate compression. 16 bit grey pages keep their depth.
+    '''
+    def __init__(self, path):
+        from PIL import TiffImagePlugin
+
+        self.writer = TiffImagePlugin.AppendingTiffWriter(path, True)
+
+    def add_page(self, path, name=None):
+        from PIL import Image
+
+        with Image.open(path) as image:
+            dpi = _dpi(image)
+            # TIFF stores 16 bit grey as it is, other 16 bit grey modes are scaled down
+            if image.mode != 'I;16':
+                image = utils.to_8_bits(image)
+            if image.mode not in ('1', 'L', 'I;16', 'RGB', 'CMYK'):
+                image = image.convert('RGB')
+            image.save(self.writer, 'TIFF', compression='tiff_adobe_deflate', dpi=(dpi, dpi))
+        self.writer.newFrame()
+        return False
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.close()
+
+
+class CbzWriter:
+    '''Writes the page files unchanged into an uncompressed zip, named in page order'''
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+    def add_page(self, path, name):
+        self.zip.write(path, name)
+        return True
+
+    def close(self):
+        self.zip.close()
+
+    def abort(self):
+        self.zip.close()
+
+
+WRITERS = {'pdf': PdfWriter, 'tiff': TiffWriter, 'cbz': CbzWriter}
+
+
+# Streams the pages in order into a single document at target
+# The document is written next to target first, so a failed export never leaves a partial file behind
+def export_files(files, target, fmt, pre="img_", progress=reporting.ConsoleProgress):
+    progress = progress("Exporting " + FORMATS[fmt], len(files))
+    batch = reporting.Batcher(progress)
+    partial = target + ".part"
+    writer = WRITERS[fmt](partial)
+    passed = 0
+
+    try:
+        for i, page in enumerate(files):
+            # A stopped export removes the partial document, so it is started again from the beginning
+            if reporting.cancelled(progress):
+                raise reporting.Cancelled()
+            with stats.timer('export.' + fmt):
+                unchanged = writer.add_page(page.path, zipper.output_name(i, page.path, len(files), pre))
+            passed += unchanged
+            batch.next("Added {0}{1}".format(page.path, "" if unchanged else " (decoded)"))
+
+        writer.close()
+        os.replace(partial, target)
+
+        batch.flush()
+        progress.log_message("Saved {0}, {1} of {2} pages stored without re-encoding".format(target, passed, len(files)))
+    except:
+        writer.abort()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        progress.destroy()
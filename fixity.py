@@ -0,0 +1,175 @@
+import collections
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import reporting
+import stats
+
+
+# Checksum algorithms for manifests, with the name shown in the Output tab
+ALGORITHMS = collections.OrderedDict([
+    ('sha256', "SHA-256"),
+    ('sha512', "SHA-512"),
+    ('blake2b', "BLAKE2b"),
+])
+
+# Bytes read at a time. Each thread keeps one buffer, so no memory is allocated per block
+CHUNK = 4 * 1024 * 1024
+
+_buffers = threading.local()
+
+
+def _buffer():
+    view = getattr(_buffers, 'view', None)
+    if view is None:
+        view = _buffers.view = memoryview(bytearray(CHUNK))
+    return view
+
+
+# Manifests are named as in BagIt, e.g. manifest-sha256.txt
+def manifest_name(algorithm):
+    return "manifest-{0}.txt".format(algorithm)
+
+
+def is_manifest(name):
+    return name in set(manifest_name(a) for a in ALGORITHMS)
+
+
+# Returns the (algorithm, path) of the manifest in out, or None if there is none
+def find_manifest(out):
+    for algorithm in ALGORITHMS:
+        path = os.path.join(out, manifest_name(algorithm))
+        if os.path.isfile(path):
+            return algorithm, path
+    return None
+
+
+# Copies src to dst like shutil.copy2, hashing the data on the way so it is read only once
+# Returns the hex digest
+def copy_hashed(src, dst, algorithm):
+    digest = hashlib.new(algorithm)
+    view = _buffer()
+    with open(src, 'rb', buffering=0) as s, open(dst, 'wb', buffering=0) as d:
+        while True:
+            n = s.readinto(view)
+            if not n:
+                break
+            block = view[:n]
+            digest.update(block)
+            while block:
+                block = block[d.write(block):]
+
+    shutil.copystat(src, dst)
+    return digest.hexdigest()
+
+
+def hash_file(path, algorithm):
+    digest = hashlib.new(algorithm)
+    view = _buffer()
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+# BagIt escapes these characters in manifest paths
+def _encode(name):
+    return name.replace("%", "%25").replace("\n", "%0A").replace("\r", "%0D")
+
+
+def _decode(name):
+    return name.replace("%0A", "\n").replace("%0D", "\r").replace("%25", "%")
+
+
+# Writes the manifest of out from {file name: digest}, one "digest  name" line per file
+# The lines can also be checked with sha256sum -c and similar tools
+def write_manifest(out, algorithm, digests):
+    path = os.path.join(out, manifest_name(algorithm))
+    temp = path + ".tmp"
+    with open(temp, 'w', encoding='utf-8', newline='\n') as f:
+        for name in sorted(digests):
+            f.write("{0}  {1}\n".format(digests[name], _encode(name)))
+    os.replace(temp, path)
+
+    # Only one manifest is kept, so a different algorithm never leaves a stale one behind
+    for other in ALGORITHMS:
+        if other != algorithm and os.path.exists(os.path.join(out, manifest_name(other))):
+            os.remove(os.path.join(out, manifest_name(other)))
+    return path
+
+
+# Returns {file name: digest}
+def read_manifest(path):
+    digests = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line:
+                digest, name = line.split(None, 1)
+                digests[_decode(name.lstrip("*"))] = digest.lower()
+    return digests
+
+
+# Checks one file of a manifest, returns None if it matches or the problem
+def _check(path, algorithm, digest):
+    try:
+        with stats.timer('verify.hash'):
+            actual = hash_file(path, algorithm)
+    except FileNotFoundError:
+        return "missing"
+    except OSError as err:
+        return "can't be read ({0})".format(err.strerror)
+    return None if actual == digest else "changed"
+
+
+# Checks every file listed in the manifest of out, hashing them with a pool of worker threads
+# Returns a list of (file name, problem), empty if the folder is intact. Raises OSError if out has no manifest
+def verify_folder(out, progress=reporting.ConsoleProgress, workers=4):
+    found = find_manifest(out)
+    if found is None:
+        raise OSError("No manifest in {0}".format(out))
+    algorithm, path = found
+    names = sorted(read_manifest(path).items())
+
+    # Files that were added to the folder after the manifest was written
+    problems = []
+    listed = set(name for name, digest in names)
+    for entry in sorted(os.listdir(out)):
+        if entry not in listed and not is_manifest(entry) and not entry.startswith(".") and os.path.isfile(os.path.join(out, entry)):
+            problems.append((entry, "not in the manifest"))
+
+    progress = progress("Verifying " + os.path.basename(path), len(names))
+    batch = reporting.Batcher(progress)
+
+    def check(i):
+        name, digest = names[i]
+        return executor.submit(_check, os.path.join(out, name), algorithm, digest)
+
+    def finish(i, problem):
+        name = names[i][0]
+        if problem is None:
+            batch.next("OK {0}".format(name))
+        else:
+            problems.append((name, problem))
+            batch.next("FAILED {0}: {1}".format(name, problem))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            complete = reporting.run_in_order(len(names), check, finish, progress, batch, workers * 2)
+        if not complete:
+            raise reporting.Cancelled()
+
+        if problems:
+            progress.log_message("Checked {0} files, {1} problems found".format(len(names), len(problems)))
+        else:
+            progress.log_message("All {0} files match the manifest".format(len(names)))
+    finally:
+        progress.destroy()
+
+    return problems
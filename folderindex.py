@@ -0,0 +1,119 @@
+import array
+import hashlib
+import json
+import os
+import re
+
+import cache
+
+
+def natural_key(name):
+    '''Sort key that orders "img_9" before "img_10"'''
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+class FolderIndex:
+    '''The files in a folder, listed with a single os.scandir pass and kept in compact arrays
+
+    The index is saved in the user's cache folder, never in the folder itself or next to it,
+    which may be read only or shared. Opening the folder again reuses the saved names without
+    listing the folder if the folder has not changed. A file rewritten in place changes neither
+    the folder nor its inode, so the sizes and mtimes of a saved index are only what they were
+    when it was listed, and verified is False. They must not be used as cache keys.
+    '''
+    __slots__ = ('path', 'folder_mtime', 'names', 'sizes', 'mtimes', 'verified')
+
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.folder_mtime = 0
+        self.names = []
+        self.sizes = array.array('q')
+        self.mtimes = array.array('q')
+        self.verified = True
+
+    def __len__(self):
+        return len(self.names)
+
+    # Yields (path, size, mtime_ns) for every file, in natural order
+    def __iter__(self):
+        for i, name in enumerate(self.names):
+            yield os.path.join(self.path, name), self.sizes[i], self.mtimes[i]
+
+    @staticmethod
+    def index_path(path):
+        path = os.path.abspath(path)
+        name = hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(cache.user_directory(), "indexes", name + ".json")
+
+    @classmethod
+    def load(cls, path, persist=True):
+        folder_mtime = os.stat(path).st_mtime_ns
+
+        saved = cls.read(path)
+        if saved is not None and saved.folder_mtime == folder_mtime:
+            return saved
+
+        index = cls.scan(path)
+        index.folder_mtime = folder_mtime
+        if persist:
+            index.save()
+        return index
+
+    # Lists the folder. Every entry is stat'ed, as neither the folder mtime nor the inode
+    # changes when a file is rewritten in place (on Windows entry.stat() is free anyway)
+    @classmethod
+    def scan(cls, path):
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Removed since it was listed
+                    continue
+                entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+
+        entries.sort(key=lambda e: natural_key(e[0]))
+
+        index = cls(path)
+        for name, size, mtime in entries:
+            index.names.append(name)
+            index.sizes.append(size)
+            index.mtimes.append(mtime)
+        return index
+
+    @classmethod
+    def read(cls, path):
+        try:
+            with open(cls.index_path(path)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get('version') != cls.version or data.get('path') != os.path.abspath(path):
+            return None
+
+        index = cls(path)
+        index.folder_mtime = data['folder_mtime']
+        index.names = data['names']
+        index.sizes = array.array('q', data['sizes'])
+        index.mtimes = array.array('q', data['mtimes'])
+        index.verified = False
+        return index
+
+    # Saving is best effort, e.g. the cache folder may not be writable
+    def save(self):
+        data = {'version': FolderIndex.version, 'path': os.path.abspath(self.path), 'folder_mtime': self.folder_mtime,
+                'names': self.names, 'sizes': self.sizes.tolist(), 'mtimes': self.mtimes.tolist()}
+        target = FolderIndex.index_path(self.path)
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target + ".tmp", 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(target + ".tmp", target)
+        except OSError as err:
+            print("Error Saving Folder Index: {0}".format(err))
@@ -0,0 +1,91 @@
+import os
+import queue
+import threading
+import time
+
+import stats
+import utils
+
+
+class PageLoader:
+    '''Creates page thumbnails on request in a process pool and streams them back through a queue
+
+    Requests are served newest first, so the pages in view are made before the ones that
+    were scrolled past. Results are put on the queue as (page, data) tuples, where data is
+    None if the image could not be loaded.
+    '''
+    def __init__(self, size, workers=None):
+        self.size = size
+        self.workers = workers or os.cpu_count() or 1
+        self.requests = queue.LifoQueue()
+        self.results = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        # Bounds the number of images being decoded or waiting for a worker
+        self.slots = threading.Semaphore(self.workers * 2)
+        self.executor = None
+        self.thread = None
+
+    def request(self, page):
+        with self.lock:
+            if page in self.pending:
+                return
+            self.pending.add(page)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+        self.requests.put(page)
+
+    # Drop the requests for pages that are no longer needed, e.g. when another folder is picked
+    def cancel(self, pages):
+        with self.lock:
+            self.pending.difference_update(pages)
+
+    def busy(self):
+        with self.lock:
+            return bool(self.pending)
+
+    def run(self):
+        while True:
+            page = self.requests.get()
+            with self.lock:
+                if page not in self.pending:
+                    continue
+
+            with stats.timer('cache.get'):
+                data = utils.thumbnail_cache.get(page.path, self.size, stat=page.stat())
+            if data is not None:
+                self.finish(page, data)
+                continue
+
+            self.slots.acquire()
+            # Only start the worker processes once a thumbnail actually needs decoding
+            if self.executor is None:
+                # Imported here as multiprocessing is slow to import at startup
+                from concurrent.futures import ProcessPoolExecutor
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            future = self.executor.submit(utils.load_thumbnail_data, page.path, self.size)
+            future.add_done_callback(lambda f, page=page, start=time.perf_counter(): self.decoded(page, f, start))
+
+    def decoded(self, page, future, start):
+        self.slots.release()
+        # Includes the time spent waiting for a worker
+        stats.recorder.add('loader.worker', start, time.perf_counter() - start)
+        try:
+            data, timings = future.result()
+            stats.recorder.merge(timings)
+        except Exception as err:
+            print("Error Loading Image: {0}".format(err))
+            data = None
+
+        if data is not None:
+            with stats.timer('cache.put'):
+                utils.thumbnail_cache.put(page.path, self.size, data, page.stat())
+        self.finish(page, data)
+
+    def finish(self, page, data):
+        with self.lock:
+            self.pending.discard(page)
+        self.results.put((page, data))
@@ -0,0 +1,289 @@
+import collections
+import random
+
+import utils
+
+
+class _Node:
+    '''A treap node. Nodes are never changed once a sequence uses them, so sequences share them
+
+    size is the number of entries in the subtree, and pages the number of pages in them
+    with groups counted by their pages. count is the number of pages in item.
+    '''
+    __slots__ = ('item', 'priority', 'left', 'right', 'size', 'count', 'pages')
+
+    def __init__(self, item, priority, left=None, right=None, count=None):
+        self.item = item
+        self.priority = priority
+        self.left = left
+        self.right = right
+        self.count = _count(item) if count is None else count
+        self.size = _size(left) + 1 + _size(right)
+        self.pages = _pages(left) + self.count + _pages(right)
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _pages(node):
+    return node.pages if node is not None else 0
+
+
+def _count(item):
+    if type(item) is utils.PageGroup:
+        return sum(1 for _ in flatten(item.pages))
+    return 1
+
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        return _Node(a.item, a.priority, a.left, _merge(a.right, b), a.count)
+    return _Node(b.item, b.priority, _merge(a, b.left), b.right, b.count)
+
+
+# Returns (the first k entries, the rest)
+def _split(node, k):
+    if node is None:
+        return None, None
+    if _size(node.left) >= k:
+        a, b = _split(node.left, k)
+        return a, _Node(node.item, node.priority, b, node.right, node.count)
+    a, b = _split(node.right, k - _size(node.left) - 1)
+    return _Node(node.item, node.priority, node.left, a, node.count), b
+
+
+# Builds a treap in linear time, keeping a stack of the rightmost path
+def _build(items):
+    stack = []
+    for item in items:
+        node = _Node(item, random.random())
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+
+    if not stack:
+        return None
+    _fix_sizes(stack[0])
+    return stack[0]
+
+
+def _fix_sizes(node):
+    if node is None:
+        return
+    _fix_sizes(node.left)
+    _fix_sizes(node.right)
+    node.size = _size(node.left) + 1 + _size(node.right)
+    node.pages = _pages(node.left) + node.count + _pages(node.right)
+
+
+class PageSequence:
+    '''An immutable sequence of pages and page groups, stored as a persistent treap
+
+    Indexing, slicing, counting pages, insert, delete, group, ungroup and move take O(log n)
+    time, plus the pages being grouped or ungrouped, and return a new sequence. The unchanged parts of the
+    tree are shared, so keeping old sequences for undo is cheap.
+    '''
+    __slots__ = ('root',)
+
+    def __init__(self, items=()):
+        self.root = _build(items)
+
+    @staticmethod
+    def _wrap(root):
+        sequence = PageSequence()
+        sequence.root = root
+        return sequence
+
+    def __len__(self):
+        return _size(self.root)
+
+    # Returns the number of pages in the entries before stop, all of them if stop is None, in O(log n) time
+    def page_count(self, stop=None):
+        if stop is None or stop >= len(self):
+            return _pages(self.root)
+
+        total = 0
+        node = self.root
+        while node is not None:
+            left = _size(node.left)
+            if stop <= left:
+                node = node.left
+            else:
+                total += _pages(node.left) + node.count
+                stop -= left + 1
+                node = node.right
+        return total
+
+    def __iter__(self):
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.item
+            node = node.right
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return self._wrap(self._range(start, max(start, stop))[1])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("PageSequence index out of range")
+
+        node = self.root
+        while True:
+            left = _size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node.item
+            else:
+                index -= left + 1
+                node = node.right
+
+    def __repr__(self):
+        return "PageSequence({0!r})".format(list(self))
+
+    # Returns the (before, range, after) trees of entries start to stop
+    def _range(self, start, stop):
+        head, rest = _split(self.root, start)
+        middle, tail = _split(rest, stop - start)
+        return head, middle, tail
+
+    def insert(self, index, item):
+        head, tail = _split(self.root, index)
+        return self._wrap(_merge(_merge(head, _Node(item, random.random())), tail))
+
+    def delete(self, start, stop=None):
+        head, middle, tail = self._range(start, start + 1 if stop is None else stop)
+        return self._wrap(_merge(head, tail))
+
+    def replace(self, index, item):
+        head, middle, tail = self._range(index, index + 1)
+        return self._wrap(_merge(_merge(head, _Node(item, random.random())), tail))
+
+    # Replaces the entries from start to stop with one group of them
+    # Groups among them are kept whole inside the new group, so ungrouping it gives them back
+    def group(self, start, stop):
+        head, middle, tail = self._range(start, stop)
+        entries = list(self._wrap(middle))
+        return self._wrap(_merge(_merge(head, _Node(utils.PageGroup(entries), random.random())), tail))
+
+    # Replaces the group at index with its entries
+    def ungroup(self, index):
+        head, middle, tail = self._range(index, index + 1)
+        if middle is None or type(middle.item) is not utils.PageGroup:
+            return self
+        return self._wrap(_merge(_merge(head, _build(middle.item.pages)), tail))
+
+    # Returns (the sequence without pages, the index of the first entry that changed or len(self))
+    # Groups that lose some of their pages are replaced by new groups, and left out if they lose them all.
+    # The entries that don't change are shared with this sequence.
+    def remove(self, pages):
+        hits = [i for i, entry in enumerate(self) if any(p in pages for p in flatten([entry]))]
+
+        result = self
+        for i in reversed(hits):
+            kept = _without(self[i], pages)
+            result = result.delete(i) if kept is None else result.replace(i, kept)
+        return result, hits[0] if hits else len(self)
+
+    # Moves the entries from start to stop so the first of them is at index to afterwards
+    def move(self, start, stop, to):
+        head, middle, tail = self._range(start, stop)
+        rest = _merge(head, tail)
+        head, tail = _split(rest, to)
+        return self._wrap(_merge(_merge(head, middle), tail))
+
+
+# Yields the pages of entries in order, with groups (and groups in groups) replaced by their pages
+def flatten(entries):
+    for entry in entries:
+        if type(entry) is utils.PageGroup:
+            yield from flatten(entry.pages)
+        else:
+            yield entry
+
+
+# Returns entry without pages, or None if nothing is left of it
+def _without(entry, pages):
+    if type(entry) is not utils.PageGroup:
+        return None if entry in pages else entry
+
+    kept = [e for e in (_without(e, pages) for e in entry.pages) if e is not None]
+    return utils.PageGroup(kept) if kept else None
+
+
+class History:
+    '''Undo and redo for a PageSequence
+
+    Each step keeps the sequence from before a change and the index of the first entry the
+    change affected. Sequences share their unchanged parts, so a step costs almost nothing.
+    Pages added or removed outside of undo are added to or removed from every step.
+    '''
+
+    # Steps kept for undo
+    limit = 100
+
+    def __init__(self):
+        self.undo_steps = collections.deque(maxlen=History.limit)
+        self.redo_steps = []
+
+    # Call before changing pages, start is the first entry that will change
+    def push(self, pages, start):
+        self.undo_steps.append((pages, start))
+        self.redo_steps = []
+
+    # Returns (sequence, start) to show, or None if there is nothing to undo
+    def undo(self, pages):
+        if not self.undo_steps:
+            return None
+        previous, start = self.undo_steps.pop()
+        self.redo_steps.append((pages, start))
+        return previous, start
+
+    def redo(self, pages):
+        if not self.redo_steps:
+            return None
+        following, start = self.redo_steps.pop()
+        self.undo_steps.append((pages, start))
+        return following, start
+
+    # Pages added while watching a folder are added to every step too, so undo never drops them
+    # index is a function returning where page belongs in a sequence
+    def insert(self, page, index):
+        def adjust(pages, start):
+            i = index(pages)
+            return pages.insert(i, page), min(start, i)
+        self._adjust(adjust)
+
+    # Pages removed from the folder are removed from every step, so undo never brings them back
+    def remove(self, pages):
+        def adjust(sequence, start):
+            sequence, first = sequence.remove(pages)
+            return sequence, min(start, first)
+        self._adjust(adjust)
+
+    def _adjust(self, adjust):
+        self.undo_steps = collections.deque((adjust(*step) for step in self.undo_steps), maxlen=History.limit)
+        self.redo_steps = [adjust(*step) for step in self.redo_steps]
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps = []
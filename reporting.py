@@ -0,0 +1,147 @@
+import sys
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+class Cancelled(Exception):
+    '''Raised by a job that stopped at a checkpoint because its progress was cancelled'''
+
+
+# Jobs check this between steps, and stop at the next point they can be resumed from
+def cancelled(progress):
+    return getattr(progress, 'cancelled', False)
+
+
+class ConsoleProgress:
+    '''Reports progress on the terminal, with the same interface as widgets.ProgressPopup'''
+
+    # Seconds between redraws of the progress line
+    interval = 0.1
+
+    # Set on the class by the command line when Ctrl+C is pressed
+    cancelled = False
+
+    def __init__(self, title, steps=100, verbose=False):
+        self.title = title
+        self.steps = steps
+        self.done = 0
+        self.verbose = verbose
+        self.last_draw = 0.0
+
+    def next(self, count=1):
+        self.done += count
+
+        now = time.perf_counter()
+        if now - self.last_draw >= ConsoleProgress.interval or self.done >= self.steps:
+            self.last_draw = now
+            self.draw()
+
+    def draw(self):
+        percent = 100.0 * self.done / self.steps if self.steps else 100.0
+        sys.stderr.write("\r{0}: {1}/{2} ({3:.0f}%)".format(self.title, self.done, self.steps, percent))
+        sys.stderr.flush()
+
+    def log_message(self, line):
+        self.log_messages([line])
+
+    def log_messages(self, lines):
+        if self.verbose and lines:
+            for line in lines:
+                sys.stderr.write("\r\033[K{0}\n".format(line))
+            self.draw()
+
+    def destroy(self):
+        self.draw()
+        sys.stderr.write("\n")
+
+
+class NullProgress:
+    '''Reports nothing, for benchmarks and other runs where progress output would only add noise'''
+
+    cancelled = False
+
+    def __init__(self, title, steps=100):
+        self.title = title
+        self.steps = steps
+        self.done = 0
+
+    def next(self, count=1):
+        self.done += count
+
+    def log_message(self, line):
+        pass
+
+    def log_messages(self, lines):
+        pass
+
+    def destroy(self):
+        pass
+
+
+class Batcher:
+    '''Coalesces progress steps and log lines so the progress display is redrawn at a fixed rate'''
+    def __init__(self, progress, rate=10):
+        self.progress = progress
+        self.interval = 1.0 / rate
+        self.steps = 0
+        self.lines = []
+        self.last_flush = time.perf_counter()
+
+    def next(self, line=None):
+        self.steps += 1
+        if line is not None:
+            self.lines.append(line)
+        self.tick()
+
+    # Flushes if enough time has passed, call this while waiting too
+    def tick(self):
+        if time.perf_counter() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.steps:
+            self.progress.next(self.steps)
+        if self.lines:
+            self.progress.log_messages(self.lines)
+        elif not self.steps and hasattr(self.progress, 'tick'):
+            # Lets a progress window handle events such as Cancel while nothing is reported
+            self.progress.tick()
+
+        self.steps = 0
+        self.lines = []
+        self.last_flush = time.perf_counter()
+
+
+# Runs count jobs on a pool, at most limit at a time, and calls finish(i, result) for each job in job order
+# submit(i) starts job i and returns its future. admit(i, in_flight), if given, returns False to hold job i
+# back until some of the jobs in flight (their indexes) are done. Results and waits are reported through batch,
+# a Batcher of progress. When progress is cancelled, the jobs in flight are finished before stopping
+# Returns True if every job finished, False if it stopped early
+def run_in_order(count, submit, finish, progress, batch, limit, admit=None):
+    pending = {}
+    results = {}
+    submitted = 0
+    finished = 0
+    stopping = False
+
+    while finished < submitted or (finished < count and not stopping):
+        stopping = stopping or cancelled(progress)
+        while not stopping and submitted < count and len(pending) < limit:
+            if pending and admit is not None and not admit(submitted, pending.values()):
+                break
+            pending[submit(submitted)] = submitted
+            submitted += 1
+
+        done, _ = wait(pending, timeout=batch.interval, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[pending.pop(future)] = future.result()
+
+        # Jobs are finished in order, once every job before them is done
+        while finished in results:
+            finish(finished, results.pop(finished))
+            finished += 1
+
+        batch.tick()
+
+    batch.flush()
+    return finished == count
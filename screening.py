@@ -0,0 +1,223 @@
+import collections
+import io
+import os
+
+import reporting
+import stats
+import utils
+
+
+# The hash compares neighbouring pixels of the thumbnail shrunk to HASH_SIZE + 1 by HASH_SIZE, giving HASH_SIZE ** 2 bits
+HASH_SIZE = 16
+
+# Pages with less edge detail than this, as the mean of the edge filter from 0 to 255, are blank
+BLANK_EDGES = 2.0
+
+# Neighbouring thumbnail pixels closer than this, from 0 to 255, count as the same so noise in flat areas doesn't flip bits
+HASH_DEADBAND = 2
+
+# Pages compared with every page this close before them, to catch a page shot again after it moved
+NEIGHBOURS = 4
+
+# A page whose hash differs in at most this many bits from one of its NEIGHBOURS is the same capture
+DUPLICATE_BITS = 56
+
+# The hash is indexed in this many chunks. Two hashes that differ in fewer bits than there are chunks
+# have at least one chunk in common, so HashIndex always finds them
+CHUNKS = 16
+
+# A page further back is the same capture only if its hash differs in fewer bits than there are chunks,
+# which covers a page shot twice without moving. A search radius of DUPLICATE_BITS can't be indexed:
+# different pages are only 80 to 125 bits apart, so even a BK-tree would compare every page
+DISTANT_BITS = CHUNKS - 1
+
+# Pages sent to a worker process at once, so each round trip does a useful amount of work
+# but a batch of pages without cached thumbnails still finishes soon after Cancel
+BATCH = 16
+
+BLANK = "Blank?"
+
+# Features of the pages screened so far, by (path, (size, mtime_ns))
+_known = {}
+
+
+class Features:
+    '''The perceptual hash of a page thumbnail, and how much edge detail it has'''
+    __slots__ = ('hash', 'edges')
+
+    def __init__(self, hash, edges):
+        self.hash = hash
+        self.edges = edges
+
+    def blank(self):
+        return self.edges < BLANK_EDGES
+
+
+# Returns the Features of thumbnail data from utils.make_thumbnail_data
+# All pixel work is done by PIL on whole images, nothing loops over pixels in Python
+def thumbnail_features(data):
+    from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+    with Image.open(io.BytesIO(data)) as image:
+        grey = image.convert('L')
+
+    # The page edges and the shadow of the binding are not part of the page
+    width, height = grey.size
+    margin = int(min(width, height) * 0.05)
+    grey = grey.crop((margin, margin, width - margin, height - margin))
+
+    # Text and pictures have edges, blank paper and empty frames only have noise and shading
+    edges = grey.filter(ImageFilter.FIND_EDGES).crop((1, 1, grey.width - 1, grey.height - 1))
+
+    # A difference hash: one bit for each pixel that is more than HASH_DEADBAND darker than the pixel to its right
+    small = grey.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX)
+    right, left = small.crop((1, 0, HASH_SIZE + 1, HASH_SIZE)), small.crop((0, 0, HASH_SIZE, HASH_SIZE))
+    brighter = ImageChops.subtract(right, left, 1.0, -HASH_DEADBAND).point(lambda v: 255 if v else 0)
+
+    # Each row of the hash is a diagonal of the image, so each chunk HashIndex files a page under covers
+    # every row and column, rather than a strip of margin that most pages have empty
+    for y in range(HASH_SIZE):
+        row = brighter.crop((0, y, HASH_SIZE, y + 1))
+        brighter.paste(ImageChops.offset(row, -y, 0), (0, y))
+    bits = brighter.transpose(Image.TRANSPOSE).convert('1').tobytes()
+
+    return Features(int.from_bytes(bits, 'big'), ImageStat.Stat(edges).mean[0])
+
+
+# Runs in worker processes. Returns (features or None for each (path, stat), timings)
+# Thumbnails come from the thumbnail cache, and missing ones are made and cached so the viewers can use them
+def batch_features(items, size):
+    recorder = stats.Recorder()
+    found = []
+    for path, stat in items:
+        data = utils.thumbnail_cache.get(path, size, count=False, stat=stat)
+        if data is None:
+            try:
+                data = utils.make_thumbnail_data(path, size, recorder=recorder)
+            except OSError:
+                found.append(None)
+                continue
+            utils.thumbnail_cache.put(path, size, data, stat)
+
+        with recorder.timer('screening.features'):
+            found.append(thumbnail_features(data))
+    return found, recorder.drain()
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HashIndex:
+    '''Finds earlier hashes that match a hash, without comparing every pair
+
+    The last NEIGHBOURS hashes added match within DUPLICATE_BITS, and are always compared.
+    Earlier hashes match within DISTANT_BITS. Each hash is split into CHUNKS chunks and filed
+    under each of them, and only the hashes that share a chunk with the query are compared,
+    which finds every earlier hash within DISTANT_BITS.
+    '''
+    def __init__(self):
+        bits = HASH_SIZE * HASH_SIZE
+        self.width = bits // CHUNKS
+        self.mask = (1 << self.width) - 1
+        self.tables = [{} for _ in range(CHUNKS)]
+        self.recent = collections.deque(maxlen=NEIGHBOURS)
+
+    def _chunks(self, value):
+        return [(value >> (i * self.width)) & self.mask for i in range(CHUNKS)]
+
+    def add(self, value, item):
+        entry = (value, item)
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            table.setdefault(chunk, []).append(entry)
+        self.recent.append(entry)
+
+    # Returns (distance, item) for each item that matches value
+    def search(self, value):
+        found = {}
+        for entry in self.recent:
+            distance = hamming(value, entry[0])
+            if distance <= DUPLICATE_BITS:
+                found[id(entry)] = (distance, entry[1])
+
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            for entry in table.get(chunk, ()):
+                if id(entry) not in found:
+                    distance = hamming(value, entry[0])
+                    if distance <= DISTANT_BITS:
+                        found[id(entry)] = (distance, entry[1])
+        return list(found.values())
+
+
+# The file is always stat'ed, as a page's own stat may be from before the file was shot again
+def _key(page):
+    try:
+        result = os.stat(page.path)
+        return page.path, (result.st_size, result.st_mtime_ns)
+    except OSError:
+        return page.path, None
+
+
+# Finds blank pages and double captures among pages, in book order, with workers processes
+# Returns {page: reason} for the pages that should be looked at. Raises reporting.Cancelled if progress is cancelled
+# Waiting for the workers never blocks for long, so a progress window stays responsive
+def screen_pages(pages, progress=reporting.ConsoleProgress, workers=None):
+    size = utils.Page.size
+    keys = {page: _key(page) for page in pages}
+    todo = [p for p in pages if keys[p] not in _known]
+    progress = progress("Checking Pages", len(pages))
+    progress.next(len(pages) - len(todo))
+
+    try:
+        if todo:
+            # Imported here as multiprocessing is slow to import at startup
+            from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+            batcher = reporting.Batcher(progress)
+            with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+                pending = {}
+                for i in range(0, len(todo), BATCH):
+                    batch = todo[i:i + BATCH]
+                    pending[executor.submit(batch_features, [keys[p] for p in batch], size)] = batch
+
+                while pending:
+                    if reporting.cancelled(progress):
+                        for future in pending:
+                            future.cancel()
+                        raise reporting.Cancelled()
+
+                    done, _ = wait(pending, timeout=batcher.interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch = pending.pop(future)
+                        found, timings = future.result()
+                        stats.recorder.merge(timings)
+                        for page, features in zip(batch, found):
+                            if features is not None:
+                                _known[keys[page]] = features
+                            batcher.next()
+                    batcher.tick()
+            batcher.flush()
+
+        with stats.timer('screening.compare'):
+            flags = {}
+            index = HashIndex()
+            for page in pages:
+                features = _known.get(keys[page])
+                if features is None:
+                    continue
+                if features.blank():
+                    flags[page] = BLANK
+                    continue
+
+                # Each page is only compared with the pages before it, so a double capture names the first shot
+                matches = index.search(features.hash)
+                if matches:
+                    flags[page] = "Same as {0}?".format(min(matches, key=lambda m: m[0])[1].name)
+                index.add(features.hash, page)
+
+        blank = sum(1 for reason in flags.values() if reason == BLANK)
+        progress.log_message("{0} blank pages and {1} double captures found".format(blank, len(flags) - blank))
+    finally:
+        progress.destroy()
+
+    return flags
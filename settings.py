@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+
+
+DEFAULTS = {
+    # Hours between checks for a new release. 0 checks on every start
+    'update_check_interval_hours': 24,
+    # Seconds to wait for the release server before giving up
+    'update_timeout': 3,
+    'update_url': "https://api.github.com/repos/natecraddock/page-zipper/releases/latest",
+    # Memory used for the thumbnails shown in the viewers
+    'thumbnail_memory_mb': 256,
+}
+
+
+def data_dir():
+    '''Returns the per-user folder Page Zipper keeps its settings and state in'''
+    if os.environ.get("PAGE_ZIPPER_HOME"):
+        return os.environ["PAGE_ZIPPER_HOME"]
+
+    if sys.platform == "win32":
+        base = os.environ.get("APPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CONFIG_HOME", os.path.join(os.path.expanduser("~"), ".config"))
+
+    return os.path.join(base, "page-zipper")
+
+
+def settings_path():
+    return os.path.join(data_dir(), "settings.json")
+
+
+# Returns the settings, with defaults for anything not in settings.json
+def load():
+    values = dict(DEFAULTS)
+    try:
+        with open(settings_path()) as f:
+            values.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+    # Lets the update check run against a local stand-in server
+    if os.environ.get("PAGE_ZIPPER_UPDATE_URL"):
+        values['update_url'] = os.environ["PAGE_ZIPPER_UPDATE_URL"]
+
+    return values
+
+
+def read_state(name):
+    try:
+        with open(os.path.join(data_dir(), name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(name, state):
+    try:
+        os.makedirs(data_dir(), exist_ok=True)
+        with open(os.path.join(data_dir(), name), 'w') as f:
+            json.dump(state, f)
+    except OSError as err:
+        print("Error Saving {0}: {1}".format(name, err))
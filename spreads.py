@@ -0,0 +1,129 @@
+import collections
+import os
+import shutil
+
+import reporting
+import stats
+import utils
+import zipper
+
+
+# Vertical placement of pages that are shorter than the other page of their spread
+ALIGNMENTS = collections.OrderedDict([
+    ('top', "Top"),
+    ('center', "Center"),
+    ('bottom', "Bottom"),
+])
+
+# Bytes of decoded images all the spreads being joined at once may hold, so 100 megapixel captures
+# are joined one or two at a time instead of one per worker
+MEMORY_BUDGET = 1024 * 1024 * 1024
+
+# Save options for the spread image, by the extension of its first page
+SAVE_OPTIONS = {
+    '.jpg': ('JPEG', {'quality': 95}),
+    '.jpeg': ('JPEG', {'quality': 95}),
+    '.png': ('PNG', {}),
+    '.tif': ('TIFF', {'compression': 'tiff_adobe_deflate'}),
+    '.tiff': ('TIFF', {'compression': 'tiff_adobe_deflate'}),
+}
+
+
+# Splits pages in book order into spreads of facing pages, the earlier page on the left
+# The cover faces nothing, so it is a spread of its own unless cover_alone is False
+def pair_pages(pages, cover_alone=True):
+    spreads = []
+    start = 0
+    if cover_alone and pages:
+        spreads.append(pages[:1])
+        start = 1
+
+    for i in range(start, len(pages), 2):
+        spreads.append(pages[i:i + 2])
+    return spreads
+
+
+# Returns the extension of the file a spread is saved as
+def spread_extension(paths):
+    ext = os.path.splitext(paths[0])[1].lower()
+    if len(paths) == 1 or ext in SAVE_OPTIONS:
+        return ext
+    return '.png'
+
+
+# The bytes of memory stitch needs for a spread: the spread, and a decoded page with its copy in the
+# spread's mode, at 4 bytes a pixel as PIL stores RGB. Only the image headers are read
+def stitch_memory(paths, target, gap=0, align='center'):
+    from PIL import Image
+
+    if len(paths) == 1:
+        return 0
+
+    sizes = []
+    for path in paths:
+        try:
+            with Image.open(path) as image:
+                sizes.append(image.size)
+        except OSError:
+            # stitch reports the error
+            return 0
+    width = sum(w for w, h in sizes) + gap * (len(paths) - 1)
+    height = max(h for w, h in sizes)
+    return 4 * (width * height + 2 * max(w * h for w, h in sizes))
+
+
+# Runs in worker processes. Pages are pasted into the spread one at a time and closed as soon
+# as they are copied, so a worker holds at most the spread and one decoded page
+def stitch(paths, target, gap=0, align='center'):
+    from PIL import Image
+
+    # A page without a facing page is copied unchanged
+    if len(paths) == 1:
+        shutil.copy2(paths[0], target)
+        return target
+
+    sizes = []
+    grey = True
+    for path in paths:
+        with Image.open(path) as image:
+            if not sizes:
+                info = image.info
+            sizes.append(image.size)
+            grey = grey and (image.mode in ('1', 'L') or utils.is_16_bit_grey(image.mode))
+
+    mode = 'L' if grey else 'RGB'
+    height = max(h for w, h in sizes)
+    spread = Image.new(mode, (sum(w for w, h in sizes) + gap * (len(paths) - 1), height), 'white')
+
+    x = 0
+    for path, (w, h) in zip(paths, sizes):
+        with Image.open(path) as image:
+            image = utils.to_8_bits(image)
+            if image.mode != mode:
+                image = image.convert(mode)
+            y = {'top': 0, 'center': (height - h) // 2, 'bottom': height - h}[align]
+            spread.paste(image, (x, y))
+        x += w + gap
+
+    name, options = SAVE_OPTIONS[os.path.splitext(target)[1].lower()]
+    if 'dpi' in info:
+        options = dict(options, dpi=info['dpi'])
+    spread.save(target, name, **options)
+    return target
+
+
+# Saves a numbered image of each spread, joining the pages of a spread in a process pool
+# pages are in book order, as from zipper.ungroup(zipper.merge_lists(right, left)), so grouped pages stay in sequence
+def stitch_files(files, out, pre="img_", progress=reporting.ConsoleProgress, workers=4, cover_alone=True, gap=0, align='center'):
+    spreads = [[p.path for p in spread] for spread in pair_pages(files, cover_alone)]
+    jobs = []
+    for i, paths in enumerate(spreads):
+        target = os.path.join(out, zipper.output_name(i, "page" + spread_extension(paths), len(spreads), pre))
+        jobs.append(((paths, target, gap, align), "Joined {0} as {1}".format(" and ".join(paths), target)))
+
+    progress = progress("Saving Spreads", len(jobs))
+    try:
+        with stats.timer('stitch_files'):
+            zipper.process_files(jobs, stitch, progress, workers, stitch_memory, MEMORY_BUDGET)
+    finally:
+        progress.destroy()
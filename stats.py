@@ -0,0 +1,110 @@
+import collections
+import json
+import os
+import threading
+import time
+
+
+class Timer:
+    '''Times a with block and records it as one event'''
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.add(self.name, self.start, time.perf_counter() - self.start)
+
+
+class Recorder:
+    '''Collects per-stage timings and counters with little overhead
+
+    Each timing is added to a running total for its stage and kept as an event for the
+    trace export. Only the most recent events are kept, so recording can always be on.
+    Worker processes have their own recorder, whose events are sent back with drain and
+    added here with merge.
+    '''
+    def __init__(self, max_events=100000):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.counters = collections.Counter()
+        self.events = collections.deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    # start is a time.perf_counter() value, which is comparable between processes
+    def add(self, name, start, seconds, pid=None, tid=None):
+        with self.lock:
+            total = self.totals.get(name)
+            if total is None:
+                self.totals[name] = [1, seconds, seconds]
+            else:
+                total[0] += 1
+                total[1] += seconds
+                if seconds > total[2]:
+                    total[2] = seconds
+            self.events.append((name, start, seconds, pid or os.getpid(), tid or threading.get_ident()))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    # Returns and forgets the events and counters recorded so far, to send back from a worker
+    def drain(self):
+        with self.lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+            self.reset_locked()
+        return events, counters
+
+    def merge(self, drained):
+        events, counters = drained
+        for event in events:
+            self.add(*event)
+        with self.lock:
+            self.counters.update(counters)
+
+    def reset(self):
+        with self.lock:
+            self.reset_locked()
+
+    def reset_locked(self):
+        self.totals = {}
+        self.counters = collections.Counter()
+        self.events.clear()
+
+    # Returns (name, count, total seconds, mean seconds, max seconds) for each stage, by name
+    def summary(self):
+        with self.lock:
+            return [(name, count, total, total / count, longest) for name, (count, total, longest) in sorted(self.totals.items())]
+
+    def counter_values(self):
+        with self.lock:
+            return sorted(self.counters.items())
+
+    # Writes the events in the Chrome trace format, which chrome://tracing and Perfetto open
+    def export_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+
+        trace = [{'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': seconds * 1e6, 'pid': pid, 'tid': tid}
+                 for name, start, seconds, pid, tid in events]
+        end = (time.perf_counter() - self.origin) * 1e6
+        trace.extend({'name': name, 'ph': 'C', 'ts': end, 'pid': os.getpid(), 'args': {'value': value}}
+                     for name, value in counters.items())
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+recorder = Recorder()
+timer = recorder.timer
+count = recorder.count
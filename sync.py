@@ -0,0 +1,170 @@
+import os
+import uuid
+
+import fixity
+import reporting
+import utils
+import zipper
+
+
+class SyncPlan:
+    '''The changes that make an output folder hold exactly the planned pages'''
+    def __init__(self, out):
+        self.out = out
+        # {output name: (origin, size, mtime_ns)} of every planned page
+        self.origins = {}
+        self.keep = []
+        self.renames = []
+        self.deletes = []
+        self.writes = []
+
+    def changes(self):
+        return len(self.renames) + len(self.deletes) + len(self.writes)
+
+    # A dry run description of the plan, listing at most limit entries of each kind
+    def summary(self, limit=5):
+        lines = ["{0} files are already up to date".format(len(self.keep)),
+                 "{0} files will be written".format(len(self.writes)),
+                 "{0} files will be renamed".format(len(self.renames)),
+                 "{0} files will be deleted".format(len(self.deletes))]
+
+        for label, entries in (("Write", ["{0} -> {1}".format(s, n) for s, n in self.writes]),
+                               ("Rename", ["{0} -> {1}".format(o, n) for o, n in self.renames]),
+                               ("Delete", self.deletes)):
+            if entries:
+                lines.append("")
+                lines.extend("{0} {1}".format(label, e) for e in entries[:limit])
+                if len(entries) > limit:
+                    lines.append("... and {0} more".format(len(entries) - limit))
+
+        return "\n".join(lines)
+
+
+# Returns a SyncPlan comparing the numbered output names of files with what is in out
+# compare is 'stat' or 'hash'. With 'stat', a file only matches an original that zipper's source record
+# says it was saved from, with neither file changed since. Captures of the same size shot seconds apart
+# can't be told apart by their stats alone. 'hash' compares the size and SHA-256 of the contents.
+def plan_sync(files, out, pre="img_", compare='stat'):
+    plan = SyncPlan(out)
+    targets = [(zipper.output_name(i, f.path, len(files), pre), f.path) for i, f in enumerate(files)]
+
+    existing = {}
+    if os.path.isdir(out):
+        for entry in os.scandir(out):
+            if entry.is_file() and not utils.is_own_file(entry.name):
+                existing[entry.name] = entry.stat()
+
+    sources = zipper.read_sources(out) if compare == 'stat' else {}
+    hashes = {}
+
+    def content(path):
+        if path not in hashes:
+            hashes[path] = fixity.hash_file(path, 'sha256')
+        return hashes[path]
+
+    def same(origin, origin_stat, name):
+        stat = existing[name]
+        if origin_stat.st_size != stat.st_size:
+            return False
+        if compare == 'hash':
+            return content(origin) == content(os.path.join(out, name))
+        record = [os.path.abspath(origin), origin_stat.st_size, origin_stat.st_mtime_ns, stat.st_size, stat.st_mtime_ns]
+        return sources.get(name) == record
+
+    # Output files that are already right stay as they are
+    missing = []
+    keep = set()
+    for name, origin in targets:
+        origin_stat = os.stat(origin)
+        plan.origins[name] = (origin, origin_stat.st_size, origin_stat.st_mtime_ns)
+        if name in existing and same(origin, origin_stat, name):
+            plan.keep.append(name)
+            keep.add(name)
+        else:
+            missing.append((name, origin, origin_stat))
+
+    # A page that moved to another number is renamed instead of written again. Files are looked up
+    # by the original they were saved from, or by size and contents when comparing hashes
+    sizes = set(origin_stat.st_size for name, origin, origin_stat in missing)
+
+    def key(name, stat):
+        if compare == 'stat':
+            return sources[name][0] if name in sources else None
+        return stat.st_size, content(os.path.join(out, name)) if stat.st_size in sizes else None
+
+    unclaimed = {}
+    for name, stat in existing.items():
+        if name not in keep:
+            unclaimed.setdefault(key(name, stat), []).append(name)
+
+    for name, origin, origin_stat in missing:
+        if compare == 'stat':
+            candidates = unclaimed.get(os.path.abspath(origin), [])
+        else:
+            candidates = unclaimed.get((origin_stat.st_size, content(origin)), [])
+        match = next((c for c in candidates if os.path.splitext(c)[1] == os.path.splitext(name)[1] and same(origin, origin_stat, c)), None)
+        if match is not None:
+            candidates.remove(match)
+            plan.renames.append((match, name))
+        else:
+            plan.writes.append((origin, name))
+
+    # A file that is written again is replaced by the write, not deleted first
+    written = set(name for origin, name in plan.writes)
+    plan.deletes = sorted(name for names in unclaimed.values() for name in names if name not in written)
+    return plan
+
+
+# Carries out a plan. Renames go through temporary names so they never collide with each other
+# A manifest in out is kept up to date, and one is written with algorithm if given
+def apply_sync(plan, progress=reporting.ConsoleProgress, mode='copy', workers=4, algorithm=None):
+    progress = progress("Syncing Output", plan.changes())
+    batch = reporting.Batcher(progress)
+    out = plan.out
+    token = uuid.uuid4().hex[:8]
+
+    # Digests of the files that stay are taken from the old manifest, so they are not read again
+    found = fixity.find_manifest(out) if os.path.isdir(out) else None
+    listed = fixity.read_manifest(found[1]) if found else {}
+    algorithm = algorithm or (found[0] if found else None)
+    if found and found[0] != algorithm:
+        listed = {}
+
+    try:
+        os.makedirs(out, exist_ok=True)
+        # The outputs no longer follow the plan of an interrupted save, which would undo this sync if resumed
+        zipper.discard_save(out)
+
+        temps = []
+        for i, (old, new) in enumerate(plan.renames):
+            temp = "{0}-sync-{1}-{2}.tmp".format(utils.RESERVED_PREFIX, token, i)
+            os.rename(os.path.join(out, old), os.path.join(out, temp))
+            temps.append((temp, old, new))
+
+        for name in plan.deletes:
+            os.remove(os.path.join(out, name))
+            batch.next("Deleted {0}".format(name))
+
+        for temp, old, new in temps:
+            os.replace(os.path.join(out, temp), os.path.join(out, new))
+            batch.next("Renamed {0} to {1}".format(old, new))
+
+        batch.flush()
+        written = zipper.transfer_files([(origin, os.path.join(out, name)) for origin, name in plan.writes], progress, mode, workers, algorithm=algorithm)
+
+        sources = dict((name, zipper.source_record(origin, size, mtime, os.path.join(out, name)))
+                       for name, (origin, size, mtime) in plan.origins.items())
+        zipper.write_sources(out, sources)
+
+        if algorithm:
+            digests = dict((name, listed.get(name)) for name in plan.keep)
+            digests.update((new, listed.get(old)) for old, new in plan.renames)
+            for name, digest in digests.items():
+                if digest is None:
+                    digests[name] = fixity.hash_file(os.path.join(out, name), algorithm)
+            digests.update((os.path.basename(path), digest) for path, digest in written.items())
+            fixity.write_manifest(out, algorithm, digests)
+            progress.log_message("Updated {0}".format(fixity.manifest_name(algorithm)))
+        progress.log_message("Sync Completed")
+    finally:
+        progress.destroy()
@@ -0,0 +1,248 @@
+'''Checks PageSequence and History against plain lists doing the same changes
+
+Run with: python -m unittest discover tests
+'''
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pagesequence
+import utils
+import zipper
+from pagesequence import History, PageSequence
+
+
+# Returns entries as nested lists, with each group as the list of its entries
+def shape(entries):
+    return [shape(e.pages) if type(e) is utils.PageGroup else e for e in entries]
+
+
+# Returns the pages of nested lists in order
+def pages_of(entries):
+    return [p for e in entries for p in (pages_of(e) if type(e) is list else [e])]
+
+
+# Removes pages from nested lists the way PageSequence.remove does, dropping groups left empty
+def without(entries, pages):
+    kept = []
+    for e in entries:
+        if type(e) is list:
+            e = without(e, pages)
+            if e:
+                kept.append(e)
+        elif e not in pages:
+            kept.append(e)
+    return kept
+
+
+class PageSequenceTest(unittest.TestCase):
+    def assertSame(self, sequence, expected):
+        self.assertEqual(shape(sequence), expected)
+        self.assertEqual(len(sequence), len(expected))
+        self.assertEqual(list(pagesequence.flatten(sequence)), pages_of(expected))
+        for stop in range(len(expected) + 1):
+            self.assertEqual(sequence.page_count(stop), len(pages_of(expected[:stop])))
+        for i in range(-len(expected), len(expected)):
+            self.assertEqual(shape([sequence[i]]), [expected[i]])
+
+    def test_random_changes(self):
+        rng = random.Random(1)
+        for run in range(20):
+            expected = ["p{0}".format(i) for i in range(rng.randint(0, 30))]
+            sequence = PageSequence(expected)
+            # Earlier sequences are kept to check that later changes leave them as they were
+            kept = [(sequence, list(expected))]
+
+            for step in range(60):
+                n = len(expected)
+                action = rng.choice(['group', 'ungroup', 'move', 'insert', 'delete', 'slice'])
+                if action == 'group' and n:
+                    start = rng.randrange(n)
+                    stop = rng.randint(start + 1, n)
+                    sequence = sequence.group(start, stop)
+                    expected[start:stop] = [expected[start:stop]]
+                elif action == 'ungroup' and n:
+                    i = rng.randrange(n)
+                    sequence = sequence.ungroup(i)
+                    if type(expected[i]) is list:
+                        expected[i:i + 1] = expected[i]
+                elif action == 'move' and n:
+                    start = rng.randrange(n)
+                    stop = rng.randint(start, n)
+                    to = rng.randint(0, n - (stop - start))
+                    sequence = sequence.move(start, stop, to)
+                    rest = expected[:start] + expected[stop:]
+                    expected = rest[:to] + expected[start:stop] + rest[to:]
+                elif action == 'insert':
+                    i = rng.randint(0, n)
+                    page = "new{0}-{1}".format(run, step)
+                    sequence = sequence.insert(i, page)
+                    expected.insert(i, page)
+                elif action == 'delete' and n:
+                    start = rng.randrange(n)
+                    stop = rng.randint(start + 1, n)
+                    sequence = sequence.delete(start, stop)
+                    del expected[start:stop]
+                elif action == 'slice':
+                    start = rng.randint(0, n)
+                    stop = rng.randint(start, n)
+                    self.assertSame(sequence[start:stop], expected[start:stop])
+                    continue
+
+                self.assertSame(sequence, expected)
+                kept.append((sequence, list(expected)))
+
+            for old, old_expected in kept:
+                self.assertEqual(shape(old), old_expected)
+
+    def test_nested_groups(self):
+        sequence = PageSequence(["a", "b", "c", "d", "e"])
+        sequence = sequence.group(1, 3).group(0, 3)
+        self.assertSame(sequence, [["a", ["b", "c"], "d"], "e"])
+
+        # Ungrouping the outer group gives back the inner one whole
+        self.assertSame(sequence.ungroup(0), ["a", ["b", "c"], "d", "e"])
+        self.assertSame(sequence.ungroup(0).ungroup(1), ["a", "b", "c", "d", "e"])
+
+        # Ungrouping a page changes nothing
+        self.assertIs(sequence.ungroup(1), sequence)
+
+    def test_remove(self):
+        sequence = PageSequence(["a", "b", "c", "d", "e", "f"]).group(1, 3).group(0, 3)
+        self.assertSame(sequence, [["a", ["b", "c"], "d"], "e", "f"])
+
+        removed, first = sequence.remove({"b", "f"})
+        self.assertSame(removed, [["a", ["c"], "d"], "e"])
+        self.assertEqual(first, 0)
+
+        # Groups that lose all of their pages are left out
+        removed, first = sequence.remove({"b", "c"})
+        self.assertSame(removed, [["a", "d"], "e", "f"])
+        removed, first = sequence.remove({"a", "b", "c", "d"})
+        self.assertSame(removed, ["e", "f"])
+
+        removed, first = sequence.remove({"f"})
+        self.assertEqual(first, 2)
+        removed, first = sequence.remove({"x"})
+        self.assertIs(removed, sequence)
+        self.assertEqual(first, 3)
+
+        # Unchanged entries are shared
+        self.assertIs(removed[0], sequence[0])
+
+    def test_random_remove(self):
+        rng = random.Random(2)
+        for run in range(50):
+            expected = ["p{0}".format(i) for i in range(rng.randint(1, 20))]
+            sequence = PageSequence(expected)
+            for step in range(5):
+                start = rng.randrange(len(expected))
+                stop = rng.randint(start + 1, len(expected))
+                sequence = sequence.group(start, stop)
+                expected[start:stop] = [expected[start:stop]]
+
+            pages = set(rng.sample(pages_of(expected), rng.randint(0, min(5, len(pages_of(expected))))))
+            removed, first = sequence.remove(pages)
+            self.assertSame(removed, without(expected, pages))
+            changed = [i for i, e in enumerate(expected) if set(pages_of([e])) & pages]
+            self.assertEqual(first, changed[0] if changed else len(expected))
+
+    def test_output_pages(self):
+        rng = random.Random(3)
+        for run in range(30):
+            sides = []
+            for side in ("r", "l"):
+                sequence = PageSequence(["{0}{1}".format(side, i) for i in range(rng.randint(0, 15))])
+                for step in range(rng.randint(0, 4)):
+                    if len(sequence):
+                        start = rng.randrange(len(sequence))
+                        sequence = sequence.group(start, rng.randint(start + 1, len(sequence)))
+                sides.append(sequence)
+
+            right, left = sides
+            expected = zipper.ungroup(zipper.merge_lists(list(right), list(left)))
+            output = zipper.OutputPages(right, left)
+            self.assertEqual(len(output), len(expected))
+            self.assertEqual(list(output), expected)
+            self.assertEqual([output[i] for i in range(-len(expected), len(expected))], expected + expected)
+            self.assertEqual(output[2:7], expected[2:7])
+            with self.assertRaises(IndexError):
+                output[len(expected)]
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = History()
+        self.first = PageSequence(["a", "b", "c", "d"])
+        self.history.push(self.first, 1)
+        self.second = self.first.move(1, 2, 3)
+
+    def test_undo_redo(self):
+        self.assertIsNone(self.history.redo(self.second))
+
+        sequence, start = self.history.undo(self.second)
+        self.assertIs(sequence, self.first)
+        self.assertEqual(start, 1)
+        self.assertIsNone(self.history.undo(sequence))
+
+        sequence, start = self.history.redo(sequence)
+        self.assertIs(sequence, self.second)
+
+        # A new change drops what could be redone
+        self.history.undo(sequence)
+        self.history.push(self.first, 0)
+        self.assertIsNone(self.history.redo(self.first.delete(0)))
+
+    def test_insert(self):
+        # A page added to the folder goes where it belongs in every step
+        def index(sequence):
+            return next((i for i, p in enumerate(sequence) if p > "bb"), len(sequence))
+
+        current = self.second.insert(index(self.second), "bb")
+        self.history.insert("bb", index)
+
+        sequence, start = self.history.undo(current)
+        self.assertEqual(list(sequence), ["a", "b", "bb", "c", "d"])
+        self.assertEqual(start, 1)
+
+        sequence, start = self.history.redo(sequence)
+        self.assertEqual(list(sequence), ["a", "bb", "c", "d", "b"])
+        self.assertEqual(start, 1)
+
+        self.history.undo(sequence)
+        self.history.insert("0", lambda sequence: 0)
+        sequence, start = self.history.redo(self.first)
+        self.assertEqual(list(sequence), ["0", "a", "bb", "c", "d", "b"])
+        self.assertEqual(start, 0)
+
+    def test_remove(self):
+        # A page removed from the folder is not brought back by undo
+        current, first = self.second.remove({"c"})
+        self.history.remove({"c"})
+
+        sequence, start = self.history.undo(current)
+        self.assertEqual(list(sequence), ["a", "b", "d"])
+        self.assertEqual(start, 1)
+
+        grouped = PageSequence(["a", "b", "c"]).group(0, 2)
+        self.history.push(grouped, 2)
+        self.history.remove({"a"})
+        sequence, start = self.history.undo(grouped.remove({"a"})[0])
+        self.assertEqual(shape(sequence), [["b"], "c"])
+        self.assertEqual(start, 0)
+
+    def test_limit(self):
+        for i in range(History.limit + 10):
+            self.history.push(PageSequence([i]), 0)
+        steps = 0
+        while self.history.undo(None) is not None:
+            steps += 1
+        self.assertEqual(steps, History.limit)
+
+
+if __name__ == "__main__":
+    unittest.main()
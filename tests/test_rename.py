@@ -0,0 +1,161 @@
+'''Checks the Rename utility on folders saved by Page Zipper
+
+Run with: python -m unittest discover tests
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fixity
+import reporting
+import utils
+import zipper
+
+
+class RenameTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="page-zipper-test-")
+        # Listing pages saves a folder index in the user's cache, which goes in the test folder instead
+        self.environ = dict(os.environ)
+        os.environ["XDG_CACHE_HOME"] = os.environ["LOCALAPPDATA"] = os.path.join(self.folder, "cache")
+        self.pages = os.path.join(self.folder, "pages")
+        self.out = os.path.join(self.folder, "out")
+        os.mkdir(self.pages)
+        os.mkdir(self.out)
+
+        # Each page has different contents, so a page renamed out of order is noticed
+        self.contents = []
+        for i in range(6):
+            data = "page {0}\n".format(i).encode() * (i + 1)
+            with open(os.path.join(self.pages, "p{0}.jpg".format(i)), 'wb') as f:
+                f.write(data)
+            self.contents.append(data)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def save(self):
+        zipper.copy_files(utils.list_pages(self.pages), self.out, "img_", reporting.NullProgress, algorithm='sha256')
+
+    def assertRenamed(self, folder, prefix):
+        names = sorted(os.listdir(folder))
+        expected = ["{0}{1}.jpg".format(prefix, i + 1) for i in range(len(self.contents))]
+        self.assertEqual([n for n in names if not utils.is_own_file(n)], expected)
+        for name, data in zip(expected, self.contents):
+            with open(os.path.join(folder, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+        # The manifest and the save record follow the new names
+        self.assertIn(fixity.manifest_name('sha256'), names)
+        self.assertEqual(fixity.verify_folder(folder, reporting.NullProgress), [])
+        self.assertEqual(sorted(zipper.read_sources(folder)), expected)
+
+    def test_save_then_rename_in_place(self):
+        self.save()
+        utils.rename_files(self.out, 1, "x_", reporting.NullProgress, in_place=True)
+        self.assertRenamed(self.out, "x_")
+        self.assertFalse(utils.pending_rename(self.out))
+
+    def test_save_then_rename_copy(self):
+        self.save()
+        utils.rename_files(self.out, 1, "x_", reporting.NullProgress)
+        self.assertRenamed(self.out + "_renamed", "x_")
+
+
+class Crash(Exception):
+    pass
+
+
+class JournaledRenameTest(unittest.TestCase):
+    '''Stops an in-place rename after some of its file renames, then finishes or undoes it'''
+    count = 5
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="page-zipper-test-")
+        self.original = {}
+        for i in range(JournaledRenameTest.count):
+            name = "capture{0}.jpg".format(i)
+            self.original[name] = "contents of {0}".format(name).encode()
+            with open(os.path.join(self.folder, name), 'wb') as f:
+                f.write(self.original[name])
+        self.renamed = {"x_{0}.jpg".format(i + 1): self.original["capture{0}.jpg".format(i)] for i in range(JournaledRenameTest.count)}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def reset(self):
+        self.tearDown()
+        self.setUp()
+
+    def contents(self):
+        found = {}
+        for name in os.listdir(self.folder):
+            with open(os.path.join(self.folder, name), 'rb') as f:
+                found[name] = f.read()
+        return found
+
+    # Runs function with os.rename failing after allowed renames
+    def crash_after(self, allowed, function, *args):
+        rename = os.rename
+        calls = []
+
+        def failing(src, dst):
+            if len(calls) >= allowed:
+                raise Crash()
+            calls.append(src)
+            rename(src, dst)
+
+        with mock.patch('os.rename', failing):
+            with self.assertRaises(Crash):
+                function(*args)
+
+    def rename(self):
+        utils.rename_files(self.folder, 1, "x_", reporting.NullProgress, in_place=True)
+
+    def check_recovery(self, allowed):
+        for forward, expected in ((True, self.renamed), (False, self.original)):
+            with self.subTest(allowed=allowed, forward=forward):
+                self.reset()
+                self.crash_after(allowed, self.rename)
+                self.assertTrue(utils.pending_rename(self.folder))
+
+                utils.recover_rename(self.folder, forward, reporting.NullProgress)
+                self.assertFalse(utils.pending_rename(self.folder))
+                self.assertEqual(self.contents(), expected)
+
+    def test_forward(self):
+        self.rename()
+        self.assertEqual(self.contents(), self.renamed)
+
+    def test_crash_in_phase_1(self):
+        self.check_recovery(2)
+
+    def test_crash_between_phases(self):
+        # Every file has its temporary name, none has its new one
+        self.check_recovery(JournaledRenameTest.count)
+
+    def test_crash_in_phase_2(self):
+        self.check_recovery(JournaledRenameTest.count + 2)
+
+    def test_crash_while_recovering(self):
+        for forward, expected in ((True, self.renamed), (False, self.original)):
+            with self.subTest(forward=forward):
+                self.reset()
+                self.crash_after(JournaledRenameTest.count + 1, self.rename)
+                # Finishing or undoing stops part way too, and is run again
+                self.crash_after(2, utils.recover_rename, self.folder, forward, reporting.NullProgress)
+                utils.recover_rename(self.folder, forward, reporting.NullProgress)
+                self.assertFalse(utils.pending_rename(self.folder))
+                self.assertEqual(self.contents(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
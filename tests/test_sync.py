@@ -0,0 +1,143 @@
+'''Checks Sync Output planning and applying on folders saved by Page Zipper
+
+Run with: python -m unittest discover tests
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fixity
+import reporting
+import sync
+import utils
+import zipper
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="page-zipper-test-")
+        # Listing pages saves a folder index in the user's cache, which goes in the test folder instead
+        self.environ = dict(os.environ)
+        os.environ["XDG_CACHE_HOME"] = os.environ["LOCALAPPDATA"] = os.path.join(self.folder, "cache")
+        self.pages = os.path.join(self.folder, "pages")
+        self.out = os.path.join(self.folder, "out")
+        os.mkdir(self.pages)
+        os.mkdir(self.out)
+
+        # The pages are all the same size, so only the source record tells them apart by their stats
+        for i in range(4):
+            with open(os.path.join(self.pages, "p{0}.jpg".format(i)), 'wb') as f:
+                f.write("page {0}\n".format(i).encode() * 10)
+
+        self.files = utils.list_pages(self.pages)
+        zipper.copy_files(self.files, self.out, "img_", reporting.NullProgress, algorithm='sha256')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def sync(self, files, compare='stat'):
+        plan = sync.plan_sync(files, self.out, "img_", compare)
+        sync.apply_sync(plan, reporting.NullProgress)
+        return plan
+
+    # Checks the output folder holds files, numbered in order, and nothing else but Page Zipper's own files
+    def assertSynced(self, files):
+        names = sorted(n for n in os.listdir(self.out) if not utils.is_own_file(n))
+        expected = [zipper.output_name(i, f.path, len(files)) for i, f in enumerate(files)]
+        self.assertEqual(names, sorted(expected))
+        for name, f in zip(expected, files):
+            with open(os.path.join(self.out, name), 'rb') as out, open(f.path, 'rb') as page:
+                self.assertEqual(out.read(), page.read())
+
+        self.assertEqual(fixity.verify_folder(self.out, reporting.NullProgress), [])
+        self.assertEqual(sorted(zipper.read_sources(self.out)), sorted(expected))
+
+        # Nothing is left to do
+        self.assertEqual(sync.plan_sync(files, self.out, "img_").changes(), 0)
+
+    def test_up_to_date(self):
+        plan = sync.plan_sync(self.files, self.out, "img_")
+        self.assertEqual(plan.keep, ["img_1.jpg", "img_2.jpg", "img_3.jpg", "img_4.jpg"])
+        self.assertEqual(plan.changes(), 0)
+
+    def test_reorder(self):
+        for compare in ('stat', 'hash'):
+            with self.subTest(compare=compare):
+                files = [self.files[1], self.files[0]] + self.files[2:]
+                plan = self.sync(files, compare)
+                self.assertEqual(plan.keep, ["img_3.jpg", "img_4.jpg"])
+                self.assertEqual(sorted(plan.renames), [("img_1.jpg", "img_2.jpg"), ("img_2.jpg", "img_1.jpg")])
+                self.assertEqual(plan.deletes, [])
+                self.assertEqual(plan.writes, [])
+                self.assertSynced(files)
+
+                # Back to the order they were saved in
+                self.sync(self.files, compare)
+                self.assertSynced(self.files)
+
+    def test_drop_pages(self):
+        files = [self.files[0], self.files[2]]
+        plan = self.sync(files)
+        self.assertEqual(plan.keep, ["img_1.jpg"])
+        self.assertEqual(plan.renames, [("img_3.jpg", "img_2.jpg")])
+        self.assertEqual(plan.deletes, ["img_2.jpg", "img_4.jpg"])
+        self.assertEqual(plan.writes, [])
+        self.assertSynced(files)
+
+    def test_add_pages(self):
+        with open(os.path.join(self.pages, "p4.jpg"), 'wb') as f:
+            f.write(b"page 4\n" * 10)
+        files = utils.list_pages(self.pages)
+        plan = self.sync(files)
+        self.assertEqual(len(plan.keep), 4)
+        self.assertEqual(plan.writes, [(files[4].path, "img_5.jpg")])
+        self.assertSynced(files)
+
+    def test_touch_original(self):
+        # The same contents, saved again: the stats no longer match the source record
+        page = self.files[2].path
+        stat = os.stat(page)
+        os.utime(page, ns=(stat.st_atime_ns, stat.st_mtime_ns + 5 * 10**9))
+
+        plan = sync.plan_sync(self.files, self.out, "img_", 'hash')
+        self.assertEqual(plan.changes(), 0)
+
+        plan = self.sync(self.files)
+        self.assertEqual(plan.keep, ["img_1.jpg", "img_2.jpg", "img_4.jpg"])
+        self.assertEqual(plan.writes, [(page, "img_3.jpg")])
+        self.assertEqual(plan.renames, [])
+        self.assertEqual(plan.deletes, [])
+        self.assertSynced(self.files)
+
+    def test_rewrite_original(self):
+        # New contents of the same size are only noticed by the source record or by hashing
+        page = self.files[1].path
+        with open(page, 'wb') as f:
+            f.write(b"PAGE 1\n" * 10)
+
+        plan = sync.plan_sync(self.files, self.out, "img_", 'hash')
+        self.assertEqual(plan.writes, [(page, "img_2.jpg")])
+
+        plan = self.sync(self.files)
+        self.assertEqual(plan.writes, [(page, "img_2.jpg")])
+        self.assertEqual(plan.deletes, [])
+        self.assertSynced(self.files)
+
+    def test_interrupted_save_is_discarded(self):
+        zipper.SaveJournal(self.out).start([(f.path, os.path.join(self.out, "x.jpg")) for f in self.files], 'copy', None)
+        self.assertTrue(zipper.pending_save(self.out))
+
+        self.sync(self.files[:2])
+        self.assertFalse(zipper.pending_save(self.out))
+        self.assertSynced(self.files[:2])
+
+
+if __name__ == "__main__":
+    unittest.main()
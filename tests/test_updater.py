@@ -0,0 +1,104 @@
+'''Checks the update check against a local stand-in for the GitHub API
+
+Run with: python -m unittest discover tests
+'''
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import updater
+
+
+class ReleaseHandler(http.server.BaseHTTPRequestHandler):
+    '''Answers /latest.json with the release tag set on the server'''
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path.split("?")[0] != "/latest.json":
+            self.send_error(404)
+            return
+
+        body = json.dumps({'tag_name': self.server.tag}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpdateCheckerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), ReleaseHandler)
+        self.server.tag = "v1.3"
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        # The settings and the saved result of earlier checks go in a folder of their own
+        self.home = tempfile.mkdtemp(prefix="page-zipper-test-")
+        self.environ = dict(os.environ)
+        os.environ["PAGE_ZIPPER_HOME"] = self.home
+        self.use_url("/latest.json")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def use_url(self, path):
+        os.environ["PAGE_ZIPPER_UPDATE_URL"] = "http://127.0.0.1:{0}{1}".format(self.server.server_port, path)
+
+    def check(self, current=1.2):
+        checker = updater.UpdateChecker(current).start()
+        self.assertTrue(checker.done.wait(10))
+        return checker
+
+    def test_newer_version(self):
+        checker = self.check()
+        self.assertIsNone(checker.error)
+        self.assertEqual(checker.newer_version(), 1.3)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_up_to_date(self):
+        checker = self.check(current=1.3)
+        self.assertIsNone(checker.error)
+        self.assertIsNone(checker.newer_version())
+
+    def test_result_is_reused(self):
+        self.check()
+        self.server.tag = "v1.4"
+
+        # Within the check interval the saved result is used without asking the server
+        checker = self.check()
+        self.assertEqual(checker.newer_version(), 1.3)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_new_url_is_checked(self):
+        self.check()
+        self.use_url("/latest.json?again")
+        self.server.tag = "v1.4"
+
+        checker = self.check()
+        self.assertEqual(checker.newer_version(), 1.4)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_failed_request(self):
+        self.use_url("/missing.json")
+        checker = self.check()
+        self.assertIsNotNone(checker.error)
+        self.assertIsNone(checker.newer_version())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import collections
+import math
+import os
+
+import reporting
+import stats
+import utils
+import zipper
+
+
+# Formats access copies can be saved as, with the name shown in the Output tab
+FORMATS = collections.OrderedDict([
+    ('keep', "Same as Original"),
+    ('jpeg', "JPEG"),
+    ('webp', "WebP"),
+    ('png', "PNG"),
+])
+
+# PIL format and extension of each format
+SAVE_FORMATS = {'jpeg': ('JPEG', ".jpg"), 'webp': ('WEBP', ".webp"), 'png': ('PNG', ".png"), 'tiff': ('TIFF', ".tif")}
+
+# Extensions that 'keep' saves in the same format, everything else becomes PNG
+KEEP = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp', '.png': 'png', '.tif': 'tiff', '.tiff': 'tiff'}
+
+
+class Profile:
+    '''How access copies are made from the original pages
+
+    long_edge is the longest side in pixels, 0 keeps the size. quality applies to JPEG and
+    WebP. strip leaves out EXIF and other metadata, turning the page upright first as the
+    orientation is part of the metadata. The colour profile is always kept.
+    '''
+    def __init__(self, long_edge=0, fmt='jpeg', quality=85, strip=False):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format {0}".format(fmt))
+        self.long_edge = long_edge
+        self.fmt = fmt
+        self.quality = quality
+        self.strip = strip
+
+    # Returns the format key an original is saved as
+    def format_for(self, path):
+        if self.fmt == 'keep':
+            return KEEP.get(os.path.splitext(path)[1].lower(), 'png')
+        return self.fmt
+
+    def extension_for(self, path):
+        return SAVE_FORMATS[self.format_for(path)][1]
+
+
+# Runs in worker processes. The original is decoded once, at the smallest size that still covers long_edge
+def transcode(src, dst, profile):
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as image:
+        if profile.long_edge and max(image.size) > profile.long_edge:
+            # The JPEG decoder scales by 1/2, 1/4 or 1/8 while decoding, never below the requested size
+            scale = profile.long_edge / max(image.size)
+            image.draft(None, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+
+        info = image.info
+        if profile.strip:
+            image = ImageOps.exif_transpose(image)
+
+        if profile.long_edge and max(image.size) > profile.long_edge:
+            # reducing_gap lets Image.reduce do the bulk of the shrinking before resampling
+            image.thumbnail((profile.long_edge, profile.long_edge), Image.LANCZOS, reducing_gap=3.0)
+
+        fmt = profile.format_for(src)
+        name = SAVE_FORMATS[fmt][0]
+        allowed = ('L', 'RGB', 'CMYK') if fmt in ('jpeg', 'tiff') else ('L', 'RGB', 'RGBA', 'LA', 'P')
+        image = utils.to_8_bits(image)
+        if image.mode not in allowed:
+            image = image.convert('RGBA' if 'A' in image.mode and fmt != 'jpeg' else 'RGB')
+
+        options = {}
+        if fmt in ('jpeg', 'webp'):
+            options['quality'] = profile.quality
+        if info.get('icc_profile'):
+            options['icc_profile'] = info['icc_profile']
+        if not profile.strip:
+            if info.get('exif'):
+                options['exif'] = info['exif']
+            if info.get('dpi'):
+                options['dpi'] = info['dpi']
+
+        image.save(dst, name, **options)
+    return dst
+
+
+# Saves a numbered access copy of each page in a process pool, instead of copying the originals
+def transcode_files(files, out, profile, pre="img_", progress=reporting.ConsoleProgress, workers=4):
+    jobs = []
+    for i, page in enumerate(files):
+        target = os.path.join(out, zipper.output_name(i, "page" + profile.extension_for(page.path), len(files), pre))
+        jobs.append(((page.path, target, profile), "Converted {0} to {1}".format(page.path, target)))
+
+    progress = progress("Saving Access Copies", len(jobs))
+    try:
+        with stats.timer('transcode_files'):
+            zipper.process_files(jobs, transcode, progress, workers)
+    finally:
+        progress.destroy()
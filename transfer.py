@@ -0,0 +1,176 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+import threading
+
+import fixity
+import stats
+
+
+# Output modes, with the name shown in the Output tab
+MODES = collections.OrderedDict([
+    ('copy', "Copy"),
+    ('hardlink', "Hard link"),
+    ('reflink', "Reflink (clone)"),
+    ('kernel', "In-kernel copy"),
+    ('move', "Move"),
+])
+
+# Modes to try, in order, when a mode is not supported for a pair of volumes
+FALLBACKS = {
+    'copy': [],
+    'hardlink': ['reflink', 'kernel', 'copy'],
+    'reflink': ['kernel', 'copy'],
+    'kernel': ['copy'],
+    'move': [],
+}
+
+VERBS = {'copy': "Copied", 'hardlink': "Linked", 'reflink': "Cloned", 'kernel': "Copied", 'move': "Moved"}
+
+# Errors that mean "this filesystem or platform can't do that", rather than a real failure
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP,
+                      errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOTSOCK, errno.EMLINK}
+
+# ioctl request to clone a whole file on Linux (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+class Unsupported(Exception):
+    pass
+
+
+def _remove(path):
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def _copy(src, dst):
+    shutil.copy2(src, dst)
+
+
+def _hardlink(src, dst):
+    _remove(dst)
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    if sys.platform.startswith('linux'):
+        import fcntl
+
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    elif sys.platform == 'darwin':
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _remove(dst)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), src)
+    else:
+        raise Unsupported()
+
+    shutil.copystat(src, dst)
+
+
+# Copies inside the kernel, so the data never passes through user space
+def _kernel(src, dst):
+    if hasattr(os, 'copy_file_range'):
+        send = lambda d, s, count: os.copy_file_range(s, d, count)
+    elif hasattr(os, 'sendfile'):
+        send = lambda d, s, count: os.sendfile(d, s, None, count)
+    else:
+        raise Unsupported()
+
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            sent = send(d.fileno(), s.fileno(), min(remaining, 1 << 30))
+            if sent == 0:
+                break
+            remaining -= sent
+
+    shutil.copystat(src, dst)
+
+
+def _move(src, dst):
+    shutil.move(src, dst)
+
+
+FUNCTIONS = {'copy': _copy, 'hardlink': _hardlink, 'reflink': _reflink, 'kernel': _kernel, 'move': _move}
+
+
+# Removes an output that is still a hard link to its original from an earlier save
+# Copies would otherwise write through it into the original, and moves would do nothing
+def _unlink_same(src, dst):
+    try:
+        same = os.path.samefile(src, dst)
+    except OSError:
+        return
+    if same:
+        os.remove(dst)
+
+
+def _device(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+class Transfer:
+    '''Puts files in the output folder with the chosen mode, falling back when it is not supported
+
+    Modes that fail as unsupported between two volumes are not tried again for that pair.
+    With an algorithm from fixity.ALGORITHMS, the digest of each file is kept in digests by
+    destination. Copies are hashed as they are written, other modes hash the placed file.
+    Calls are thread safe.
+    '''
+    def __init__(self, mode='copy', algorithm=None):
+        if mode not in MODES:
+            raise ValueError("Unknown output mode {0}".format(mode))
+
+        self.mode = mode
+        self.algorithm = algorithm
+        self.digests = {}
+        self.unsupported = set()
+        self.used = collections.Counter()
+        self.lock = threading.Lock()
+
+    # Returns the mode that was used
+    def __call__(self, src, dst):
+        _unlink_same(src, dst)
+        volumes = (_device(src), _device(os.path.dirname(os.path.abspath(dst))))
+
+        for mode in [self.mode] + FALLBACKS[self.mode]:
+            if (mode, volumes) in self.unsupported:
+                continue
+
+            try:
+                with stats.timer('transfer.' + mode):
+                    if self.algorithm and mode == 'copy':
+                        digest = fixity.copy_hashed(src, dst, self.algorithm)
+                    else:
+                        FUNCTIONS[mode](src, dst)
+                        digest = fixity.hash_file(dst, self.algorithm) if self.algorithm else None
+            except Unsupported:
+                pass
+            except OSError as err:
+                if err.errno not in UNSUPPORTED_ERRORS or mode == 'copy':
+                    raise
+                # Don't leave a partly written file behind for the next mode
+                if mode in ('reflink', 'kernel'):
+                    _remove(dst)
+            else:
+                with self.lock:
+                    self.used[mode] += 1
+                    if digest is not None:
+                        self.digests[dst] = digest
+                return mode
+
+            with self.lock:
+                self.unsupported.add((mode, volumes))
+
+        raise OSError(errno.ENOTSUP, "No output mode could be used", src)
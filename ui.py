@@ -4,12 +4,20 @@ from tkinter import messagebox
 
 import sys
 import os
+import time
 import webbrowser
 
 import widgets
 import utils
+import reporting
 import zipper
 import updater
+import sync
+import fixity
+import export
+import spreads
+import transcode
+import screening
 
 
 version = 1.2
@@ -60,16 +68,66 @@ class RenameFrame(tk.Frame):
         self.prefix = widgets.PrefixEntry(self)
         self.prefix.grid(row=2, column=0, sticky='nsw')
 
+        self.in_place = tk.BooleanVar(value=False)
+        tk.Checkbutton(self, text="Rename in place (no copy or backup)", variable=self.in_place).grid(row=3, column=0, sticky='nsw')
+
         self.rename_button = tk.Button(self, text='Rename Files', command=self.rename)
-        self.rename_button.grid(row=3, column=0, columnspan=2, sticky='nesw', padx=5)
+        self.rename_button.grid(row=4, column=0, columnspan=2, sticky='nesw', padx=5)
 
     def rename(self):
-        if os.path.exists(self.browser.path.get()):
-            utils.rename_files(self.browser.path.get(), self.number.get(), self.prefix.prefix.get())
+        path = self.browser.path.get()
+        if os.path.exists(path):
+            try:
+                if utils.pending_rename(path):
+                    result = messagebox.askyesnocancel("Interrupted Rename", "A rename of this folder did not finish.\n\nClick Yes to finish it, or No to undo it.")
+                    if result is not None:
+                        utils.recover_rename(path, result, widgets.ProgressPopup)
+                else:
+                    utils.rename_files(path, self.number.get(), self.prefix.prefix.get(), widgets.ProgressPopup, self.in_place.get())
+            except widgets.InvalidEntry as err:
+                messagebox.showerror("Error", str(err))
+            except OSError as err:
+                messagebox.showerror("Error", "Rename failed: {0}".format(err))
+            except reporting.Cancelled:
+                messagebox.showinfo("Stopped", "The rename was stopped. Click Rename Files again to continue it.")
         else:
             messagebox.showerror("Error", "No directory specified, or path is invalid")
 
 
+class VerifyFrame(tk.Frame):
+    '''Checks a saved folder against its checksum manifest'''
+    def __init__(self, parent):
+        tk.Frame.__init__(self, parent)
+
+        self.browser = widgets.DirectoryBrowser(self, "Verify files in folder:")
+        self.browser.grid(row=0, column=0, sticky='nesw', padx=5)
+
+        self.verify_button = tk.Button(self, text='Verify Manifest', command=self.verify)
+        self.verify_button.grid(row=1, column=0, sticky='nesw', padx=5)
+
+    def verify(self):
+        path = self.browser.path.get()
+        if not os.path.isdir(path):
+            messagebox.showerror("Error", "No directory specified, or path is invalid")
+            return
+        if fixity.find_manifest(path) is None:
+            messagebox.showerror("Error", "{0} has no checksum manifest".format(path))
+            return
+
+        try:
+            problems = fixity.verify_folder(path, widgets.ProgressPopup)
+        except reporting.Cancelled:
+            return
+
+        if problems:
+            lines = ["{0}: {1}".format(name, problem) for name, problem in problems[:10]]
+            if len(problems) > 10:
+                lines.append("... and {0} more, see the log".format(len(problems) - 10))
+            messagebox.showerror("Verification Failed", "\n".join(lines))
+        else:
+            messagebox.showinfo("Verified", "All files match the manifest")
+
+
 class PageZipperWindow:
     def __init__(self, root):
         global version
@@ -81,6 +139,7 @@ class PageZipperWindow:
         self.right = {'valid':False, 'pages':[]}
         self.utils = {}
         self.output = {'valid':False, 'pages':[]}
+        self.output_model = zipper.OutputModel()
 
         self.create_gui()
 
@@ -106,7 +165,7 @@ class PageZipperWindow:
         # Create Frames for each area
         self.left_frame = widgets.PagesFrame(self.input_tab, "Left", self.on_viewer_update)
         self.right_frame = widgets.PagesFrame(self.input_tab, "Right", self.on_viewer_update)
-        self.output_frame = widgets.OutputFrame(self.output_tab, self.save_files)
+        self.output_frame = widgets.OutputFrame(self.output_tab, self.save_files, self.check_pages)
         self.utils_frame = tk.Frame(self.utils_tab)
 
         # Align to grid
@@ -127,6 +186,13 @@ class PageZipperWindow:
         self.renamer.grid(row=0, column=0, sticky='nsew')
         self.renamer.columnconfigure(0, weight=1)
 
+        self.verifier = VerifyFrame(self.utils_frame)
+        self.verifier.grid(row=1, column=0, sticky='nsew', pady=(15, 0))
+        self.verifier.columnconfigure(0, weight=1)
+
+        self.stats_frame = widgets.StatsFrame(self.utils_frame)
+        self.stats_frame.grid(row=2, column=0, sticky='nsew', padx=5, pady=15)
+
         # For horizontal expanding of all widgets
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=1)
@@ -137,33 +203,178 @@ class PageZipperWindow:
         self.help_tab.columnconfigure(0, weight=1)
         self.utils_tab.columnconfigure(0, weight=1)
 
-    def on_viewer_update(self):
-        merged = zipper.merge_lists(self.right_frame.viewer.pages, self.left_frame.viewer.pages)
-        merged = zipper.ungroup(merged)
-
-        self.output_frame.viewer.reload_pages(merged)
+    # start is the index of the first changed page in the left or right viewer
+    def on_viewer_update(self, start=0):
+        changed = self.output_model.update(self.right_frame.viewer.pages, self.left_frame.viewer.pages, start)
+
+        self.output_frame.viewer.replace(self.output_model.pages, *changed)
+
+        # Marks from Check Pages no longer match pages that were reloaded, regrouped or shot again
+        if widgets.ThumbnailViewer.flags:
+            self.show_flags({})
+
+    def show_flags(self, flags):
+        widgets.ThumbnailViewer.flags = flags
+        for viewer in (self.left_frame.viewer, self.right_frame.viewer, self.output_frame.viewer):
+            viewer.draw()
+
+    # Tells which checked settings will be skipped, rather than leaving them out silently
+    @staticmethod
+    def unused_message(kind, unused):
+        if not unused:
+            return ""
+        return "\n\n{0} are always saved as new files, so these settings are not used:\n{1}".format(kind, "\n".join(unused))
+
+    # Marks blank pages and pages shot twice in every viewer, so they can be fixed before saving
+    def check_pages(self):
+        pages = list(self.output_frame.viewer.pages)
+        if not pages:
+            messagebox.showerror("Error", "There are no pages to check")
+            return
+
+        try:
+            flags = screening.screen_pages(pages, widgets.ProgressPopup, max(1, self.output_frame.workers.get()))
+        except widgets.InvalidEntry as err:
+            messagebox.showerror("Error", str(err))
+            return
+        except reporting.Cancelled:
+            return
+
+        self.show_flags(flags)
+
+        blank = sum(1 for reason in flags.values() if reason == screening.BLANK)
+        if flags:
+            messagebox.showwarning("Check Pages", "{0} pages may be blank and {1} may be shot twice. They are marked in orange.".format(blank, len(flags) - blank))
+        else:
+            messagebox.showinfo("Check Pages", "No blank pages or double captures found")
 
     def save_files(self):
+        try:
+            self.save_pages()
+        except widgets.InvalidEntry as err:
+            messagebox.showerror("Error", str(err))
+        except OSError as err:
+            messagebox.showerror("Error", "Save failed: {0}".format(err))
+        except reporting.Cancelled:
+            message = "The save was stopped."
+            if zipper.pending_save(self.output_frame.browser.path.get()):
+                message += " Click Save again to resume it."
+            messagebox.showinfo("Stopped", message)
+
+    def save_pages(self):
         output_path = self.output_frame.browser.path.get()
         if self.left_frame.viewer.pages and self.right_frame.viewer.pages and output_path:
-            if messagebox.askokcancel("Proceed?", "Saving may overwrite some files in {0}".format(output_path)):
-                zipper.clear_dir(self.output_frame.browser.path.get())
-                zipper.copy_files(self.output_frame.viewer.pages, output_path, self.output_frame.prefix.prefix.get())
+            mode = self.output_frame.mode.get()
+            workers = max(1, self.output_frame.workers.get())
+            # Every page is needed, so the output is listed once instead of looking each one up
+            pages = list(self.output_frame.viewer.pages)
+            prefix = self.output_frame.prefix.prefix.get()
+
+            fmt = self.output_frame.format.get()
+            if fmt != 'files':
+                # Documents are written in one pass, the output mode and sync only apply to numbered files
+                target = export.document_path(output_path, fmt)
+                message = "Save the book as {0}?".format(target)
+                if os.path.exists(target):
+                    message += "\n\nThe existing file will be replaced."
+                if messagebox.askokcancel("Proceed?", message):
+                    export.export_files(pages, target, fmt, prefix, widgets.ProgressPopup)
+                return
+
+            if self.output_frame.spreads.get():
+                # Spreads are new images, so they are always written in full
+                message = "Saving may overwrite some files in {0}".format(output_path)
+                message += self.unused_message("Spreads", self.output_frame.unused_settings(True))
+                gap = max(0, self.output_frame.gap.get())
+                if messagebox.askokcancel("Proceed?", message):
+                    zipper.clear_dir(output_path)
+                    spreads.stitch_files(pages, output_path, prefix, widgets.ProgressPopup, workers, self.output_frame.cover_alone.get(),
+                                         gap, self.output_frame.align.get())
+                return
+
+            profile = self.output_frame.profile.get()
+            if profile is not None:
+                message = "Saving may overwrite some files in {0}".format(output_path)
+                message += self.unused_message("Access copies", self.output_frame.unused_settings(False))
+                if messagebox.askokcancel("Proceed?", message):
+                    zipper.clear_dir(output_path)
+                    transcode.transcode_files(pages, output_path, profile, prefix, widgets.ProgressPopup, workers)
+                return
+
+            algorithm = self.output_frame.algorithm()
+            if zipper.pending_save(output_path) and not self.output_frame.sync.get():
+                result = messagebox.askyesnocancel("Interrupted Save", "A save to this folder did not finish.\n\nClick Yes to resume it, or No to start over.")
+                if result is None:
+                    return
+                if result:
+                    zipper.resume_save(output_path, widgets.ProgressPopup, workers)
+                    return
+
+            if self.output_frame.sync.get():
+                # Show what will change before anything is written
+                plan = sync.plan_sync(pages, output_path, prefix, 'hash' if self.output_frame.hash.get() else 'stat')
+                if plan.changes() == 0:
+                    messagebox.showinfo("Up to Date", "{0} already matches the output".format(output_path))
+                    return
+                message = plan.summary()
+                if zipper.pending_save(output_path):
+                    message += "\n\nThe interrupted save to this folder will be discarded."
+            else:
+                plan = None
+                message = "Saving may overwrite some files in {0}".format(output_path)
+
+            if mode == 'move':
+                message += "\n\nThe pages will be moved out of the input folders."
+
+            if messagebox.askokcancel("Proceed?", message):
+                if plan is not None:
+                    sync.apply_sync(plan, widgets.ProgressPopup, mode, workers, algorithm)
+                else:
+                    zipper.clear_dir(self.output_frame.browser.path.get())
+                    zipper.copy_files(pages, output_path, prefix, widgets.ProgressPopup, mode, workers, algorithm)
             else:
                 print("no write")
         else:
             messagebox.showerror("Error", "No input/output directories selected")
 
+    # The check runs in the background, so the window never waits on the network
     def check_version(self):
         global version
-        updater.check_for_updates(version)
+        print("Checking for updates...")
+        self.update_checker = updater.UpdateChecker(version).start()
+        self.root.after(250, self.on_update_checked)
+
+    def on_update_checked(self):
+        if not self.update_checker.done.is_set():
+            self.root.after(250, self.on_update_checked)
+            return
+
+        latest = self.update_checker.newer_version()
+        if self.update_checker.error is not None:
+            print("Update check failed: {0}".format(self.update_checker.error))
+        elif latest:
+            print("Update found!")
+            result = messagebox.askyesno("Updates Found", f"An updated version of Page Zipper has been found (v{latest}), would you like to download the update?")
+
+            if result:
+                webbrowser.open(f"https://www.github.com/natecraddock/page-zipper/releases/latest")
+            else:
+                print("Not updating")
 
 
-def create_window():
+# start is the time.perf_counter() value when the program started
+# With measure_startup the time until the window is shown is printed, and the window closes
+def create_window(start=None, measure_startup=False):
     root = tk.Tk()
     PageZipperWindow(root)
 
     root.update()
+    if measure_startup:
+        if start is not None:
+            print("Window shown in {0:.0f} ms".format((time.perf_counter() - start) * 1000))
+        root.destroy()
+        return
+
     root.minsize(root.winfo_reqwidth(), root.winfo_reqheight())
     root.resizable(width=True, height=True)
 
@@ -1,39 +1,83 @@
-import requests
-from tkinter import messagebox
-import webbrowser
+import threading
+import time
 
+import settings
+
+
+STATE_FILE = "update.json"
+
+
+# Returns tag from latest release at the given API url
+def get_tag_name(url, timeout):
+    # requests is slow to import, and is only needed once the check actually runs
+    import requests
 
-# Returns tag from latest release on a given repository
-def get_tag_name(repository_name):
     try:
-        request = requests.get(f"https://api.github.com/repos/{repository_name}/releases/latest")
-        if request.status_code == 200:
-            return request.json()["tag_name"]
-        else:
-                raise Exception("Query failed to run by returning code of {}. {}".format(request.status_code, query))
-    except:
-        raise Exception("Failed to make request")
+        request = requests.get(url, timeout=timeout)
+    except requests.RequestException as err:
+        raise Exception("Failed to make request: {0}".format(err))
 
+    if request.status_code == 200:
+        return request.json()["tag_name"]
+    else:
+        raise Exception("Query failed to run by returning code of {}.".format(request.status_code))
 
-def check_for_updates(v):
-    print("Checking for updates...", end=" ")
-    repository = "natecraddock/page-zipper"
-    tag = get_tag_name(repository)
 
-    # Strip text
-    tag = tag[1:]
-    version = float(tag)
+class UpdateChecker:
+    '''Looks up the latest release on a background thread
+
+    The result is saved, and the server is asked again only once the check interval has
+    passed, so starting offline never waits on the network.
+    '''
+    def __init__(self, current, config=None):
+        self.current = current
+        self.config = config or settings.load()
+        self.latest = None
+        self.error = None
+        self.done = threading.Event()
 
-    # If latest version is greater than current version
-    if version > v:
-        print("Update found!")
-        result = messagebox.askyesno("Updates Found", f"An updated version of Page Zipper has been found (v{version}), would you like to download the update?")
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        try:
+            state = settings.read_state(STATE_FILE)
+            interval = self.config['update_check_interval_hours'] * 3600
+
+            if state.get('url') == self.config['update_url'] and time.time() - state.get('checked', 0) < interval:
+                self.latest = state.get('latest')
+            else:
+                tag = get_tag_name(self.config['update_url'], self.config['update_timeout'])
+                # Strip text
+                self.latest = float(tag[1:])
+                settings.write_state(STATE_FILE, {'checked': time.time(), 'latest': self.latest, 'url': self.config['update_url']})
+        except Exception as err:
+            self.error = err
+        finally:
+            self.done.set()
+
+    # Returns the newer version once the check is done, or None
+    def newer_version(self):
+        if self.latest is not None and self.latest > self.current:
+            return self.latest
+        return None
+
+
+def check_for_updates(v):
+    print("Checking for updates...", end=" ")
+    checker = UpdateChecker(v)
+    checker.run()
 
-        if result:
-            webbrowser.open(f"https://www.github.com/{repository}/releases/latest")
-        else:
-            print("Not updating")
+    if checker.error is not None:
+        print("Failed: {0}".format(checker.error))
+    elif checker.newer_version():
+        print("Update found! (v{0})".format(checker.latest))
+    else:
+        print("Up to date")
 
 
+# PAGE_ZIPPER_UPDATE_URL=http://localhost:8000/latest.json python updater.py
+# checks against a local stand-in server
 if __name__ == "__main__":
     check_for_updates(1.2)
@@ -1,36 +1,171 @@
-import tkinter as tk
 import tempfile
 import os
 import shutil
 import sys
-from PIL import Image
 import io
+import json
+import uuid
 
-import widgets
+import cache
+import fixity
+import folderindex
+import reporting
+import stats
+
+
+thumbnail_cache = cache.ThumbnailCache()
+
+# Files in a folder that belong to Page Zipper, such as save records and journals
+RESERVED_PREFIX = ".page-zipper"
+
+
+# Page Zipper's own files, including checksum manifests, are never renamed or synced as pages
+def is_own_file(name):
+    return name.startswith(RESERVED_PREFIX) or fixity.is_manifest(name)
 
 
 class Page:
-    '''A page object that contains the path to an image file, and the loaded thumbnail of that file'''
+    '''A page object that contains the path to an image file
+
+    The thumbnail is created in the background when the page is first shown, and kept
+    in thumbnail_cache. loaded is None until then, and False if the file could not be
+    loaded as an image. file_size and mtime come from a folder index that was just listed,
+    they are None when the file must be stat'ed for them.
+    '''
+    __slots__ = ('path', 'name', 'file_size', 'mtime', 'loaded')
 
     size = 250
 
-    def __init__(self, path):
+    def __init__(self, path, file_size=None, mtime=None):
         self.path = path
         self.name = os.path.splitext(os.path.basename(self.path))[0]
-        self.thumb = self.make_thumbnail()
+        self.file_size = file_size
+        self.mtime = mtime
+        self.loaded = None
 
-    # Returns None if no image can be loaded
-    def make_thumbnail(self):
-        try:
-            image = Image.open(self.path)
-            image.thumbnail((Page.size, Page.size))
+    # The (size, mtime) the thumbnail cache is keyed on, None if it must stat the file
+    def stat(self):
+        if self.file_size is None:
+            return None
+        return self.file_size, self.mtime
+
+
+# True for the modes PIL opens 16 bit grey images in
+def is_16_bit_grey(mode):
+    return mode == 'I' or mode.startswith('I;16')
+
+
+# Returns 16 bit grey images scaled to 8 bit grey, and any other image unchanged
+# convert() doesn't scale, so it would turn every 16 bit value above 255 white
+def to_8_bits(image):
+    if is_16_bit_grey(image.mode):
+        return image.convert('I').point(lambda value: value * (1 / 256)).convert('L')
+    return image
+
+
+# Returns the thumbnail as PPM data, which tk.PhotoImage reads without another codec pass
+# fast=False is the original full decode and GIF encode, kept for benchmarking
+# Stage times go to recorder. PIL reads the file as it decodes, so decode includes the disk reads
+def make_thumbnail_data(path, size, fast=True, recorder=stats.recorder):
+    # PIL is imported here so the command line tools start quickly
+    from PIL import Image
+
+    with recorder.timer('thumbnail.open'):
+        image = Image.open(path)
+    recorder.count('thumbnail.bytes', os.path.getsize(path))
+
+    with image:
+        if not fast:
+            image.thumbnail((size, size))
             b = io.BytesIO()
             image.save(b, 'gif')
-            return tk.PhotoImage(data=b.getvalue())
+            return b.getvalue()
 
-        except (OSError, IsADirectoryError) as err:
-            print("Error Loading Image: {0}".format(err))
-            return None
+        with recorder.timer('thumbnail.decode'):
+            preview = _exif_preview(image, size)
+            if preview is not None:
+                image = preview
+                recorder.count('thumbnail.exif_previews')
+            elif image.format == 'JPEG':
+                # Let the JPEG decoder scale by 1/2, 1/4 or 1/8 instead of decoding every pixel
+                image.draft('RGB', (size, size))
+            image.load()
+
+        with recorder.timer('thumbnail.resize'):
+            # reducing_gap uses Image.reduce for the bulk of the shrinking before resampling
+            image.thumbnail((size, size), reducing_gap=2.0)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+        with recorder.timer('thumbnail.encode'):
+            b = io.BytesIO()
+            image.save(b, 'ppm')
+            return b.getvalue()
+
+
+# Returns the thumbnail embedded in the EXIF data of a JPEG, if it is large enough to use
+def _exif_preview(image, size):
+    from PIL import Image
+
+    exif = image.info.get('exif')
+    if image.format != 'JPEG' or not exif:
+        return None
+
+    start = exif.find(b'\xff\xd8\xff', 6)
+    end = exif.rfind(b'\xff\xd9')
+    if start < 0 or end < start:
+        return None
+
+    try:
+        preview = Image.open(io.BytesIO(exif[start:end + 2]))
+        preview.load()
+    except OSError:
+        return None
+
+    # Cameras often letterbox the preview, which would show as black bars
+    width, height = image.size
+    if max(preview.size) < size or abs(preview.width / preview.height - width / height) > 0.02:
+        return None
+
+    return preview
+
+
+# Runs in worker processes, returns (data, timings) where data is None if no image can be loaded
+# The timings are added to stats.recorder in the main process with merge
+def load_thumbnail_data(path, size):
+    recorder = stats.Recorder()
+    try:
+        data = make_thumbnail_data(path, size, recorder=recorder)
+    except (OSError, IsADirectoryError) as err:
+        print("Error Loading Image: {0}".format(err))
+        data = None
+    return data, recorder.drain()
+
+
+# Extensions of the files the command line tools treat as pages. The GUI lists every file and
+# leaves out the ones that can't be loaded, as the command line tools never decode them
+IMAGE_EXTENSIONS = {'.bmp', '.gif', '.jp2', '.jpeg', '.jpg', '.jpe', '.jfif', '.png', '.ppm', '.tif', '.tiff', '.webp',
+                    '.heic', '.heif', '.dng', '.cr2', '.cr3', '.nef', '.arw', '.orf', '.raf', '.rw2', '.pef', '.srw'}
+
+
+def is_image(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+# Returns a Page for every file in a directory in natural order, without loading any images
+# index is a folderindex.FolderIndex of the directory, loaded if not given
+# images_only leaves out the files whose extension is not in IMAGE_EXTENSIONS
+def list_pages(directory, index=None, images_only=False):
+    if index is None:
+        index = folderindex.FolderIndex.load(directory)
+
+    pages = []
+    for path, size, mtime in index:
+        if images_only and not is_image(path):
+            continue
+        # A saved index may be out of date for files rewritten in place, so those pages are stat'ed when needed
+        pages.append(Page(path, size, mtime) if index.verified else Page(path))
+    return pages
 
 
 # TODO: include group image
@@ -63,27 +198,76 @@ def _restore_backup(backup, path):
     shutil.copytree(backup.name, path)
 
 
-def rename_files(path, start_number, prefix):
+# progress is called as progress(title, steps), e.g. widgets.ProgressPopup in the GUI
+# in_place renames the files in path instead of copying them to <path>_renamed
+def rename_files(path, start_number, prefix, progress=reporting.ConsoleProgress, in_place=False):
+    with stats.timer('rename_files'):
+        if in_place:
+            return _rename_in_place(path, start_number, prefix, progress)
+        return _rename_copy(path, start_number, prefix, progress)
+
+
+# Returns the save record and checksum manifest of folder, read before its files are renamed
+def _read_records(folder):
+    # zipper imports utils
+    import zipper
+
+    manifest = None
+    found = fixity.find_manifest(folder)
+    if found is not None:
+        try:
+            manifest = [found[0], fixity.read_manifest(found[1])]
+        except (OSError, ValueError):
+            pass
+    return {'sources': zipper.read_sources(folder), 'manifest': manifest}
+
+
+# Writes the records read by _read_records to folder, for files renamed from {old name: new name}
+# Renaming keeps each file's contents and modification time, so only the names change
+def _write_records(folder, records, renamed):
+    import zipper
+
+    if not records:
+        return
+    if records['sources']:
+        zipper.write_sources(folder, {renamed.get(name, name): record for name, record in records['sources'].items()})
+    if records['manifest'] is not None:
+        algorithm, digests = records['manifest']
+        fixity.write_manifest(folder, algorithm, {renamed.get(name, name): digest for name, digest in digests.items()})
+
+
+def _rename_copy(path, start_number, prefix, progress):
     files = os.listdir(path)
     files.sort()
+    pages = [f for f in files if not is_own_file(f)]
 
-    progress = widgets.ProgressPopup("Renaming Files", len(files))
+    progress = progress("Renaming Files", len(pages))
     progress.log_message("Creating backup")
 
     backup = _create_backup(files, path)
 
-    digits = len(os.listdir(path)) + start_number
+    digits = len(pages) + start_number
 
     # Create temporary directory for renaming
+    # A folder left by a stopped rename of the same files is kept, and the files copied already are skipped
     renamed_directory = path + "_renamed"
-    if os.path.exists(renamed_directory):
+    marker = os.path.join(renamed_directory, RENAME_JOURNAL)
+    job = {'start': start_number, 'prefix': prefix, 'files': pages}
+    if os.path.exists(renamed_directory) and _read_json(marker) != job:
         shutil.rmtree(renamed_directory)
-    os.mkdir(renamed_directory)
+    if not os.path.exists(renamed_directory):
+        os.mkdir(renamed_directory)
+        with open(marker, 'w') as f:
+            json.dump(job, f)
 
     try:
         progress.log_message("Copying Files")
         # Move all of the files to a new directory, with new names
-        for file in files:
+        renamed = {}
+        for file in pages:
+            if reporting.cancelled(progress):
+                raise reporting.Cancelled()
+
             origin = os.path.join(path, file)
             if os.path.isfile(origin):
                 end = os.path.splitext(file)[1]
@@ -91,21 +275,183 @@ def rename_files(path, start_number, prefix):
                 file_name = prefix + file_name
                 dest = os.path.join(renamed_directory, file_name)
 
-                shutil.copyfile(origin, dest)
+                if _same_file(origin, dest):
+                    progress.log_message("Already renamed {0} as {1}".format(origin, file_name))
+                else:
+                    # copy2 keeps the modification time, which a resumed rename checks
+                    shutil.copy2(origin, dest)
+                    progress.log_message("Renamed {0} as {1}".format(origin, file_name))
                 progress.next()
-                progress.log_message("Renamed {0} as {1}".format(origin, file_name))
 
+                renamed[file] = file_name
                 start_number += 1
             else:
                 dest = os.path.join(renamed_directory, file)
+                if os.path.exists(dest):
+                    shutil.rmtree(dest)
                 shutil.copytree(origin, dest)
                 progress.next()
                 progress.log_message("Did not modify {0}".format(origin))
 
+        _write_records(renamed_directory, _read_records(path), renamed)
+        os.remove(marker)
         progress.log_message("Rename Completed")
 
+    except reporting.Cancelled:
+        progress.log_message("Rename stopped, rename the folder again to continue")
+        progress.destroy()
+        raise
+
     except:
         progress.log_message("Rename failed, restoring backup")
         _restore_backup(backup, path)
 
     progress.destroy()
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _same_file(origin, dest):
+    try:
+        a = os.stat(origin)
+        b = os.stat(dest)
+    except OSError:
+        return False
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+# An in-place rename moves every file to a temporary name, then to its new name, so new
+# names never collide with old ones. The journal records both steps so an interrupted
+# rename can be finished or undone with recover_rename.
+RENAME_JOURNAL = ".page-zipper-rename.json"
+
+
+def pending_rename(path):
+    return os.path.exists(os.path.join(path, RENAME_JOURNAL))
+
+
+def _write_journal(path, journal):
+    temp = os.path.join(path, RENAME_JOURNAL + ".tmp")
+    with open(temp, 'w') as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, os.path.join(path, RENAME_JOURNAL))
+
+
+def _read_journal(path):
+    with open(os.path.join(path, RENAME_JOURNAL)) as f:
+        return json.load(f)
+
+
+def _rename_in_place(path, start_number, prefix, progress):
+    names = sorted(os.listdir(path))
+    files = [f for f in names if not is_own_file(f)]
+    digits = len(files) + start_number
+    token = uuid.uuid4().hex[:8]
+
+    entries = []
+    for file in files:
+        if os.path.isfile(os.path.join(path, file)):
+            end = os.path.splitext(file)[1]
+            final = prefix + str(start_number).zfill(len(str(digits))) + end
+            entries.append([file, ".pz-{0}-{1}.tmp".format(token, len(entries)), final])
+            start_number += 1
+
+    # Folders and other entries that are not renamed must not be overwritten
+    untouched = set(names) - set(e[0] for e in entries)
+    taken = [e[2] for e in entries if e[2] in untouched]
+    if taken:
+        raise FileExistsError("Cannot rename to {0}, the name is already used".format(taken[0]))
+
+    # The records are kept as they were, so finishing or undoing the rename can write them again
+    _write_journal(path, {'phase': 1, 'entries': entries, 'records': _read_records(path)})
+    _roll_forward(path, _read_journal(path), progress)
+
+
+def _roll_forward(path, journal, progress):
+    entries = journal['entries']
+    progress = progress("Renaming Files", 2 * len(entries))
+    batch = reporting.Batcher(progress)
+
+    try:
+        if journal['phase'] == 1:
+            for origin, temp, final in entries:
+                _check_cancelled(progress, batch)
+                if os.path.exists(os.path.join(path, origin)) and not os.path.exists(os.path.join(path, temp)):
+                    os.rename(os.path.join(path, origin), os.path.join(path, temp))
+                batch.next()
+
+            journal['phase'] = 2
+            _write_journal(path, journal)
+        else:
+            progress.next(len(entries))
+
+        for origin, temp, final in entries:
+            _check_cancelled(progress, batch)
+            if os.path.exists(os.path.join(path, temp)):
+                os.rename(os.path.join(path, temp), os.path.join(path, final))
+            batch.next("Renamed {0} as {1}".format(origin, final))
+
+        _write_records(path, journal.get('records'), {origin: final for origin, temp, final in entries})
+        os.remove(os.path.join(path, RENAME_JOURNAL))
+        batch.flush()
+        progress.log_message("Rename Completed")
+    finally:
+        progress.destroy()
+
+
+def _roll_back(path, journal, progress):
+    entries = journal['entries']
+    progress = progress("Undoing Rename", 2 * len(entries))
+    batch = reporting.Batcher(progress)
+
+    try:
+        if journal['phase'] == 2:
+            for origin, temp, final in entries:
+                _check_cancelled(progress, batch)
+                if os.path.exists(os.path.join(path, final)) and not os.path.exists(os.path.join(path, temp)):
+                    os.rename(os.path.join(path, final), os.path.join(path, temp))
+                batch.next()
+
+            journal['phase'] = 1
+            _write_journal(path, journal)
+        else:
+            progress.next(len(entries))
+
+        for origin, temp, final in entries:
+            _check_cancelled(progress, batch)
+            if os.path.exists(os.path.join(path, temp)):
+                os.rename(os.path.join(path, temp), os.path.join(path, origin))
+            batch.next("Restored {0}".format(origin))
+
+        _write_records(path, journal.get('records'), {})
+        os.remove(os.path.join(path, RENAME_JOURNAL))
+        batch.flush()
+        progress.log_message("Rename Undone")
+    finally:
+        progress.destroy()
+
+
+# Every step of a journaled rename can be repeated, so it can stop between any two files and
+# be finished or undone later with recover_rename
+def _check_cancelled(progress, batch):
+    if reporting.cancelled(progress):
+        batch.flush()
+        progress.log_message("Rename stopped, it can be finished or undone later")
+        raise reporting.Cancelled()
+
+
+# Finishes (forward=True) or undoes an interrupted in-place rename
+def recover_rename(path, forward=True, progress=reporting.ConsoleProgress):
+    journal = _read_journal(path)
+    if forward:
+        _roll_forward(path, journal, progress)
+    else:
+        _roll_back(path, journal, progress)
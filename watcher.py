@@ -0,0 +1,208 @@
+import ctypes
+import ctypes.util
+import os
+import stat
+import struct
+import sys
+import time
+
+import folderindex
+import stats
+
+
+# inotify(7) flags
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    '''A non-blocking inotify watch on one folder, used through ctypes
+
+    read returns the events of each name. A new file is only ready once it is closed after
+    writing or moved into the folder, so captures still being written are not picked up
+    half finished.
+    '''
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    # Events after which a file can be read, or is gone
+    ready = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+    def __init__(self, path):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), Inotify.mask) < 0:
+            code = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(code, os.strerror(code), path)
+
+    # Returns {name: the events of the name combined}, and whether the whole folder must be listed again
+    def read(self):
+        names = {}
+        rescan = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+
+                # Events were lost, or the folder itself was removed or moved
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    rescan = True
+                if name:
+                    name = os.fsdecode(name)
+                    names[name] = names.get(name, 0) | mask
+
+        return names, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _inotify(path):
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return Inotify(path)
+    except (OSError, AttributeError):
+        # No inotify, or the per-user watch limit is reached
+        return None
+
+
+class FolderWatcher:
+    '''Reports the files added, changed or removed in a folder since the last poll
+
+    Uses inotify on Linux, where only the files named in the events are stat'ed. A new file
+    is added once it is closed after writing or moved in, and the folder is only listed again
+    when events were lost. Elsewhere the folder is polled: it is only listed again when its
+    modification time changes, and every few polls to notice files rewritten in place.
+    Whenever the folder is listed, files modified in the last settle seconds are held back
+    until a later poll, as they may still be being written.
+    '''
+
+    settle = 1.0
+
+    # Polls between full scans when polling
+    full_scan = 10
+
+    # index is the FolderIndex the caller's pages were listed from
+    def __init__(self, path, index=None):
+        self.path = path
+        self.index = index or folderindex.FolderIndex.load(path)
+        self.known = {os.path.basename(p): (size, mtime) for p, size, mtime in self.index}
+        # Names held back until they settle
+        self.waiting = set()
+        self.polls = 0
+        self.notify = _inotify(path)
+        # Files written before the watch started have no events, so the folder is listed once
+        self.rescan = self.notify is not None
+
+    def uses_inotify(self):
+        return self.notify is not None
+
+    # Returns (added, changed, removed), or None if nothing changed
+    # added and changed are lists of (path, size, mtime_ns) in natural order, removed is a list of paths
+    # Raises OSError if the folder can no longer be read
+    def poll(self):
+        if self.notify is not None:
+            events, rescan = self.notify.read()
+            if not rescan and not self.rescan:
+                return self.poll_events(events)
+            self.rescan = False
+        else:
+            self.polls += 1
+            full = self.polls % FolderWatcher.full_scan == 0
+            if not full and not self.waiting and os.stat(self.path).st_mtime_ns == self.index.folder_mtime:
+                return None
+
+        with stats.timer('watch.scan'):
+            folder_mtime = os.stat(self.path).st_mtime_ns
+            index = folderindex.FolderIndex.scan(self.path)
+            index.folder_mtime = folder_mtime
+        if index.names != self.index.names or index.sizes != self.index.sizes or index.mtimes != self.index.mtimes:
+            index.save()
+        self.index = index
+
+        found = {os.path.basename(path): (size, mtime) for path, size, mtime in index}
+        return self.compare(found, None, set(found))
+
+    # Stats only the files named in the events, and the files held back by an earlier listing
+    def poll_events(self, events):
+        ready = set()
+        for name, mask in events.items():
+            # Other events of a new file, such as its permissions being set, come before it is closed
+            if mask & Inotify.ready or name in self.known:
+                ready.add(name)
+        if not ready and not self.waiting:
+            return None
+
+        # A held back file that was closed since is ready now
+        hold = self.waiting - ready
+        found = {}
+        with stats.timer('watch.stat'):
+            for name in ready | self.waiting:
+                if name.startswith('.'):
+                    continue
+                try:
+                    result = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # Removed or moved away
+                    continue
+                if stat.S_ISREG(result.st_mode):
+                    found[name] = (result.st_size, result.st_mtime_ns)
+        return self.compare(found, ready | self.waiting, hold)
+
+    # found is {name: (size, mtime_ns)} of the files among checked, or among every file when checked is None
+    # Names in hold are held back while they were modified in the last settle seconds
+    def compare(self, found, checked, hold):
+        added = []
+        changed = []
+        self.waiting = set()
+        recent = time.time_ns() - int(FolderWatcher.settle * 1e9)
+
+        for name in sorted(found, key=folderindex.natural_key):
+            size, mtime = found[name]
+            old = self.known.get(name)
+            if old == (size, mtime):
+                continue
+
+            if name in hold and mtime > recent:
+                self.waiting.add(name)
+                continue
+
+            self.known[name] = (size, mtime)
+            (added if old is None else changed).append((os.path.join(self.path, name), size, mtime))
+
+        gone = [name for name in (self.known if checked is None else checked) if name in self.known and name not in found]
+        removed = [os.path.join(self.path, name) for name in gone]
+        for name in gone:
+            del self.known[name]
+
+        if added or changed or removed:
+            return added, changed, removed
+        return None
+
+    def close(self):
+        if self.notify is not None:
+            self.notify.close()
+            self.notify = None
@@ -4,9 +4,23 @@ from tkinter import filedialog
 from tkinter import messagebox
 from tkinter.font import Font
 
+import collections
 import os
+import queue
+import time
 import utils
 
+import export
+import fixity
+import folderindex
+import loader
+import pagesequence
+import settings
+import spreads
+import stats
+import transcode
+import transfer
+import watcher
 import zipper
 
 
@@ -28,11 +42,23 @@ class LabeledEntry(tk.Frame):
         return self.entry.get()
 
 
+class InvalidEntry(ValueError):
+    pass
+
+
 class LabeledIntEntry(LabeledEntry):
     def __init__(self, parent, label="Entry:"):
         self.entry = tk.IntVar()
+        self.label = label.rstrip(":")
         LabeledEntry.__init__(self, parent, label)
 
+    # Raises InvalidEntry, with a message to show, when the text is not a whole number
+    def get(self):
+        try:
+            return self.entry.get()
+        except tk.TclError:
+            raise InvalidEntry("{0} must be a whole number".format(self.label))
+
 
 class LabeledStringEntry(LabeledEntry):
     def __init__(self, parent, label="Entry:"):
@@ -40,6 +66,27 @@ class LabeledStringEntry(LabeledEntry):
         LabeledEntry.__init__(self, parent, label)
 
 
+class LabeledOptionMenu(tk.Frame):
+    '''A tkinter widget for a labeled drop down menu. options maps each value to the text shown for it'''
+    def __init__(self, parent, options, label="Option:"):
+        tk.Frame.__init__(self, parent)
+        self.options = options
+        self.entry = tk.StringVar(value=next(iter(options.values())))
+
+        tk.Label(self, text=label).grid(row=0, column=0, sticky='nse')
+        tk.OptionMenu(self, self.entry, *options.values()).grid(row=0, column=1, sticky='nsw', padx=5)
+
+        self.columnconfigure(0, weight=0)
+        self.columnconfigure(1, weight=1)
+
+    def set(self, value):
+        self.entry.set(self.options[value])
+
+    def get(self):
+        text = self.entry.get()
+        return next(value for value, shown in self.options.items() if shown == text)
+
+
 class DirectoryBrowser(tk.Frame):
     '''A tkinter widget for a labeled directory browser'''
     def __init__(self, parent, label="Choose Folder:", callback=lambda: None):
@@ -68,11 +115,26 @@ class DirectoryBrowser(tk.Frame):
 
 
 class ProgressPopup(tk.Toplevel):
-    '''Displays progress with progressbar'''
+    '''Displays progress with progressbar
+
+    Only the most recent lines of the log are shown, and the window is redrawn at most
+    rate times a second, so the cost of reporting does not grow with the size of the job.
+    Every line is written to a log file in the settings folder. Cancel asks the job to stop
+    at its next checkpoint, jobs check cancelled between steps.
+    '''
+
+    # Lines kept in the window
+    lines = 200
+
+    # Redraws per second
+    rate = 20
+
+    # Log files kept in the logs folder
+    log_files = 20
+
     def __init__(self, title, steps=100):
         tk.Toplevel.__init__(self)
         self.fixed_font = Font(size=10)
-        self.line_height = self.fixed_font.metrics("linespace")
 
         self.title(title)
         tk.Label(self, text=title).grid(row=0, column=0, sticky='w', padx=5, pady=20, columnspan=2)
@@ -84,26 +146,143 @@ class ProgressPopup(tk.Toplevel):
 
         self.log = tk.Canvas(self, background='#FFFFFF', width=500, height=150, yscrollcommand=self.scrollbar.set)
         self.log.grid(row=2, column=0, sticky='nesw', pady=10)
-        self.log.line_number = 0
+        self.log_text = self.log.create_text(0, 0, font=self.fixed_font, text="", anchor='nw')
+        self.recent = collections.deque(maxlen=ProgressPopup.lines)
 
         self.scrollbar.config(command=self.log.yview)
 
+        self.log_file = ProgressPopup.open_log(title)
+        if self.log_file is not None:
+            tk.Label(self, text="Full log: {0}".format(self.log_file.name), anchor='w').grid(row=3, column=0, sticky='ew', padx=5, columnspan=2)
+
+        self.cancelled = False
+        self.cancel_button = tk.Button(self, text="Cancel", command=self.cancel)
+        self.cancel_button.grid(row=4, column=0, columnspan=2, pady=5)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+
         self.grab_set()
 
         self.step = 100.0 / steps
-
-    def next(self):
-        self.progress['value'] += self.step
-        self.update()
+        self.done = 0
+        self.dirty = False
+        self.last_draw = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+        self.cancel_button.configure(text="Stopping...", state='disabled')
+
+    # Returns a new log file, or None if it can't be created
+    @staticmethod
+    def open_log(title):
+        folder = os.path.join(settings.data_dir(), "logs")
+        try:
+            os.makedirs(folder, exist_ok=True)
+            old = sorted(f for f in os.listdir(folder) if f.endswith(".log"))
+            for name in old[:max(0, len(old) - ProgressPopup.log_files + 1)]:
+                os.remove(os.path.join(folder, name))
+
+            stem = os.path.join(folder, "{0}-{1}".format(time.strftime("%Y%m%d-%H%M%S"), title.replace(" ", "-").lower()))
+            # Created exclusively, so two windows opened in the same second never share a log
+            number = 1
+            while True:
+                try:
+                    return open(stem + (".log" if number == 1 else "-{0}.log".format(number)), 'x', encoding='utf-8')
+                except FileExistsError:
+                    number += 1
+        except OSError as err:
+            print("Error Creating Log File: {0}".format(err))
+            return None
+
+    def next(self, count=1):
+        self.done += count
+        self.dirty = True
+        self.tick()
 
     def log_message(self, line):
-        self.log.create_text(0, (self.line_height * self.log.line_number), font=self.fixed_font, text=line, anchor='nw')
-        self.log.line_number += 1
-        self.log.configure(scrollregion=self.log.bbox('all'))
-        self.log.yview_moveto(1)
+        self.log_messages([line])
+
+    def log_messages(self, lines):
+        self.recent.extend(lines)
+        if self.log_file is not None:
+            for line in lines:
+                self.log_file.write(line + "\n")
+        self.dirty = True
+        self.tick()
 
+    # Redraws if enough time has passed since the last redraw
+    def tick(self):
+        if time.perf_counter() - self.last_draw >= 1.0 / ProgressPopup.rate:
+            self.draw()
+
+    def draw(self):
+        self.last_draw = time.perf_counter()
+        if self.dirty:
+            self.dirty = False
+            self.progress['value'] = self.step * self.done
+            self.log.itemconfigure(self.log_text, text="\n".join(self.recent))
+            self.log.configure(scrollregion=self.log.bbox(self.log_text))
+            self.log.yview_moveto(1)
+            if self.log_file is not None:
+                self.log_file.flush()
+
+        # Keeps the window responsive while the job runs on the main loop
         self.update()
 
+    def destroy(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        tk.Toplevel.destroy(self)
+
+
+class StatsFrame(tk.LabelFrame):
+    '''Shows the time spent in each stage from stats.recorder, refreshed while it is visible'''
+
+    # Milliseconds between refreshes
+    interval = 1000
+
+    columns = ("Count", "Total ms", "Mean ms", "Max ms")
+
+    def __init__(self, parent):
+        tk.LabelFrame.__init__(self, parent, text="Performance")
+
+        self.table = ttk.Treeview(self, columns=StatsFrame.columns, height=10)
+        self.table.heading('#0', text="Stage")
+        for column in StatsFrame.columns:
+            self.table.heading(column, text=column)
+            self.table.column(column, width=90, anchor='e')
+        self.table.grid(row=0, column=0, columnspan=3, sticky='nesw', padx=5, pady=5)
+
+        tk.Button(self, text="Reset", command=self.reset).grid(row=1, column=0, sticky='w', padx=5, pady=5)
+        tk.Button(self, text="Export Trace", command=self.export).grid(row=1, column=1, sticky='w', pady=5)
+
+        self.columnconfigure(2, weight=1)
+        self.after(StatsFrame.interval, self.poll)
+
+    def poll(self):
+        if self.winfo_ismapped():
+            self.refresh()
+        self.after(StatsFrame.interval, self.poll)
+
+    def refresh(self):
+        self.table.delete(*self.table.get_children())
+        for name, count, total, mean, longest in stats.recorder.summary():
+            self.table.insert('', 'end', text=name, values=(count, "{0:.1f}".format(total * 1000), "{0:.2f}".format(mean * 1000), "{0:.2f}".format(longest * 1000)))
+        for name, value in stats.recorder.counter_values():
+            self.table.insert('', 'end', text=name, values=(value, "", "", ""))
+
+    def reset(self):
+        stats.recorder.reset()
+        self.refresh()
+
+    def export(self):
+        path = filedialog.asksaveasfilename(defaultextension=".json", initialfile="page-zipper-trace.json", filetypes=[("Chrome Trace", "*.json")])
+        if path:
+            try:
+                stats.recorder.export_trace(path)
+            except OSError as err:
+                messagebox.showerror("Error", "Export failed: {0}".format(err))
+
 
 # TODO: Add option to set prefix on the rename
 class PrefixEntry(tk.Frame):
@@ -115,95 +294,400 @@ class PrefixEntry(tk.Frame):
         self.prefix.set("img_")
 
 
+class ProfileFrame(tk.LabelFrame):
+    '''Settings for saving resized access copies instead of the original files'''
+    def __init__(self, parent):
+        tk.LabelFrame.__init__(self, parent, text="Access Copies")
+
+        self.enabled = tk.BooleanVar(value=False)
+        tk.Checkbutton(self, text="Save resized copies instead of the originals", variable=self.enabled).grid(row=0, column=0, columnspan=2, sticky='w')
+
+        self.long_edge = LabeledIntEntry(self, label="Long Edge (pixels, 0 keeps the size):")
+        self.long_edge.set(2000)
+        self.format = LabeledOptionMenu(self, transcode.FORMATS, label="Format:")
+        self.format.set('jpeg')
+        self.quality = LabeledIntEntry(self, label="Quality (1-100):")
+        self.quality.set(85)
+        self.strip = tk.BooleanVar(value=False)
+
+        self.long_edge.grid(row=1, column=0, sticky='w')
+        self.format.grid(row=1, column=1, sticky='w')
+        self.quality.grid(row=2, column=0, sticky='w')
+        tk.Checkbutton(self, text="Remove metadata", variable=self.strip).grid(row=2, column=1, sticky='w')
+
+    # Returns a transcode.Profile, or None when the originals are saved
+    def get(self):
+        if not self.enabled.get():
+            return None
+        return transcode.Profile(max(0, self.long_edge.get()), self.format.get(), min(100, max(1, self.quality.get())), self.strip.get())
+
+
 class OutputFrame(tk.Frame):
     '''A frame for a thumbnail viewer and browser'''
-    def __init__(self, root, callback=lambda: None):
+    def __init__(self, root, callback=lambda: None, check=lambda: None):
         self.pages = []
 
         tk.Frame.__init__(self, root)
         self.viewer = ThumbnailViewer(self, group=False)
         self.browser = DirectoryBrowser(self, "Output Path:")
         self.prefix = PrefixEntry(self)
-        self.save_button = tk.Button(self, text="Save", command=callback)
+        self.format = LabeledOptionMenu(self, export.FORMATS, label="Save As:")
+        self.mode = LabeledOptionMenu(self, transfer.MODES, label="Output Mode:")
+        self.workers = LabeledIntEntry(self, label="Files Copied at Once:")
+        self.workers.set(4)
+
+        options = tk.Frame(self)
+        self.sync = tk.BooleanVar(value=False)
+        self.hash = tk.BooleanVar(value=False)
+        tk.Checkbutton(options, text="Only write changes", variable=self.sync).grid(row=0, column=0, sticky='w')
+        tk.Checkbutton(options, text="Compare file contents (slower)", variable=self.hash).grid(row=0, column=1, sticky='w')
+
+        self.spreads = tk.BooleanVar(value=False)
+        self.cover_alone = tk.BooleanVar(value=True)
+        tk.Checkbutton(options, text="Join facing pages into spreads", variable=self.spreads).grid(row=1, column=0, sticky='w')
+        tk.Checkbutton(options, text="Keep the cover alone", variable=self.cover_alone).grid(row=1, column=1, sticky='w')
+        self.gap = LabeledIntEntry(options, label="Spread Gap (pixels):")
+        self.gap.set(0)
+        self.gap.grid(row=2, column=0, sticky='w')
+        self.align = LabeledOptionMenu(options, spreads.ALIGNMENTS, label="Align Pages:")
+        self.align.set('center')
+        self.align.grid(row=2, column=1, sticky='w')
+
+        self.manifest = tk.BooleanVar(value=False)
+        tk.Checkbutton(options, text="Write a checksum manifest", variable=self.manifest).grid(row=3, column=0, sticky='w')
+        self.checksum = LabeledOptionMenu(options, fixity.ALGORITHMS, label="Checksum:")
+        self.checksum.grid(row=3, column=1, sticky='w')
+
+        self.profile = ProfileFrame(self)
+
+        buttons = tk.Frame(self)
+        self.check_button = tk.Button(buttons, text="Check Pages", command=check)
+        self.check_button.grid(row=0, column=0, padx=5)
+        self.save_button = tk.Button(buttons, text="Save", command=callback)
+        self.save_button.grid(row=0, column=1, padx=5)
 
         self.viewer.grid(row=0, column=0, sticky='nesw', padx=10, pady=5)
         self.browser.grid(row=1, column=0, sticky='nesw', padx=10)
         self.prefix.grid(row=2, column=0, sticky='nsw', padx=10, pady=5)
-        self.save_button.grid(row=3, column=0, sticky='', pady=5)
+        self.format.grid(row=3, column=0, sticky='nsw', padx=10, pady=5)
+        self.mode.grid(row=4, column=0, sticky='nsw', padx=10, pady=5)
+        self.workers.grid(row=5, column=0, sticky='nsw', padx=10, pady=5)
+        options.grid(row=6, column=0, sticky='nsw', padx=10, pady=5)
+        self.profile.grid(row=7, column=0, sticky='nsw', padx=10, pady=5)
+        buttons.grid(row=8, column=0, sticky='', pady=5)
 
         self.columnconfigure(0, weight=1)
 
+    # Returns the checksum algorithm of the manifest to write, or None
+    def algorithm(self):
+        return self.checksum.get() if self.manifest.get() else None
+
+    # Returns the names of the checked settings that a save of spreads or access copies does not use
+    def unused_settings(self, spreads):
+        unused = []
+        if spreads and self.profile.get() is not None:
+            unused.append("Access Copies")
+        if self.manifest.get():
+            unused.append("Write a checksum manifest")
+        if self.sync.get():
+            unused.append("Only write changes")
+        if self.mode.get() != 'copy':
+            unused.append("Output Mode")
+        return unused
+
 
 class PagesFrame(tk.Frame):
-    '''A frame for a thumbnail viewer and browser'''
-    def __init__(self, root, label, callback=lambda: None):
+    '''A frame for a thumbnail viewer and browser
+
+    When watching, pages added to the folder during a capture are appended to the viewer
+    without rebuilding the pages already there or their groups.
+    '''
+
+    # Milliseconds between checks of a watched folder
+    watch_interval = 500
+
+    def __init__(self, root, label, callback=lambda start: None):
         self.pages = []
         self.callback = callback
+        self.cache_stats = (0, 0)
+        self.index = None
+        self.watcher = None
+        self.watch_job = None
 
         tk.Frame.__init__(self, root)
         tk.Label(self, text=label).grid(row=0, column=0, sticky='w', padx=5, pady=5, columnspan=2)
         self.browser = DirectoryBrowser(self, "")
         self.viewer = ThumbnailViewer(self, group=True, callback=self.on_viewer_update)
 
+        self.watch = tk.BooleanVar(value=False)
+        tk.Checkbutton(self, text="Watch for new pages", variable=self.watch, command=self.on_watch).grid(row=1, column=1, sticky='w', padx=5)
+
         self.browser.grid(row=1, column=0, sticky='nesw', padx=10)
         self.viewer.grid(row=2, column=0, sticky='nesw', padx=10, pady=5)
 
+        self.status = tk.Label(self, text="", anchor='w')
+        self.status.grid(row=3, column=0, sticky='ew', padx=10)
+
         self.columnconfigure(0, weight=1)
 
         self.browser.callback = self.on_input
+        thumbnail_pool.listen(self.on_thumbnails, self)
 
-    # Create a widget that displays a progressbar as the pages are loaded
+    # Lists the pages from the folder index. Thumbnails are only made when a page is shown
     def load_pages(self, directory):
-        paths = os.listdir(directory)
-        paths.sort()
-
-        if len(paths) > 0:
-            progress = ProgressPopup("Loading Pages", len(paths))
-            temp = []
-            for path in paths:
-                if not os.path.isdir(os.path.join(directory, path)):
-                    p = utils.Page(os.path.join(directory, path))
+        # Thumbnails of the previous folder are no longer needed
+        thumbnail_pool.loader.cancel(self.pages)
 
-                    if p.thumb is not None:
-                        temp.append(p)
-                    progress.next()
-                    progress.log_message("Created thumbnail for {}".format(path))
+        with stats.timer('load_pages'):
+            self.index = folderindex.FolderIndex.load(directory)
+            pages = utils.list_pages(directory, self.index)
 
-            progress.destroy()
-
-            return temp
+        if len(pages) > 0:
+            self.cache_stats = utils.thumbnail_cache.stats()
+            self.status.configure(text="{0} pages".format(len(pages)))
+            return pages
         else:
             print("No images found")
 
+    def on_thumbnails(self, arrived, failed):
+        if not self.pages:
+            return
+
+        hits, misses = utils.thumbnail_cache.stats()
+        self.status.configure(text="{0} pages. Thumbnail cache: {1} hits, {2} misses".format(
+            len(self.pages), hits - self.cache_stats[0], misses - self.cache_stats[1]))
+
+        # Files that can't be loaded as images are left out of the book
+        failed = failed.intersection(self.pages)
+        if failed:
+            self.pages = [p for p in self.pages if p not in failed]
+            self.viewer.remove_pages(failed)
+
     def on_input(self):
         path = self.browser.path.get()
+        self.stop_watching()
 
         # Load pages, then draw in ImageViewer
-        self.pages = self.load_pages(path)
+        self.pages = self.load_pages(path) or []
 
-        if self.pages:
+        # A watched folder may still be empty when the capture starts
+        if self.pages or self.watch.get():
             self.viewer.reload_pages(self.pages)
 
-    def on_viewer_update(self):
-        self.callback()
+        if self.watch.get():
+            self.start_watching()
+
+    def on_watch(self):
+        if self.watch.get():
+            if self.index is not None:
+                self.start_watching()
+        else:
+            self.stop_watching()
+
+    def start_watching(self):
+        self.stop_watching()
+        try:
+            self.watcher = watcher.FolderWatcher(self.index.path, self.index)
+        except OSError as err:
+            self.status.configure(text="Cannot watch folder: {0}".format(err))
+            return
+        self.watch_job = self.after(PagesFrame.watch_interval, self.poll_watcher)
+
+    def stop_watching(self):
+        if self.watch_job is not None:
+            self.after_cancel(self.watch_job)
+            self.watch_job = None
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def poll_watcher(self):
+        self.watch_job = None
+        try:
+            changes = self.watcher.poll()
+        except OSError as err:
+            self.stop_watching()
+            self.watch.set(False)
+            self.status.configure(text="Stopped watching: {0}".format(err))
+            return
+
+        if changes is not None:
+            self.apply_changes(*changes)
+        self.watch_job = self.after(PagesFrame.watch_interval, self.poll_watcher)
+
+    # Only new and changed files get new thumbnails, the other pages and groups are kept
+    def apply_changes(self, added, changed, removed):
+        by_path = {p.path: p for p in self.pages}
+
+        gone = set(by_path[path] for path in removed if path in by_path)
+        if gone:
+            thumbnail_pool.loader.cancel(gone)
+            self.viewer.remove_pages(gone)
+
+        new = [utils.Page(path, size, mtime) for path, size, mtime in added]
+        for path, size, mtime in changed:
+            page = by_path.get(path)
+            if page is None:
+                # A file that failed to load before, e.g. because it was still being written
+                new.append(utils.Page(path, size, mtime))
+                continue
+
+            # The cache key includes the size and mtime, so the old thumbnail is not reused
+            page.file_size = size
+            page.mtime = mtime
+            page.loaded = None
+            thumbnail_pool.discard(page)
+            thumbnail_pool.request(page)
+
+        if new:
+            self.viewer.insert_pages(new)
+        elif changed and not gone:
+            # Nothing moved, but pages that were shot again need checking again
+            self.callback(len(self.viewer.pages))
+
+        self.pages = self.viewer.pages_in
+        self.status.configure(text="{0} pages".format(len(self.pages)))
+
+    def on_viewer_update(self, start=0):
+        self.callback(start)
+
+
+class ThumbnailPool:
+    '''Holds the decoded tk.PhotoImage thumbnails of the most recently shown pages within a memory budget
+
+    Thumbnails that are not made yet are requested from a loader.PageLoader. Listeners are
+    called with the sets of pages that arrived and failed.
+    '''
+    def __init__(self, budget=256 * 1024 * 1024):
+        self.budget = budget
+        self.used = 0
+        self.images = collections.OrderedDict()
+        self.loader = loader.PageLoader(utils.Page.size)
+        self.listeners = []
+        self.widget = None
+        self.polling = False
+
+    # widget is used to schedule polling the loader on the Tk main loop
+    def listen(self, callback, widget):
+        self.listeners.append(callback)
+        if self.widget is None:
+            self.widget = widget
+
+    # Returns None while the thumbnail has not been made yet
+    def get(self, page):
+        image = self.images.get(page)
+        if image is not None:
+            self.images.move_to_end(page)
+            return image
+
+        if page.loaded is False:
+            return None
+
+        if page.loaded:
+            data = utils.thumbnail_cache.get(page.path, utils.Page.size, count=False, stat=page.stat())
+            if data is not None:
+                return self.put(page, data)
+
+        # Not made yet, or evicted from the disk cache
+        self.request(page)
+        return None
+
+    def request(self, page):
+        self.loader.request(page)
+        if not self.polling and self.widget is not None:
+            self.polling = True
+            self.widget.after(50, self.poll)
+
+    # Move finished thumbnails from the loader into the pool without blocking the window
+    def poll(self):
+        arrived = set()
+        failed = set()
+        deadline = time.perf_counter() + 0.03
+
+        while time.perf_counter() < deadline:
+            try:
+                page, data = self.loader.results.get_nowait()
+            except queue.Empty:
+                break
+
+            if data is None:
+                page.loaded = False
+                failed.add(page)
+            else:
+                page.loaded = True
+                self.put(page, data)
+                arrived.add(page)
+
+        if arrived or failed:
+            for callback in self.listeners:
+                callback(arrived, failed)
+
+        if self.loader.busy() or not self.loader.results.empty():
+            self.widget.after(50, self.poll)
+        else:
+            self.polling = False
+
+    def put(self, page, data):
+        with stats.timer('thumbnail.photo'):
+            image = tk.PhotoImage(data=data)
+        if page in self.images:
+            self.discard(page)
+
+        self.images[page] = image
+        self.used += ThumbnailPool.cost(image)
+
+        while self.used > self.budget and len(self.images) > 1:
+            self.discard(next(iter(self.images)))
+
+        return image
+
+    def discard(self, page):
+        image = self.images.pop(page, None)
+        if image is not None:
+            self.used -= ThumbnailPool.cost(image)
+
+    # Tk stores photo images with four bytes per pixel
+    @staticmethod
+    def cost(image):
+        return image.width() * image.height() * 4
+
+
+thumbnail_pool = ThumbnailPool(settings.load()['thumbnail_memory_mb'] * 1024 * 1024)
 
 
 class ThumbnailViewer(tk.Frame):
-    '''A frame that holds a canvas for loaded images. Can scroll horizontally'''
-    def __init__(self, root, group=False, callback=lambda:None, *args, **kwargs):
+    '''A frame that holds a canvas for loaded images. Can scroll horizontally
+
+    With groups, pages is a pagesequence.PageSequence so grouping and ungrouping don't copy
+    the whole book, and each change can be undone. Files added or removed while watching are
+    added to or removed from the undo history too, so it is kept during a capture.
+    '''
+
+    spacing = 20
+
+    # Number of pages drawn past each edge of the view so scrolling doesn't show gaps
+    margin = 5
+
+    # {page: reason} from screening.screen_pages, shared by every viewer so a page is marked wherever it is shown
+    flags = {}
+
+    # callback is called with the index of the first page that changed
+    def __init__(self, root, group=False, callback=lambda start: None, *args, **kwargs):
         tk.Frame.__init__(self, root, *args, **kwargs)
         self.root = root
         self.pages_in = []
-        self.pages = []
-        self.hit_boxes = []
-        self.selected = []
-        self.scroll_location = None
+        self.pages = pagesequence.PageSequence()
+        self.history = pagesequence.History()
+        self.hit_boxes = {}
+        self.visible = {}
+        self.selected = set()
+        self.digits = 0
         self.callback = callback
         self.use_groups = group
 
         self.canvas = tk.Canvas(self, background='#FFFFFF', height=int(utils.Page.size * 0.85), width=800)
         self.scrollbar = tk.Scrollbar(self, orient='horizontal', command=self.canvas.xview)
-        self.canvas.configure(xscrollcommand=self.scrollbar.set)
+        self.canvas.configure(xscrollcommand=self.on_scroll)
         self.canvas.grid(row=0, column=0, sticky='ew', columnspan=2)
         self.scrollbar.grid(row=1, column=0, sticky='nesw', columnspan=2)
 
@@ -212,54 +696,200 @@ class ThumbnailViewer(tk.Frame):
             frame.grid(row=2, column=0, sticky='w', pady=5)
             tk.Button(frame, text='Group', command=self.group).grid(row=0, column=0, sticky='w')
             tk.Button(frame, text='Ungroup', command=self.ungroup).grid(row=0, column=1, sticky='w')
+            tk.Button(frame, text='Undo', command=self.undo).grid(row=0, column=2, sticky='w', padx=(10, 0))
+            tk.Button(frame, text='Redo', command=self.redo).grid(row=0, column=3, sticky='w')
 
         self.columnconfigure(0, weight=1)
         self.columnconfigure(1, weight=1)
 
-        self.canvas.configure(scrollregion=self.canvas.bbox('all'))
+        self.canvas.configure(scrollregion=(0, 0, 0, 0))
         self.canvas.bind("<Button-1>", self.on_click)
-        self.slider = self.scrollbar.get()
+        self.canvas.bind("<Configure>", lambda e: self.render())
+
+        # Thumbnails are made in the background, so they are filled in as they arrive
+        thumbnail_pool.listen(lambda arrived, failed: self.update_thumbnails(arrived), self)
 
     def reload_pages(self, pages_in=None):
         if pages_in is not None:
             self.pages_in = pages_in
-        self.pages = self.pages_in[:]
+        self.pages = pagesequence.PageSequence(self.pages_in)
+        self.history.clear()
         self.update()
 
-    def update(self):
-        self.selected = []
-        self.draw()
-        self.callback()
+    # Pages before start are unchanged, so their canvas items are kept
+    def update(self, start=0):
+        self.clear_selection()
+        self.refresh(start)
+        self.callback(start)
+
+    # Show new pages where only the pages from start to stop changed
+    # old_stop and new_stop differ when pages were added or removed, then every later page moved too
+    # pages is a zipper.OutputPages, which never changes, so the viewer holds it without copying
+    def replace(self, pages, start, old_stop, new_stop):
+        self.pages_in = pages
+        self.pages = pages
+
+        if old_stop != new_stop:
+            self.refresh(start)
+        else:
+            for i in [i for i in self.visible if start <= i < new_stop]:
+                self.erase_page(i)
+            self.render()
 
+    # Only the pages in view (plus a margin) have canvas items, the rest are drawn as the canvas scrolls
     def draw(self):
-        # CLEAR ALL
-        self.canvas.delete('all')
-        self.hit_boxes = []
-        self.scroll_location = self.scrollbar.get()
-
-        for i, page in enumerate(self.pages):
-            spacing = 20
-            size = utils.Page.size
-            n = str(i + 1).zfill(len(str(len(self.pages))))
-
-            # Create a frame for the image and text and save it to a list
-            box = (size * i) + (i * spacing), 1, (size * i) + (i * spacing) + size, utils.Page.size + 25
-            if i in self.selected:
-                self.canvas.create_rectangle(box, fill='lightblue', outline='', tags="background")
-
-            if type(page) is utils.Page:
-                name = n + "  " + page.name
-                self.canvas.create_image((size * i) + (i * spacing), spacing / 2, image=page.thumb, anchor="nw")
-                self.canvas.create_text((size * i) + (i * spacing) + (size / 2), int(size * 0.75), font=("tkdefaultfont", 10), text=name, anchor="n")
-            elif type(page) is utils.PageGroup:
-                # Draw first page of the group
-                self.canvas.create_image((size * i) + (i * spacing), spacing / 2, image=page.pages[0].thumb, anchor="nw")
-                self.canvas.create_text((size * i) + (i * spacing) + (size / 2), int(size * 0.75), font=("tkdefaultfont", 10), text=n + " " + page.name)
-
-            self.hit_boxes.append(self.canvas.create_rectangle(box, fill='', outline='', tags="hitbox"))
-
-        self.canvas.configure(scrollregion=self.canvas.bbox('all'))
-        self.scrollbar.set(self.scroll_location[0], self.scroll_location[1])
+        with stats.timer('viewer.draw'):
+            # CLEAR ALL
+            self.canvas.delete('all')
+            self.hit_boxes = {}
+            self.visible = {}
+            self.refresh()
+
+    # Redraw the pages from start onwards
+    def refresh(self, start=0):
+        # Page numbers are padded to the same width, so a new width changes every label
+        digits = len(str(len(self.pages)))
+        if digits != self.digits:
+            self.digits = digits
+            start = 0
+
+        for i in [i for i in self.visible if i >= start]:
+            self.erase_page(i)
+
+        width = len(self.pages) * (utils.Page.size + ThumbnailViewer.spacing)
+        self.canvas.configure(scrollregion=(0, 0, width, utils.Page.size + 25))
+        self.render()
+
+    def clear_selection(self):
+        for i in self.selected:
+            if i in self.visible:
+                self.canvas.itemconfigure(self.visible[i]['background'], fill='')
+        self.selected = set()
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.render()
+
+    # Returns the range of page indices that should have canvas items
+    def visible_range(self):
+        slot = utils.Page.size + ThumbnailViewer.spacing
+        left = self.canvas.canvasx(0)
+        width = max(self.canvas.winfo_width(), int(self.canvas['width']))
+
+        first = max(0, int(left // slot) - ThumbnailViewer.margin)
+        last = min(len(self.pages), int((left + width) // slot) + 1 + ThumbnailViewer.margin)
+        return first, last
+
+    def render(self):
+        with stats.timer('viewer.render'):
+            first, last = self.visible_range()
+
+            for i in list(self.visible):
+                if i < first or i >= last:
+                    self.erase_page(i)
+
+            for i in range(first, last):
+                if i not in self.visible:
+                    self.draw_page(i)
+                    stats.count('viewer.pages_drawn')
+
+    def draw_page(self, i):
+        page = self.pages[i]
+        spacing = ThumbnailViewer.spacing
+        size = utils.Page.size
+        x = (size * i) + (i * spacing)
+        n = str(i + 1).zfill(self.digits)
+        items = []
+
+        # Create a frame for the image and text, it is coloured when the page is selected
+        box = x, 1, x + size, utils.Page.size + 25
+        reason = self.flag(page)
+        background = self.canvas.create_rectangle(box, fill='lightblue' if i in self.selected else '', outline='darkorange' if reason else '',
+                                                  width=2, tags="background")
+        items.append(background)
+
+        if type(page) is utils.Page:
+            first = page
+            name = n + "  " + page.name
+            anchor = "n"
+        else:
+            # Draw first page of the group
+            first = next(pagesequence.flatten([page]))
+            name = n + " " + page.name
+            anchor = "center"
+
+        image = thumbnail_pool.get(first)
+        image_item = self.canvas.create_image(x, spacing / 2, image=image, anchor="nw")
+        items.append(image_item)
+        items.append(self.canvas.create_text(x + (size / 2), int(size * 0.75), font=("tkdefaultfont", 10), text=name, anchor=anchor))
+        if reason:
+            items.append(self.canvas.create_text(x + (size / 2), int(size * 0.75) + 14, font=("tkdefaultfont", 9), text=reason,
+                                                 fill='darkorange', anchor="n"))
+
+        hit_box = self.canvas.create_rectangle(box, fill='', outline='', tags="hitbox")
+        items.append(hit_box)
+        self.hit_boxes[hit_box] = i
+
+        # Holding the image keeps it alive on the canvas even if the pool evicts it
+        self.visible[i] = {'page': first, 'image': image, 'image_item': image_item, 'background': background, 'items': items, 'hit_box': hit_box}
+
+    # Returns why the page, or the first flagged page of a group, should be looked at, or None
+    @staticmethod
+    def flag(page):
+        if not ThumbnailViewer.flags:
+            return None
+        for p in pagesequence.flatten([page]):
+            if p in ThumbnailViewer.flags:
+                return ThumbnailViewer.flags[p]
+        return None
+
+    def erase_page(self, i):
+        entry = self.visible.pop(i)
+        self.canvas.delete(*entry['items'])
+        del self.hit_boxes[entry['hit_box']]
+
+    # Show thumbnails that finished loading after the pages were drawn
+    def update_thumbnails(self, pages):
+        for entry in self.visible.values():
+            if entry['page'] in pages:
+                entry['image'] = thumbnail_pool.get(entry['page'])
+                self.canvas.itemconfigure(entry['image_item'], image=entry['image'])
+
+    # Adds pages in file name order without changing groups
+    # Captures usually arrive at the end, so the search for their place starts there
+    def insert_pages(self, pages):
+        start = len(self.pages)
+        for page in sorted(pages, key=ThumbnailViewer.sort_key):
+            i = ThumbnailViewer.sorted_index(self.pages, page)
+            self.pages = self.pages.insert(i, page)
+            start = min(start, i)
+            self.pages_in.insert(ThumbnailViewer.sorted_index(self.pages_in, page), page)
+            self.history.insert(page, lambda pages: ThumbnailViewer.sorted_index(pages, page))
+
+        self.update(start)
+
+    # Returns the index page belongs at in pages, which are in file name order
+    @staticmethod
+    def sorted_index(pages, page):
+        key = ThumbnailViewer.sort_key(page)
+        i = len(pages)
+        while i > 0 and ThumbnailViewer.sort_key(pages[i - 1]) > key:
+            i -= 1
+        return i
+
+    @staticmethod
+    def sort_key(page):
+        while type(page) is utils.PageGroup:
+            page = page.pages[0]
+        return folderindex.natural_key(os.path.basename(page.path))
+
+    def remove_pages(self, pages):
+        pages = set(pages)
+        self.pages_in = [p for p in self.pages_in if p not in pages]
+        self.pages, first = self.pages.remove(pages)
+        self.history.remove(pages)
+        # Pages before the first one removed keep their place, so only the rest are drawn again
+        self.update(first)
 
     def on_click(self, event):
         if self.use_groups:
@@ -267,39 +897,51 @@ class ThumbnailViewer(tk.Frame):
 
             # Page selected
             if 'hitbox' in self.canvas.gettags(item):
-                index = self.hit_boxes.index(item[0])
+                index = self.hit_boxes[item[0]]
 
                 if not index in self.selected:
-                    self.selected.append(index)
+                    self.selected.add(index)
+                    fill = 'lightblue'
                 else:
                     self.selected.remove(index)
+                    fill = ''
 
-                self.selected.sort()
-                self.draw()
+                # Only the background of the clicked page changes
+                self.canvas.itemconfigure(self.visible[index]['background'], fill=fill)
 
     # TODO: Groups don't handle gaps well
     def group(self):
         if self.selected:
-            first_index = self.selected[0]
-
-            group = utils.PageGroup([self.pages.pop(first_index) for i in reversed(self.selected)])
+            first_index = min(self.selected)
 
             # Replace the grouped pages with the page group
-            self.pages.insert(first_index, group)
-            self.update()
+            self.history.push(self.pages, first_index)
+            self.pages = self.pages.group(first_index, min(len(self.pages), first_index + len(self.selected)))
+            self.update(first_index)
         else:
             messagebox.showerror("Error", "No images are selected")
 
     def ungroup(self):
         if self.selected:
-            temp = []
-            for p in self.pages:
-                if type(p) is utils.PageGroup and self.pages.index(p) in self.selected:
-                    temp.extend(p.pages)
-                else:
-                    temp.append(p)
-
-            self.pages = temp[:]
-            self.update()
+            groups = [i for i in self.selected if type(self.pages[i]) is utils.PageGroup]
+            if not groups:
+                return
+
+            # From the end, so the indices of the other selected groups stay the same
+            self.history.push(self.pages, min(groups))
+            for i in sorted(groups, reverse=True):
+                self.pages = self.pages.ungroup(i)
+            self.update(min(groups))
         else:
             messagebox.showerror("Error", "No page groups are selected")
+
+    def undo(self):
+        self.restore(self.history.undo(self.pages))
+
+    def redo(self):
+        self.restore(self.history.redo(self.pages))
+
+    def restore(self, step):
+        if step is not None:
+            self.pages, start = step
+            self.update(start)
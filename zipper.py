@@ -1,40 +1,353 @@
 import os
-import shutil
 import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import utils
-import widgets
+import fixity
+import pagesequence
+import reporting
+import stats
+import transfer
 
 
 def ungroup(merged):
-    temp = []
-    for p in merged:
-        if type(p) is utils.PageGroup:
-            temp.extend(p.pages)
-        else:
-            temp.append(p)
+    return list(pagesequence.flatten(merged))
 
-    return temp[:]
 
+# Returns the numbered output file name of the page at index
+def output_name(index, path, count, pre="img_"):
+    return pre + str(index + 1).zfill(len(str(count))) + os.path.splitext(path)[1]
 
-def copy_files(files, out, pre="img_"):
-    progress = widgets.ProgressPopup("Saving Images", len(files))
 
-    for i in range(len(files)):
-        new_file = pre + str(str(i + 1).zfill(len(str(len(files)))) + os.path.splitext(files[i].path)[1]) #SUPER GROSS
-        new_path = os.path.join(out, new_file)
-        shutil.copy2(files[i].path, new_path)
+# A save keeps a journal in the output folder: the pages to save, written once, and a log of the
+# pages that are done, so an interrupted or cancelled save can be resumed with resume_save.
+SAVE_JOURNAL = ".page-zipper-save.json"
+SAVE_LOG = ".page-zipper-save.log"
 
-        progress.next()
-        progress.log_message("Copied {0} to {1}".format(files[i].path, new_path))
+# After a save or sync, the original of each output file, with the size and mtime of both when it was
+# written. A sync in 'stat' mode only keeps or renames a file this record says came from the same original
+SAVE_SOURCES = ".page-zipper-sources.json"
 
-    progress.destroy()
+# Seconds a saved file's modification time may differ from the original's, e.g. on FAT drives
+MTIME_TOLERANCE_NS = 2 * 10 ** 9
+
+
+def pending_save(out):
+    return os.path.exists(os.path.join(out, SAVE_JOURNAL))
+
+
+# Forgets an interrupted save, e.g. when the folder is synced instead, so it is never resumed later
+def discard_save(out):
+    for name in (SAVE_LOG, SAVE_JOURNAL):
+        path = os.path.join(out, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# The SAVE_SOURCES record of the file at path, written from origin when origin had size and mtime_ns
+def source_record(origin, size, mtime, path):
+    stat = os.stat(path)
+    return [os.path.abspath(origin), size, mtime, stat.st_size, stat.st_mtime_ns]
+
+
+# Returns {output name: source_record}, empty if out has no record
+def read_sources(out):
+    try:
+        with open(os.path.join(out, SAVE_SOURCES), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_sources(out, sources):
+    target = os.path.join(out, SAVE_SOURCES)
+    with open(target + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(sources, f, separators=(',', ':'))
+    os.replace(target + ".tmp", target)
+
+
+class SaveJournal:
+    '''The journal of a save in an output folder
+
+    Each entry is [origin, output name, size, mtime_ns] of the original. Finished output names
+    are appended to the log, with their digest when a manifest is written. The log is synced
+    to disk at most once a second, so a crash only loses the last second of work. Those pages
+    are checked and saved again on resume.
+    '''
+
+    # Seconds between checkpoints
+    interval = 1.0
+
+    def __init__(self, out):
+        self.out = out
+        self.log = None
+        self.last_checkpoint = 0.0
+
+    def path(self, name):
+        return os.path.join(self.out, name)
+
+    def start(self, jobs, mode, algorithm=None):
+        entries = []
+        for origin, target in jobs:
+            stat = os.stat(origin)
+            entries.append([origin, os.path.basename(target), stat.st_size, stat.st_mtime_ns])
+
+        temp = self.path(SAVE_JOURNAL + ".tmp")
+        with open(temp, 'w') as f:
+            json.dump({'mode': mode, 'algorithm': algorithm, 'entries': entries}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path(SAVE_JOURNAL))
+
+        self.log = open(self.path(SAVE_LOG), 'w', encoding='utf-8')
+        return entries
+
+    # Returns (mode, algorithm, entries, {name of a page that was done: digest or None})
+    def load(self):
+        with open(self.path(SAVE_JOURNAL)) as f:
+            journal = json.load(f)
+
+        done = {}
+        try:
+            with open(self.path(SAVE_LOG), encoding='utf-8') as f:
+                for line in f:
+                    # The last line may be cut short by a crash
+                    if line.endswith("\n"):
+                        name, _, digest = line[:-1].partition("\t")
+                        done[name] = digest or None
+        except OSError:
+            pass
+
+        self.log = open(self.path(SAVE_LOG), 'a', encoding='utf-8')
+        return journal['mode'], journal.get('algorithm'), journal['entries'], done
+
+    def record(self, name, digest=None):
+        self.log.write(name + ("\t" + digest if digest else "") + "\n")
+        if time.perf_counter() - self.last_checkpoint >= SaveJournal.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.last_checkpoint = time.perf_counter()
+
+    def close(self):
+        if self.log is not None:
+            self.checkpoint()
+            self.log.close()
+            self.log = None
+
+    # The save is complete, so there is nothing left to resume
+    def finish(self):
+        self.close()
+        discard_save(self.out)
+
+
+# True if an output file still matches the original it was saved from
+# tolerance is the nanoseconds the modification times may differ by
+def _saved(out, entry, tolerance=MTIME_TOLERANCE_NS):
+    origin, name, size, mtime = entry
+    try:
+        stat = os.stat(os.path.join(out, name))
+    except OSError:
+        return False
+    return stat.st_size == size and abs(stat.st_mtime_ns - mtime) <= tolerance
+
+
+# True if the page of a resumed save is already in place. Pages placed just before a crash may be
+# missing from the log. They must match exactly, unless their original is gone because it was moved
+def _placed(out, entry, done):
+    if entry[1] in done or not os.path.exists(entry[0]):
+        return _saved(out, entry)
+    return _saved(out, entry, 0)
+
+
+# progress is called as progress(title, steps), e.g. widgets.ProgressPopup in the GUI
+# mode is one of transfer.MODES. With an algorithm from fixity.ALGORITHMS, a manifest of the saved files is written to out
+def copy_files(files, out, pre="img_", progress=reporting.ConsoleProgress, mode='copy', workers=4, algorithm=None):
+    jobs = [(f.path, os.path.join(out, output_name(i, f.path, len(files), pre))) for i, f in enumerate(files)]
+
+    journal = SaveJournal(out)
+    entries = journal.start(jobs, mode, algorithm)
+    _save(entries, None, journal, progress, mode, workers, algorithm)
+
+
+# Continues an interrupted save in out, with the pages and mode it was started with
+# Pages that were saved and still match their original are skipped
+def resume_save(out, progress=reporting.ConsoleProgress, workers=4):
+    journal = SaveJournal(out)
+    mode, algorithm, entries, done = journal.load()
+    _save(entries, done, journal, progress, mode, workers, algorithm)
+
+
+# done is None for a new save, which skips nothing
+def _save(entries, done, journal, progress, mode, workers, algorithm=None):
+    out = journal.out
+    progress = progress("Saving Images", len(entries))
+
+    try:
+        skip = set(e[1] for e in entries if _placed(out, e, done)) if done is not None else set()
+        if skip:
+            progress.next(len(skip))
+            progress.log_message("Skipped {0} pages that were already saved".format(len(skip)))
+        # Pages missing from the log have no digest, so the saved file is hashed
+        if algorithm:
+            for name in skip:
+                if not done.get(name):
+                    done[name] = fixity.hash_file(os.path.join(out, name), algorithm)
+
+        jobs = [(origin, os.path.join(out, name)) for origin, name, size, mtime in entries if name not in skip]
+        with stats.timer('copy_files'):
+            digests = transfer_files(jobs, progress, mode, workers, journal, algorithm)
+
+        if algorithm:
+            digests = dict((os.path.basename(path), digest) for path, digest in digests.items())
+            digests.update((name, done[name]) for name in skip)
+            path = fixity.write_manifest(out, algorithm, digests)
+            progress.log_message("Wrote {0}".format(path))
+        write_sources(out, dict((name, source_record(origin, size, mtime, os.path.join(out, name))) for origin, name, size, mtime in entries))
+        journal.finish()
+    except reporting.Cancelled:
+        progress.log_message("Save stopped, it can be resumed")
+        raise
+    finally:
+        journal.close()
+        progress.destroy()
+
+
+# Places each (origin, destination) job with a pool of worker threads, and logs on an open progress
+# The log order only depends on the order of jobs. Finished jobs are recorded in journal, in order.
+# When progress is cancelled, the copies in flight are finished and recorded before raising reporting.Cancelled
+# Returns {destination: digest}, which is empty unless an algorithm from fixity.ALGORITHMS is given
+def transfer_files(jobs, progress, mode='copy', workers=4, journal=None, algorithm=None):
+    batch = reporting.Batcher(progress)
+    put = transfer.Transfer(mode, algorithm)
+
+    def finish(i, used):
+        origin, new_path = jobs[i]
+        batch.next("{0} {1} to {2}".format(transfer.VERBS[used], origin, new_path))
+        if journal is not None:
+            journal.record(os.path.basename(new_path), put.digests.get(new_path))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # A bounded number of copies are in flight
+        complete = reporting.run_in_order(len(jobs), lambda i: executor.submit(put, *jobs[i]), finish, progress, batch, workers * 2)
+
+    if put.used and list(put.used) != [mode]:
+        progress.log_message("Output modes used: " + ", ".join("{0} ({1})".format(transfer.MODES[m], n) for m, n in put.used.items()))
+    if not complete:
+        raise reporting.Cancelled()
+    return put.digests
+
+
+# Runs function(*args) for each (args, message) job in a pool of worker processes, and logs the messages in job order
+# Only a few jobs are in flight at a time, as each one may hold decoded images. Stops like transfer_files when cancelled
+# With cost, a function of a job's args returning the bytes of memory it needs, jobs are only started while the
+# jobs in flight need less than budget bytes altogether. A job that needs more than budget runs alone.
+def process_files(jobs, function, progress, workers=4, cost=None, budget=None):
+    batch = reporting.Batcher(progress)
+    costs = {}
+
+    def need(i):
+        if i not in costs:
+            costs[i] = cost(*jobs[i][0])
+        return costs[i]
+
+    def admit(i, in_flight):
+        return sum(need(j) for j in in_flight) + need(i) <= budget
+
+    # Imported here as multiprocessing is slow to import at startup
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        complete = reporting.run_in_order(len(jobs), lambda i: executor.submit(function, *jobs[i][0]),
+                                          lambda i, result: batch.next(jobs[i][1]), progress, batch, workers * 2,
+                                          admit if cost is not None else None)
+
+    if not complete:
+        raise reporting.Cancelled()
 
 
 def merge_lists(a, b):
     return [j for i in itertools.zip_longest(a, b) for j in i if j]
 
 
+class OutputPages:
+    '''The pages of right and left interleaved as ungroup(merge_lists(right, left)) orders them, without building the list
+
+    right and left are pagesequence.PageSequence, which never change, so neither does this and
+    viewers can hold it without copying. Finding a page takes O(log^2 n) time, from the page
+    counts the sequences keep, so a change anywhere in a long book costs the same.
+    '''
+    __slots__ = ('right', 'left', 'length')
+
+    def __init__(self, right, left):
+        self.right = right
+        self.left = left
+        self.length = right.page_count() + left.page_count()
+
+    def __len__(self):
+        return self.length
+
+    # Returns the index of the first page of the (right, left) pair at index pair
+    def offset(self, pair):
+        return self.right.page_count(pair) + self.left.page_count(pair)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("OutputPages index out of range")
+
+        # The last pair that starts at or before index
+        low, high = 0, max(len(self.right), len(self.left)) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.offset(middle) <= index:
+                low = middle
+            else:
+                high = middle - 1
+
+        index -= self.offset(low)
+        for side in (self.right, self.left):
+            if low < len(side):
+                entry = side[low]
+                count = side.page_count(low + 1) - side.page_count(low)
+                if index < count:
+                    return next(itertools.islice(pagesequence.flatten([entry]), index, None))
+                index -= count
+
+    def __iter__(self):
+        return iter(pagesequence.flatten(merge_lists(self.right, self.left)))
+
+    def __repr__(self):
+        return "OutputPages({0!r})".format(list(self))
+
+
+class OutputModel:
+    '''The merged and ungrouped output pages, kept up to date as the input pages change
+
+    pages is an OutputPages of the current input sequences, so nothing is merged again when
+    they change. Only the output viewer's pages in view are looked up.
+    '''
+    def __init__(self):
+        self.pages = OutputPages(pagesequence.PageSequence(), pagesequence.PageSequence())
+
+    # right and left are the pagesequence.PageSequence of the input viewers
+    # start is the index of the first entry that changed in either one, so the entries
+    # before it in both must be unchanged. Returns (start, old_stop, new_stop), the
+    # range of output pages that changed
+    def update(self, right, left, start=0):
+        old = len(self.pages)
+        self.pages = OutputPages(right, left)
+        begin = min(self.pages.offset(start), old, len(self.pages))
+        return begin, old, len(self.pages)
+
+
 # Testing
 def clear_dir(path):
     for f in os.listdir(path):